@@ -0,0 +1,230 @@
+'''
+Typed, array-backed analysis results.
+
+The analysis classes return these objects instead of writing to a widget. All
+numbers are computed up front with NumPy; rendering to text (for the GUI),
+JSON-ready dicts (for batch runs) or CSV rows is a separate step.
+'''
+
+import csv
+import json
+
+import numpy as np
+
+import Geometry
+import Uncertainty
+from Instrumentation import instrument
+
+# Bump whenever a change to the analysis changes its results, so stored results
+# (see ResultsStore) are recomputed
+ALGORITHM_VERSION = 4
+
+
+# json.dump default= hook for NumPy values
+def jsonDefault(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+def _point(value):
+    return None if value is None else [float(v) for v in value]
+
+
+class CollectionResult(object):
+    '''
+    Spherical result for one line collection:
+
+    distances        (n,)  distance from each line to the circle center
+    numIntersections int   number of pairwise intersections
+    inCluster        (m,)  mask of the intersections in their densest cluster (Geometry.densityCluster)
+    clusterCenter    (2,)  mode of that cluster, None with fewer than 3 intersections
+    clusterOffset    (2,)  clusterCenter minus the circle center
+    clusterSpread    float robust standard deviation of the cluster, as a distance
+    outlierLines     (k,)  indices of the lines that miss the cluster
+    uncertainty            Uncertainty.CollectionUncertainty, when Monte Carlo samples were asked for
+    '''
+
+    def __init__(self, distances, numIntersections, inCluster=None, clusterCenter=None, clusterOffset=None,
+                 clusterSpread=None, outlierLines=None, uncertainty=None):
+        self.distances = distances
+        self.numIntersections = numIntersections
+        self.inCluster = inCluster
+        self.clusterCenter = clusterCenter
+        self.clusterOffset = clusterOffset
+        self.clusterSpread = clusterSpread
+        self.outlierLines = outlierLines
+        self.uncertainty = uncertainty
+
+    @property
+    def numInCluster(self):
+        return None if self.inCluster is None else int(self.inCluster.sum())
+
+    @property
+    def numOutlierLines(self):
+        return None if self.outlierLines is None else len(self.outlierLines)
+
+    def toDict(self):
+        result = {'distances': self.distances.tolist(), 'numIntersections': int(self.numIntersections)}
+        if self.clusterCenter is not None:
+            result['numInCluster'] = self.numInCluster
+            result['clusterCenter'] = _point(self.clusterCenter)
+            result['clusterOffset'] = _point(self.clusterOffset)
+            result['clusterSpread'] = float(self.clusterSpread)
+            result['outlierLines'] = [int(idx) for idx in self.outlierLines]
+        if self.uncertainty is not None:
+            result['uncertainty'] = self.uncertainty.toDict()
+        return result
+
+
+class SphericalResult(object):
+    mode = 'spherical'
+    csvHeader = ['collection', 'numLines', 'meanDistance', 'maxDistance', 'numIntersections', 'numInCluster',
+                 'clusterX', 'clusterY', 'offsetX', 'offsetY', 'clusterSpread', 'numOutlierLines',
+                 'distanceLow', 'distanceHigh', 'offsetLow', 'offsetHigh', 'pValue']
+
+    def __init__(self, center, radius, collections):
+        self.center = np.asarray(center, dtype=float)
+        self.radius = radius
+        self.collections = collections
+
+    def toText(self):
+        lines = []
+        for i, collection in enumerate(self.collections):
+            lines.append("Line Collection %s" % (i + 1))
+            lines.append("Minimum distances from each line to the center:")
+            lines.extend("%s" % distance for distance in collection.distances)
+            if collection.clusterCenter is not None:
+                lines.append("%d out of %d intersections in the densest cluster, spread %.2f px" % (collection.numInCluster, collection.numIntersections, collection.clusterSpread))
+                lines.append("Cluster is at %s, which is %s px away from the circle center" % (tuple(collection.clusterCenter), tuple(collection.clusterOffset)))
+                if len(collection.outlierLines):
+                    lines.append("Lines missing the cluster: %s" % ", ".join(str(idx + 1) for idx in collection.outlierLines))
+            u = collection.uncertainty
+            if u is not None:
+                lines.append("Mean distance %.2f px, 95%% interval %.2f to %.2f px" % (u.meanDistance, u.distanceInterval[0], u.distanceInterval[1]))
+                if u.offsetInterval is not None:
+                    lines.append("Cluster distance from the center, 95%% interval %.2f to %.2f px" % tuple(u.offsetInterval))
+                lines.append("Probability of lines this far from the center from noise alone: %.3f%s" % (u.pValue, " (INCONSISTENT)" if u.pValue < 0.01 else ""))
+        return "\n".join(lines)
+
+    def toDict(self):
+        return {
+            'mode': self.mode,
+            'center': _point(self.center),
+            'radius': float(self.radius),
+            'lineCollections': [collection.toDict() for collection in self.collections],
+        }
+
+    def toJson(self, **kwargs):
+        return json.dumps(self.toDict(), default=jsonDefault, **kwargs)
+
+    def csvRows(self):
+        for i, c in enumerate(self.collections):
+            cluster = c.clusterCenter if c.clusterCenter is not None else (None, None)
+            offset = c.clusterOffset if c.clusterOffset is not None else (None, None)
+            u = c.uncertainty
+            distanceInterval = u.distanceInterval if u is not None else (None, None)
+            offsetInterval = u.offsetInterval if u is not None and u.offsetInterval is not None else (None, None)
+            yield [i + 1, len(c.distances),
+                   c.distances.mean() if len(c.distances) else None,
+                   c.distances.max() if len(c.distances) else None,
+                   c.numIntersections, c.numInCluster,
+                   cluster[0], cluster[1], offset[0], offset[1], c.clusterSpread, c.numOutlierLines,
+                   distanceInterval[0], distanceInterval[1], offsetInterval[0], offsetInterval[1],
+                   u.pValue if u is not None else None]
+
+    def writeCsv(self, f):
+        writer = csv.writer(f)
+        writer.writerow(self.csvHeader)
+        writer.writerows(self.csvRows())
+
+
+class PlanarResult(object):
+    mode = 'planar'
+    csvHeader = ['collection', 'vanishingX', 'vanishingY', 'rmsDistance', 'commonRmsDistance', 'consistent']
+
+    # consistency is the dict returned by Geometry.planarConsistency
+    def __init__(self, consistency):
+        self.consistency = consistency
+
+    def toText(self):
+        c = self.consistency
+        lines = []
+        for i in xrange(len(c['vanishingPoints'])):
+            lines.append("Line Collection %s" % (i + 1))
+            if i not in c['usable']:
+                lines.append("At least 2 lines are needed to find a vanishing point")
+                continue
+            lines.append("Vanishing point at %s, lines are %s px away from it on average" % (tuple(c['vanishingPoints'][i]), c['rmsDistances'][i]))
+            lines.append("Lines are %s px away from the common vanishing point on average: %s" % (c['commonRmsDistances'][i], "consistent" if c['consistent'][i] else "INCONSISTENT"))
+
+        if c['usable']:
+            lines.append("Common vanishing point of all collections: %s" % (tuple(c['commonVanishingPoint']),))
+            if c['commonCondition'] > 1e8:
+                lines.append("The lines are nearly parallel, so the vanishing point is close to infinity")
+            lines.append("Vanishing point clusters, best first:")
+            lines.extend("%s" % clusterResult for clusterResult in c['clusters'])
+        return "\n".join(lines)
+
+    def toDict(self):
+        c = self.consistency
+        return {
+            'mode': self.mode,
+            'lineCollections': [{'vanishingPoint': _point(c['vanishingPoints'][idx]),
+                                 'rmsDistance': float(c['rmsDistances'][idx]),
+                                 'commonRmsDistance': float(c['commonRmsDistances'][idx]),
+                                 'consistent': bool(c['consistent'][idx])} for idx in c['usable']],
+            'commonVanishingPoint': _point(c['commonVanishingPoint']),
+            'clusters': [{'numClusters': r.numClusters,
+                          'distanceSums': [float(d) for d in r.distanceSums],
+                          'originalIndices': [list(idx) for idx in r.originalIndices]} for r in c['clusters']],
+        }
+
+    def toJson(self, **kwargs):
+        return json.dumps(self.toDict(), default=jsonDefault, **kwargs)
+
+    def csvRows(self):
+        c = self.consistency
+        for idx in c['usable']:
+            yield [idx + 1, c['vanishingPoints'][idx][0], c['vanishingPoints'][idx][1],
+                   c['rmsDistances'][idx], c['commonRmsDistances'][idx], bool(c['consistent'][idx])]
+
+    def writeCsv(self, f):
+        writer = csv.writer(f)
+        writer.writerow(self.csvHeader)
+        writer.writerows(self.csvRows())
+
+# Spherical consistency: how close each line passes to the circle center and where
+# each collection's intersections cluster. intersectionSets may be passed in when
+# they are already known (LineCollection keeps them up to date). With circlePoints
+# and numSamples, Monte Carlo confidence intervals and p-values are added; circleNoise
+# is the noise of circlePoints when it is not their circle fit's rms error.
+@instrument('analyze')
+def sphericalResult(center, radius, lineSets, intersectionSets=None, circlePoints=None, numSamples=0, circleNoise=None):
+    center = np.asarray(center, dtype=float)
+    lineSets = [Geometry.asLineArray(lines) for lines in lineSets]
+    if intersectionSets is None:
+        intersectionSets = [Geometry.pairwiseIntersections(lines)[0] for lines in lineSets]
+
+    collections = []
+    for lines, intersections in zip(lineSets, intersectionSets):
+        collection = CollectionResult(Geometry.pointLineDistances(center, lines), len(intersections))
+        cluster = Geometry.densityCluster(intersections) if len(intersections) > 2 else None
+        if cluster is not None:
+            collection.inCluster = cluster.members
+            collection.clusterCenter = cluster.center
+            collection.clusterOffset = cluster.center - center
+            collection.clusterSpread = cluster.spread
+            collection.outlierLines = np.flatnonzero(Geometry.pointLineDistances(cluster.center, lines) > cluster.radius)
+        collections.append(collection)
+
+    if numSamples and circlePoints is not None and len(circlePoints) > 2:
+        uncertainties = Uncertainty.sphericalUncertainty(center, circlePoints, lineSets, numSamples, circleNoise=circleNoise)
+        for collection, uncertainty in zip(collections, uncertainties):
+            collection.uncertainty = uncertainty
+    return SphericalResult(center, radius, collections)
+
+@instrument('analyze')
+def planarResult(lineSets, tolerance=2.0):
+    return PlanarResult(Geometry.planarConsistency(lineSets, tolerance))
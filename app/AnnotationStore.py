@@ -0,0 +1,135 @@
+'''
+Persistent storage for image annotations.
+
+A corpus of annotations is kept in one NumPy archive with a column per field,
+so loading tens of thousands of annotated images is a handful of array reads:
+
+    imageIds           (N,)    image id, normally the path relative to the archive
+    modes              (N,)    MODE_CODES value for the analysis mode
+    collectionOffsets  (N+1,)  image i owns collections [offsets[i], offsets[i+1])
+    colors             (C,)    RGBA color of each line collection
+    lineOffsets        (C+1,)  collection j owns lines [offsets[j], offsets[j+1])
+    lines              (L, 4)  x1, y1, x2, y2
+    circleOffsets      (N+1,)  image i owns circle points [offsets[i], offsets[i+1])
+    circlePoints       (P, 2)  x, y
+
+Annotations are handed out as dicts with the same keys as the JSON annotation
+files read by BatchAnalysis: mode, lineCollections, colors and circlePoints.
+'''
+
+import os
+
+import numpy as np
+
+DEFAULT_FILENAME = 'annotations.npz'
+MODE_CODES = {'planar': 1, 'spherical': 2}
+MODE_NAMES = dict((code, name) for name, code in MODE_CODES.items())
+
+COLUMNS = ('imageIds', 'modes', 'collectionOffsets', 'colors', 'lineOffsets', 'lines', 'circleOffsets', 'circlePoints')
+
+
+class AnnotationStore(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self._columns = None
+        self._index = {}
+        self._changed = {}
+
+        if path is not None and os.path.isfile(path):
+            self._read(path)
+
+    # Open the store that lives next to an image, creating an empty one if needed
+    @classmethod
+    def forImage(cls, imagePath):
+        return cls(os.path.join(os.path.dirname(os.path.abspath(imagePath)), DEFAULT_FILENAME))
+
+    def imageIdFor(self, imagePath):
+        relative = os.path.relpath(os.path.abspath(imagePath), os.path.dirname(os.path.abspath(self.path)))
+        return relative.replace(os.sep, '/')
+
+    def _read(self, path):
+        with np.load(path) as archive:
+            self._columns = dict((name, archive[name]) for name in COLUMNS)
+        self._index = dict((imageId, i) for i, imageId in enumerate(self._columns['imageIds']))
+
+    def imageIds(self):
+        ids = set(self._index)
+        ids.update(self._changed)
+        return sorted(imageId for imageId in ids if self._lookup(imageId) is not None)
+
+    def __contains__(self, imageId):
+        return self._lookup(imageId) is not None
+
+    def __len__(self):
+        return len(self.imageIds())
+
+    def _lookup(self, imageId):
+        if imageId in self._changed:
+            return self._changed[imageId]
+        if imageId in self._index:
+            return self._slice(self._index[imageId])
+        return None
+
+    def _slice(self, i):
+        columns = self._columns
+        c0, c1 = columns['collectionOffsets'][i:i+2]
+        p0, p1 = columns['circleOffsets'][i:i+2]
+        lineOffsets = columns['lineOffsets']
+
+        return {
+            'mode': MODE_NAMES[int(columns['modes'][i])],
+            'lineCollections': [columns['lines'][lineOffsets[j]:lineOffsets[j+1]] for j in xrange(c0, c1)],
+            'colors': [int(color) for color in columns['colors'][c0:c1]],
+            'circlePoints': columns['circlePoints'][p0:p1],
+        }
+
+    def get(self, imageId, default=None):
+        annotation = self._lookup(imageId)
+        return default if annotation is None else annotation
+
+    def put(self, imageId, annotation):
+        self._changed[imageId] = annotation
+
+    def remove(self, imageId):
+        self._changed[imageId] = None
+
+    def items(self):
+        for imageId in self.imageIds():
+            yield imageId, self._lookup(imageId)
+
+    def save(self, path=None):
+        path = path or self.path
+        imageIds = self.imageIds()
+        annotations = [self._lookup(imageId) for imageId in imageIds]
+
+        collections = [np.asarray(lines, dtype=float).reshape(-1, 4) for a in annotations for lines in a['lineCollections']]
+        circlePoints = [np.asarray(a['circlePoints'], dtype=float).reshape(-1, 2) for a in annotations]
+
+        columns = {
+            'imageIds': np.array(imageIds, dtype=np.unicode_),
+            'modes': np.array([MODE_CODES[a['mode']] for a in annotations], dtype=np.int8),
+            'collectionOffsets': _offsets([len(a['lineCollections']) for a in annotations]),
+            'colors': np.array([color for a in annotations for color in a['colors']], dtype=np.uint32),
+            'lineOffsets': _offsets([len(lines) for lines in collections]),
+            'lines': np.vstack([np.empty((0, 4))] + collections),
+            'circleOffsets': _offsets([len(points) for points in circlePoints]),
+            'circlePoints': np.vstack([np.empty((0, 2))] + circlePoints),
+        }
+
+        # Write to a temporary file first so a failed save never clobbers the corpus
+        tempPath = path + '.tmp.npz'
+        np.savez(tempPath, **columns)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tempPath, path)
+
+        self.path = path
+        self._columns = columns
+        self._index = dict((imageId, i) for i, imageId in enumerate(imageIds))
+        self._changed = {}
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
@@ -0,0 +1,112 @@
+'''
+Background jobs for the GUI.
+
+Slow work (edge refinement, sphere detection, analysis) runs on a QThreadPool so
+the window stays responsive; NumPy and OpenCV release the GIL for the heavy
+parts. Every job belongs to a channel, such as 'circle' or 'analyze'. Submitting
+a job cancels the channel's previous one, and a cancelled job is either skipped
+before it starts or has its result dropped, so only the latest job's callback
+ever runs. Callbacks run on the GUI thread.
+
+Jobs must not touch Qt widgets or the analysis objects: take a snapshot of what
+they need on the GUI thread and apply the result in the callback.
+'''
+
+import traceback
+
+from PySide import QtCore
+
+
+class _Job(QtCore.QRunnable):
+
+    def __init__(self, jobs, channel, generation, function, onResult, onError=None):
+        super(_Job, self).__init__()
+        self.setAutoDelete(False)
+        self.jobs = jobs
+        self.channel = channel
+        self.generation = generation
+        self.function = function
+        self.onResult = onResult
+        self.onError = onError
+
+    def run(self):
+        if self.jobs.isStale(self):
+            self.jobs.signals.skipped.emit(self)
+            return
+        try:
+            result = self.function()
+        except Exception:
+            self.jobs.signals.failed.emit(self, traceback.format_exc())
+            return
+        self.jobs.signals.finished.emit(self, result)
+
+
+class _Signals(QtCore.QObject):
+    finished = QtCore.Signal(object, object)
+    failed = QtCore.Signal(object, object)
+    skipped = QtCore.Signal(object)
+
+
+class BackgroundJobs(QtCore.QObject):
+    # emitted with True when the first job starts and False when the last one is done
+    busyChanged = QtCore.Signal(bool)
+
+    def __init__(self, parent=None, maxThreads=None):
+        super(BackgroundJobs, self).__init__(parent)
+        self.pool = QtCore.QThreadPool(self)
+        if maxThreads:
+            self.pool.setMaxThreadCount(maxThreads)
+        self._generations = {}
+        # jobs are kept alive here until their signal has been handled
+        self._pending = set()
+
+        self.signals = _Signals()
+        self.signals.finished.connect(self._finished, QtCore.Qt.QueuedConnection)
+        self.signals.failed.connect(self._failed, QtCore.Qt.QueuedConnection)
+        self.signals.skipped.connect(self._done, QtCore.Qt.QueuedConnection)
+
+    # Run function() on the pool and call onResult(result) on the GUI thread when it
+    # is done, unless another job has been submitted to the channel in the meantime.
+    # If function raises, the traceback is printed and onError(traceback) is called.
+    def submit(self, channel, function, onResult, onError=None):
+        self.cancel(channel)
+        job = _Job(self, channel, self._generations[channel], function, onResult, onError)
+        self._pending.add(job)
+        if len(self._pending) == 1:
+            self.busyChanged.emit(True)
+        self.pool.start(job)
+        return job
+
+    def cancel(self, channel):
+        self._generations[channel] = self._generations.get(channel, 0) + 1
+
+    def cancelAll(self):
+        for channel in self._generations.keys():
+            self.cancel(channel)
+
+    def isStale(self, job):
+        return self._generations.get(job.channel) != job.generation
+
+    def isBusy(self, channel=None):
+        return any(channel is None or job.channel == channel for job in self._pending if not self.isStale(job))
+
+    # Block until every running job is done, e.g. before the application exits
+    def waitForDone(self):
+        self.pool.waitForDone()
+
+    def _finished(self, job, result):
+        if not self.isStale(job):
+            job.onResult(result)
+        self._done(job)
+
+    def _failed(self, job, message):
+        if not self.isStale(job):
+            print "Background job '%s' failed:\n%s" % (job.channel, message)
+            if job.onError is not None:
+                job.onError(message)
+        self._done(job)
+
+    def _done(self, job):
+        self._pending.discard(job)
+        if not self._pending:
+            self.busyChanged.emit(False)
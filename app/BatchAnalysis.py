@@ -0,0 +1,248 @@
+'''
+Headless batch analysis of annotated images.
+
+Annotations for the images in the input directory are read from the directory's
+annotation archive (see AnnotationStore) when there is one. Otherwise each image
+is paired with an annotation file of the same name plus ".json", for example
+"1b.png" and "1b.png.json":
+
+    {
+        "mode": "spherical",
+        "circlePoints": [[x, y], ...],
+        "lineCollections": [[[x1, y1, x2, y2], ...], ...]
+    }
+
+Images are analyzed in parallel and one result file is written per image.
+Nothing here imports Qt, so worker processes stay light.
+
+With --store, results, timings and input fingerprints also go to a SQLite
+ResultsStore, and images whose image file, annotation, settings and algorithm
+version are unchanged since their stored result are skipped.
+
+With --ellipse, an ellipse is fitted to the whole sphere outline and lines are
+measured against the projected sphere center (see EllipseFitting). The camera
+comes from the annotation's "focalLength" and "principalPoint" when it has them,
+as rendered datasets do, and otherwise from the field of view given to --ellipse.
+
+Usage: python BatchAnalysis.py IMAGE_DIR [-o OUTPUT_DIR] [-j PROCESSES] [-r SEARCH_RADIUS] [-n SAMPLES] [--detect] [--ellipse [FOV]] [--timings FILE] [--store FILE]
+'''
+
+import argparse
+import json
+import os
+import multiprocessing
+
+import numpy as np
+
+import Geometry
+import CircleFitting
+import EllipseFitting
+import SphereReflection
+import SphereDetection
+import AnalysisResults
+from AnnotationStore import AnnotationStore, DEFAULT_FILENAME
+from ImagePyramid import IMAGE_EXTENSIONS
+from Instrumentation import instruments, timed, record
+
+ANNOTATION_SUFFIX = '.json'
+RESULT_SUFFIX = '.result.json'
+
+
+def loadLuminance(imagePath):
+    import cv2
+    with timed('open'):
+        image = cv2.imread(imagePath)
+    if image is None:
+        raise IOError("Could not read image %s" % imagePath)
+    return Geometry.luminance(image)
+
+# Same steps as SphericalAnalysis.addCircle: fit, refine the points on the image edges, refit robustly.
+# With a camera the outline ellipse is fitted too and 'center' is the projected sphere center.
+def fitSphere(circlePoints, gray, searchRadius=5, camera=None):
+    h, k = CircleFitting.fitCircles(circlePoints, robust=False).centers[0]
+    refinedPoints = Geometry.refineEdgePoints(gray, circlePoints, (h, k), searchRadius)
+    fit = CircleFitting.fitCircles(refinedPoints).summary()
+    newH, newK = fit['center']
+    record('centerShift', np.hypot(h - newH, k - newK))
+
+    circle = {
+        'center': fit['center'],
+        'radius': fit['radius'],
+        'centerShift': [h - newH, k - newK],
+        'circlePoints': refinedPoints.tolist(),
+        'circleFit': fit,
+    }
+    if camera is not None:
+        ellipse = EllipseFitting.fitSphereOutline(gray, fit['center'], fit['radius'], camera, searchRadius=searchRadius)
+        circle['ellipse'] = ellipse
+        if ellipse is not None:
+            circle['center'] = ellipse['projectedCenter']
+    return circle
+
+# Camera of an image for the ellipse mode: the annotation's when it gives one,
+# otherwise one with the given horizontal field of view
+def imageCamera(annotation, gray, fieldOfView):
+    if 'focalLength' in annotation and 'principalPoint' in annotation:
+        return SphereReflection.Camera(annotation['focalLength'], annotation['principalPoint'])
+    height, width = gray.shape
+    return SphereReflection.Camera.fromFieldOfView(width, height, fieldOfView)
+
+def analyzeSpherical(annotation, gray, searchRadius=5, detect=False, numSamples=0, fieldOfView=None):
+    result = {'mode': 'spherical', 'lineCollections': []}
+    circlePoints = annotation.get('circlePoints', [])
+    if len(circlePoints) < 3 and detect:
+        detected = SphereDetection.detectSpheres(gray, searchRadius=searchRadius)
+        if detected:
+            circlePoints = detected[0].points
+            result['detected'] = True
+    if len(circlePoints) < 3:
+        result['error'] = "At least 3 circle points are needed"
+        return result
+
+    camera = None if fieldOfView is None else imageCamera(annotation, gray, fieldOfView)
+    circle = fitSphere(circlePoints, gray, searchRadius, camera)
+    result.update(AnalysisResults.sphericalResult(circle['center'], circle['radius'], annotation.get('lineCollections', []),
+                                                  circlePoints=circle['circlePoints'], numSamples=numSamples,
+                                                  circleNoise=circle['ellipse']['rmsError'] if circle.get('ellipse') else None).toDict())
+    result.update(circle)
+    return result
+
+def analyzePlanar(annotation):
+    return AnalysisResults.planarResult(annotation.get('lineCollections', [])).toDict()
+
+# fieldOfView turns on the ellipse mode for spherical images; None leaves it off
+def analyzeImage(imagePath, annotation, searchRadius=5, detect=False, numSamples=0, fieldOfView=None):
+    if annotation.get('mode', 'spherical') == 'planar':
+        result = analyzePlanar(annotation)
+    else:
+        result = analyzeSpherical(annotation, loadLuminance(imagePath), searchRadius, detect, numSamples, fieldOfView)
+    result['image'] = imagePath
+    return result
+
+def loadAnnotation(annotationPath):
+    with open(annotationPath) as f:
+        return json.load(f)
+
+# Jobs are (imagePath, annotation) pairs, where annotation is either an annotation
+# dict from the archive or the path of a JSON annotation file to read in the worker.
+# With includeUnannotated, images without annotations get an empty spherical one.
+def findJobs(imageDir, includeUnannotated=False):
+    storePath = os.path.join(imageDir, DEFAULT_FILENAME)
+    if os.path.isfile(storePath):
+        store = AnnotationStore(storePath)
+        return [(os.path.join(imageDir, *imageId.split('/')), annotation) for imageId, annotation in store.items()]
+
+    jobs = []
+    for name in sorted(os.listdir(imageDir)):
+        if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+            continue
+        imagePath = os.path.join(imageDir, name)
+        annotationPath = imagePath + ANNOTATION_SUFFIX
+        if os.path.isfile(annotationPath):
+            jobs.append((imagePath, annotationPath))
+        elif includeUnannotated:
+            jobs.append((imagePath, {'mode': 'spherical'}))
+    return jobs
+
+# Pool worker: errors are reported in the result instead of killing the whole run.
+# The image's stage timings and diagnostics come back under 'timings'.
+def _runJob(job):
+    imagePath, annotation, searchRadius, detect, numSamples, fieldOfView = job
+    instruments.reset()
+    try:
+        if isinstance(annotation, basestring):
+            annotation = loadAnnotation(annotation)
+        result = analyzeImage(imagePath, annotation, searchRadius, detect, numSamples, fieldOfView)
+    except Exception as e:
+        result = {'image': imagePath, 'error': "%s: %s" % (type(e).__name__, e)}
+    result['timings'] = instruments.toDict()
+    return result
+
+def writeResult(result, outputDir):
+    outputPath = os.path.join(outputDir, os.path.basename(result['image']) + RESULT_SUFFIX)
+    with open(outputPath, 'w') as f:
+        json.dump(result, f, indent=2, default=AnalysisResults.jsonDefault)
+    return outputPath
+
+# Drop the jobs whose stored results are current. Annotations are read here to be
+# fingerprinted and handed to the workers as dicts. Returns the remaining jobs and
+# their fingerprints by image path.
+def staleJobs(jobs, store, settings):
+    remaining = []
+    fingerprints = {}
+    for imagePath, annotation in jobs:
+        if isinstance(annotation, basestring):
+            annotation = loadAnnotation(annotation)
+        fingerprint = store.fingerprint(imagePath, annotation, settings)
+        if store.isStale(imagePath, fingerprint):
+            remaining.append((imagePath, annotation))
+            fingerprints[imagePath] = fingerprint
+    return remaining, fingerprints
+
+# With timingsPath, each result file keeps its image's timings and the totals over
+# the whole run are written to timingsPath as JSON. With storePath, results go to
+# that ResultsStore too and unchanged images are skipped.
+def runBatch(imageDir, outputDir, processes=None, chunksize=4, searchRadius=5, detect=False, timingsPath=None, numSamples=0, storePath=None,
+             fieldOfView=None):
+    jobs = findJobs(imageDir, detect)
+    store = None
+    if storePath:
+        from ResultsStore import ResultsStore
+        store = ResultsStore(storePath)
+        settings = {'searchRadius': searchRadius, 'detect': detect, 'numSamples': numSamples}
+        if fieldOfView is not None:
+            settings['fieldOfView'] = fieldOfView
+        total = len(jobs)
+        jobs, fingerprints = staleJobs(jobs, store, settings)
+        print "Skipping %d unchanged images" % (total - len(jobs))
+    jobs = [job + (searchRadius, detect, numSamples, fieldOfView) for job in jobs]
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+
+    failures = 0
+    instruments.reset()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_runJob, jobs, chunksize):
+            if store is not None:
+                store.add(result, fingerprints[result['image']])
+            timings = result.pop('timings')
+            instruments.merge(timings)
+            if timingsPath:
+                result['timings'] = timings
+            writeResult(result, outputDir)
+            if 'error' in result:
+                failures += 1
+                print "%s: %s" % (result['image'], result['error'])
+    finally:
+        pool.close()
+        pool.join()
+        if store is not None:
+            store.close()
+
+    print "Analyzed %d images, %d failed" % (len(jobs), failures)
+    if timingsPath:
+        with open(timingsPath, 'w') as f:
+            json.dump(instruments.toDict(), f, indent=2)
+        print instruments.report()
+    return len(jobs), failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze a directory of annotated images without the GUI.")
+    parser.add_argument('imageDir', help="directory containing images and their annotations")
+    parser.add_argument('-o', '--output', dest='outputDir', help="directory for result files (default: IMAGE_DIR)")
+    parser.add_argument('-j', '--processes', type=int, default=None, help="number of worker processes (default: number of cores)")
+    parser.add_argument('-r', '--search-radius', dest='searchRadius', type=float, default=5, help="pixels searched along each radial when refining circle points (default: 5)")
+    parser.add_argument('-n', '--samples', dest='numSamples', type=int, default=0, help="Monte Carlo samples for confidence intervals and p-values of spherical results (default: 0, none)")
+    parser.add_argument('-d', '--detect', action='store_true', help="detect the sphere automatically when an image has no circle points, including images without annotations")
+    parser.add_argument('-e', '--ellipse', dest='fieldOfView', nargs='?', type=float, const=60.0, metavar='FOV',
+                        help="fit an ellipse to the whole sphere outline and use the projected sphere center; FOV is the horizontal field of view in degrees for images whose annotation gives no camera (default: 60)")
+    parser.add_argument('-t', '--timings', dest='timingsPath', help="write stage timings and diagnostics for the whole run to this JSON file and keep each image's in its result file")
+    parser.add_argument('-s', '--store', dest='storePath', help="also write results to this SQLite results store and skip images unchanged since their stored result")
+    args = parser.parse_args()
+
+    runBatch(args.imageDir, args.outputDir or args.imageDir, args.processes, searchRadius=args.searchRadius, detect=args.detect,
+             timingsPath=args.timingsPath, numSamples=args.numSamples, storePath=args.storePath, fieldOfView=args.fieldOfView)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+'''
+Benchmarks for the analysis hot paths on synthetic scenes.
+
+Every case runs in a fresh worker process so its peak memory can be measured
+on its own. Stages:
+
+    intersections  all pairwise intersections of a collection (LineCollection._findIntersections)
+    addLine        intersecting one new line with the existing ones (LineCollection.addLine)
+    clusters       agglomerative clustering of intersection sets (Geometry.findClusters)
+    densityCluster dominant mode of one collection's intersection cloud (Geometry.densityCluster)
+    circleFit      batched robust circle fitting (SphericalAnalysis.solveCircle)
+    refine         radial edge refinement of a dense contour (SphericalAnalysis.addCircle)
+    contour        dense outline sampling and robust ellipse fit of the whole sphere (EllipseFitting.fitContour)
+    analyze        spherical analysis of every collection (SphericalAnalysis.analyze)
+    reflect        forward model of reflections in the sphere (SphereReflection.reflectionPoints)
+    calibration    null p-values of consistent collections on an off-axis sphere measured from its
+                   projected center (Uncertainty.sphericalUncertainty); they should be about uniform
+    startup        cold start of a fresh interpreter importing a module, with its peak memory,
+                   i.e. what every worker process pays before doing any work
+
+Accuracy against the scene's ground truth is reported where it applies.
+
+Usage: python Benchmark.py [--quick] [--stages STAGE,...] [--max-lines N] [--max-megapixels M] [--json FILE]
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import timeit
+
+import numpy as np
+
+import Geometry
+import CircleFitting
+import EllipseFitting
+import AnalysisResults
+import SphereReflection
+import Uncertainty
+from SyntheticScene import generateScene
+
+LINE_COUNTS = (10, 100, 1000, 10000)
+MEGAPIXELS = (1, 10, 100)
+CONTOUR_POINTS = 1000
+STAGES = ('intersections', 'addLine', 'clusters', 'densityCluster', 'circleFit', 'refine', 'contour', 'analyze', 'reflect', 'calibration', 'startup')
+CALIBRATION_TRIALS = (200,)
+# modules whose import a worker process or script pays for
+STARTUP_MODULES = ('ReflectionAnalysis', 'BatchAnalysis')
+
+
+def _peakMegabytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _timed(function, *args):
+    start = timeit.default_timer()
+    result = function(*args)
+    return result, timeit.default_timer() - start
+
+def benchIntersections(numLines):
+    lines = generateScene(numCollections=1, numForged=0, linesPerCollection=numLines).lineSets[0]
+    (points, pairs), seconds = _timed(Geometry.pairwiseIntersections, lines)
+    return seconds, len(points), 'intersections', {}
+
+def benchAddLine(numLines):
+    lines = generateScene(numCollections=1, numForged=0, linesPerCollection=numLines).lineSets[0]
+    _, seconds = _timed(Geometry.intersectLineWithLines, lines[-1], lines[:-1])
+    return seconds, 1, 'lines', {}
+
+def benchClusters(numLines):
+    # ten lines per object, so the number of objects grows with the line count
+    numCollections = max(2, numLines // 10)
+    scene = generateScene(numCollections=numCollections, numForged=numCollections // 4, linesPerCollection=10)
+    pointSets = [Geometry.pairwiseIntersections(lines)[0] for lines in scene.lineSets]
+    _, seconds = _timed(Geometry.findClusters, pointSets)
+    return seconds, numCollections, 'collections', {}
+
+# Up to two million intersections of one genuine collection; the mode should sit on the center
+def benchDensityCluster(numLines):
+    scene = generateScene(numCollections=1, numForged=0, linesPerCollection=min(numLines, 2000))
+    points = Geometry.pairwiseIntersections(scene.lineSets[0])[0]
+    cluster, seconds = _timed(Geometry.densityCluster, points)
+    finite = points[np.isfinite(points).all(axis=1)]
+    return seconds, len(points), 'points', {
+        'modeError': float(np.hypot(*(cluster.center - scene.center))),
+        'stdDevClusterError': float(np.hypot(*(Geometry.stdDevCluster(finite)[1] - scene.center))),
+        'spread': float(cluster.spread),
+    }
+
+def benchCircleFit(numCircles):
+    scenes = [generateScene(seed=seed, numCollections=1, linesPerCollection=2) for seed in xrange(numCircles)]
+    points = np.array([scene.circlePoints for scene in scenes])
+    fits, seconds = _timed(CircleFitting.fitCircles, points)
+    errors = np.hypot(*(fits.centers - [scene.center for scene in scenes]).T)
+    return seconds, numCircles, 'circles', {'medianCenterError': float(np.median(errors))}
+
+def benchRefine(megapixels):
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(width * 3 / 4.0))
+    scene = generateScene(width, height, numCollections=1, linesPerCollection=2, numCirclePoints=CONTOUR_POINTS)
+    gray = scene.render()
+
+    rough = CircleFitting.fitCircles(scene.circlePoints, robust=False)
+    refined, seconds = _timed(Geometry.refineEdgePoints, gray, scene.circlePoints, rough.centers[0])
+    fit = CircleFitting.fitCircles(refined)
+    return seconds, CONTOUR_POINTS, 'points', {
+        'imageSize': [width, height],
+        'centerErrorBefore': float(np.hypot(*(rough.centers[0] - scene.center))),
+        'centerErrorAfter': float(np.hypot(*(fit.centers[0] - scene.center))),
+        'radiusErrorAfter': float(abs(fit.radii[0] - scene.radius)),
+    }
+
+# What the ellipse mode adds to every circle; the synthetic outline is a true circle
+def benchContour(megapixels):
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(width * 3 / 4.0))
+    scene = generateScene(width, height, numCollections=1, linesPerCollection=2)
+    gray = scene.render()
+
+    rough = CircleFitting.fitCircles(scene.circlePoints, robust=False)
+    (points, fits), seconds = _timed(EllipseFitting.fitContour, gray, rough.centers[0], rough.radii[0])
+    return seconds, len(points), 'points', {
+        'imageSize': [width, height],
+        'centerError': float(np.hypot(*(fits.centers[0] - scene.center))),
+        'axesError': float(np.abs(fits.axes[0] - scene.radius).max()),
+        'inliers': int(fits.inliers.sum()),
+    }
+
+def benchAnalyze(numLines):
+    scene = generateScene(numCollections=4, numForged=1, linesPerCollection=max(2, numLines // 4))
+    intersectionSets = [Geometry.pairwiseIntersections(lines)[0] for lines in scene.lineSets]
+    result, seconds = _timed(AnalysisResults.sphericalResult, scene.center, scene.radius, scene.lineSets, intersectionSets)
+
+    meanDistances = np.array([c.distances.mean() for c in result.collections])
+    return seconds, sum(len(lines) for lines in scene.lineSets), 'lines', {
+        'genuineMeanDistance': float(meanDistances[~scene.forged].mean()),
+        'forgedMeanDistance': float(meanDistances[scene.forged].mean()),
+    }
+
+# Scene points around the synthetic sphere, treated as having a radius of one unit
+def benchReflect(numPoints):
+    scene = generateScene()
+    camera = SphereReflection.Camera.fromFieldOfView(scene.width, scene.height)
+    center = SphereReflection.sphereFromCircle(camera, scene.center, scene.radius)
+    points = center + np.random.RandomState(0).uniform(-10, 10, (numPoints, 3))
+    (_, valid), seconds = _timed(SphereReflection.reflectionPoints, center, 1.0, points)
+    return seconds, numPoints, 'points', {'visible': int(valid.sum())}
+
+# Consistent collections on a sphere far off the optical axis, analyzed against its
+# projected center from a silhouette fit of the noisy outline
+def benchCalibration(numTrials):
+    camera = SphereReflection.Camera.fromFieldOfView(1920, 1080, 70.0)
+    sphereCenter = np.array([2.2, 1.0, 6.0])
+    truth = camera.project(sphereCenter)[0]
+    outline = SphereReflection.sphereOutline(camera, sphereCenter, 1.0, EllipseFitting.DENSE_POINTS)
+    randomState = np.random.RandomState(0)
+
+    pValues = np.empty(numTrials)
+    start = timeit.default_timer()
+    for i in xrange(numTrials):
+        points = outline + randomState.normal(0, 0.5, outline.shape)
+        fits = EllipseFitting.fitEllipses(points, camera=camera)
+        center = EllipseFitting.projectedSphereCenters(fits.centers, fits.axes, fits.angles, camera.principalPoint, camera.focalLength)[0]
+        circlePoints = points[::EllipseFitting.DENSE_POINTS // 9][:9]
+
+        angles = randomState.uniform(0, np.pi, 10)
+        direction = np.column_stack((np.cos(angles), np.sin(angles)))
+        near = truth + randomState.uniform(50, 150, (10, 1)) * direction
+        far = truth + randomState.uniform(200, 400, (10, 1)) * direction
+        lines = np.hstack((near, far)) + randomState.normal(0, Uncertainty.LINE_NOISE, (10, 4))
+        pValues[i] = Uncertainty.sphericalUncertainty(center, circlePoints, [lines], numSamples=500,
+                                                      circleNoise=fits.rmsError[0], seed=i)[0].pValue
+    seconds = timeit.default_timer() - start
+
+    pValues.sort()
+    uniform = (np.arange(numTrials) + 0.5) / numTrials
+    circleCenter = CircleFitting.fitCircles(outline, robust=False).centers[0]
+    return seconds, numTrials, 'trials', {
+        'perspectiveOffset': float(np.hypot(*(truth - circleCenter))),
+        'fractionBelow05': float((pValues < 0.05).mean()),
+        'fractionBelow50': float((pValues < 0.5).mean()),
+        'ksDistance': float(np.abs(pValues - uniform).max()),
+    }
+
+# The child reports its own peak: RUSAGE_CHILDREN is the largest of every child reaped so far.
+def benchStartup(module):
+    script = 'import resource\nimport %s\nprint resource.getrusage(resource.RUSAGE_SELF).ru_maxrss' % module
+    start = timeit.default_timer()
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)))
+    seconds = timeit.default_timer() - start
+    return seconds, 1, 'imports', {'processPeakMB': int(output.split()[-1]) / 1024.0}
+
+BENCHMARKS = {
+    'intersections': (benchIntersections, 'lines'),
+    'addLine': (benchAddLine, 'lines'),
+    'clusters': (benchClusters, 'lines'),
+    'densityCluster': (benchDensityCluster, 'lines'),
+    'circleFit': (benchCircleFit, 'circles'),
+    'refine': (benchRefine, 'megapixels'),
+    'contour': (benchContour, 'megapixels'),
+    'analyze': (benchAnalyze, 'lines'),
+    'reflect': (benchReflect, 'points'),
+    'calibration': (benchCalibration, 'trials'),
+    'startup': (benchStartup, 'module'),
+}
+
+def _sizes(stage, lineCounts, megapixels):
+    unit = BENCHMARKS[stage][1]
+    if unit == 'megapixels':
+        return megapixels
+    if unit == 'module':
+        return STARTUP_MODULES
+    if unit == 'trials':
+        return CALIBRATION_TRIALS
+    return lineCounts
+
+def _runCase(case):
+    stage, size = case
+    baseline = _peakMegabytes()
+    seconds, count, unit, extra = BENCHMARKS[stage][0](size)
+    result = {
+        'stage': stage,
+        'size': size,
+        'sizeUnit': BENCHMARKS[stage][1],
+        'seconds': seconds,
+        'throughput': count / seconds if seconds > 0 else float('inf'),
+        'throughputUnit': unit + '/s',
+        'peakMemoryMB': _peakMegabytes() - baseline,
+    }
+    result.update(extra)
+    return result
+
+def runBenchmarks(stages=STAGES, lineCounts=LINE_COUNTS, megapixels=MEGAPIXELS):
+    cases = [(stage, size) for stage in stages for size in _sizes(stage, lineCounts, megapixels)]
+    # one process per case so each peak memory reading starts from a clean slate
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for case in cases:
+            yield pool.apply(_runCase, (case,))
+    finally:
+        pool.close()
+        pool.join()
+
+def formatResult(result):
+    extras = ", ".join("%s=%s" % (key, result[key]) for key in sorted(result)
+                       if key not in ('stage', 'size', 'sizeUnit', 'seconds', 'throughput', 'throughputUnit', 'peakMemoryMB'))
+    return "%-14s %8s %-10s %10.4f s %14.1f %-16s %8.1f MB  %s" % (
+        result['stage'], result['size'], result['sizeUnit'], result['seconds'],
+        result['throughput'], result['throughputUnit'], result['peakMemoryMB'], extras)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis hot paths on synthetic scenes.")
+    parser.add_argument('--quick', action='store_true', help="only run the small sizes")
+    parser.add_argument('--stages', default=','.join(STAGES), help="comma separated stages to run (default: all)")
+    parser.add_argument('--max-lines', dest='maxLines', type=int, default=max(LINE_COUNTS))
+    parser.add_argument('--max-megapixels', dest='maxMegapixels', type=float, default=max(MEGAPIXELS))
+    parser.add_argument('--json', dest='jsonPath', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    maxLines = min(args.maxLines, 1000) if args.quick else args.maxLines
+    maxMegapixels = min(args.maxMegapixels, 10) if args.quick else args.maxMegapixels
+    lineCounts = [n for n in LINE_COUNTS if n <= maxLines]
+    megapixels = [m for m in MEGAPIXELS if m <= maxMegapixels]
+
+    results = []
+    for result in runBenchmarks(args.stages.split(','), lineCounts, megapixels):
+        print formatResult(result)
+        results.append(result)
+
+    if args.jsonPath:
+        with open(args.jsonPath, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+'''
+Robust geometric circle fitting over NumPy arrays.
+
+Fitting happens in two stages, both vectorized over every circle in the batch:
+
+1. Random three-point hypotheses are scored with the MSAC cost (squared
+   residuals, capped at the inlier threshold) and the points within the
+   threshold of the best hypothesis are kept as inliers.
+2. The inliers are refined by Gauss-Newton on the geometric distance
+   |p - c| - r, starting from an algebraic fit of the inliers. The inlier set is
+   then re-evaluated against the refined circle and refined once more.
+
+The threshold used to pick inliers is set per circle from its own noise:
+INLIER_SCALE robust standard deviations (1.4826 times the median absolute
+residual) of the residuals from the best hypothesis, and again from the
+refined circle, but never below the threshold given. Like any median, this
+assumes at most half the points are outliers.
+
+Points for a batch are given as a (B, N, 2) array with an optional (B, N) mask
+for circles that have fewer than N points.
+'''
+
+import numpy as np
+
+from Instrumentation import instrument, record
+
+NUM_HYPOTHESES = 128
+# lower bound in pixels for the distance from a circle within which a point is an inlier
+INLIER_THRESHOLD = 2.0
+# robust standard deviations of the residuals within which a point is an inlier
+INLIER_SCALE = 3.0
+
+
+class CircleFits(object):
+    '''
+    Results for a batch of B circles:
+
+    centers         (B, 2)     fitted centers
+    radii           (B,)       fitted radii
+    inliers         (B, N)     points used for the final fit
+    residuals       (B, N)     signed geometric residual |p - c| - r of every point
+    rmsError        (B,)       root mean square residual over the inliers
+    covariance      (B, 3, 3)  covariance of (cx, cy, r)
+    centerStdErr    (B, 2)     standard error of the center
+    radiusStdErr    (B,)       standard error of the radius
+    iterations      int        Gauss-Newton iterations run
+    '''
+
+    def __init__(self, centers, radii, inliers, residuals, rmsError, covariance, iterations):
+        self.centers = centers
+        self.radii = radii
+        self.inliers = inliers
+        self.residuals = residuals
+        self.rmsError = rmsError
+        self.covariance = covariance
+        self.iterations = iterations
+
+        variances = np.diagonal(covariance, axis1=1, axis2=2)
+        self.centerStdErr = np.sqrt(variances[:, :2])
+        self.radiusStdErr = np.sqrt(variances[:, 2])
+
+    def __len__(self):
+        return len(self.radii)
+
+    def __repr__(self):
+        return "CircleFits(%d circles, mean rmsError=%.3f)" % (len(self), np.mean(self.rmsError))
+
+    # Summary of one circle as plain Python values
+    def summary(self, i=0):
+        return {
+            'center': self.centers[i].tolist(),
+            'radius': float(self.radii[i]),
+            'rmsError': float(self.rmsError[i]),
+            'centerStdErr': self.centerStdErr[i].tolist(),
+            'radiusStdErr': float(self.radiusStdErr[i]),
+            'numInliers': int(self.inliers[i].sum()),
+            'outliers': np.flatnonzero(~self.inliers[i]).tolist(),
+        }
+
+# Circles through point triples a, b, c of shape (..., 2). Collinear triples give nan.
+def circumcircles(a, b, c):
+    ax, ay = a[..., 0], a[..., 1]
+    bx, by = b[..., 0], b[..., 1]
+    cx, cy = c[..., 0], c[..., 1]
+    d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    aa = ax**2 + ay**2
+    bb = bx**2 + by**2
+    cc = cx**2 + cy**2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ux = (aa * (by - cy) + bb * (cy - ay) + cc * (ay - by)) / d
+        uy = (aa * (cx - bx) + bb * (ax - cx) + cc * (bx - ax)) / d
+    r = np.hypot(ax - ux, ay - uy)
+    return np.stack((ux, uy), axis=-1), r
+
+# Weighted algebraic fit for a batch: x^2 + y^2 + ax + by + c = 0
+def algebraicCircles(points, weights):
+    x, y = points[..., 0], points[..., 1]
+    A = np.stack((x, y, np.ones_like(x)), axis=-1) * weights[..., None]
+    b = -(x**2 + y**2) * weights
+    AtA = np.einsum('bni,bnj->bij', A, A)
+    Atb = np.einsum('bni,bn->bi', A, b)
+    solution = np.linalg.solve(AtA + 1e-12 * np.eye(3), Atb[..., None])[..., 0]
+
+    centers = -solution[:, :2] / 2
+    radii = np.sqrt(np.maximum((centers**2).sum(axis=1) - solution[:, 2], 0))
+    return centers, radii
+
+# Per-circle inlier threshold from residuals (B, N): INLIER_SCALE robust standard
+# deviations, at least threshold
+def _inlierThresholds(residuals, mask, threshold):
+    absolute = np.sort(np.where(mask, np.abs(residuals), np.inf), axis=1)
+    middle = np.maximum(mask.sum(axis=1) - 1, 0) // 2
+    sigma = 1.4826 * absolute[np.arange(len(absolute)), middle]
+    sigma[~np.isfinite(sigma)] = 0
+    return np.maximum(INLIER_SCALE * sigma, threshold)
+
+def _robustInliers(points, mask, threshold, numHypotheses, randomState):
+    B, N = mask.shape
+    counts = mask.sum(axis=1)
+
+    # Pick three distinct valid points per hypothesis by sorting random keys
+    keys = randomState.rand(B, numHypotheses, N)
+    keys[~np.broadcast_to(mask[:, None, :], keys.shape)] = np.inf
+    triples = np.argsort(keys, axis=2)[:, :, :3]
+    batchIdx = np.arange(B)[:, None, None]
+    sample = points[batchIdx, triples]
+
+    centers, radii = circumcircles(sample[..., 0, :], sample[..., 1, :], sample[..., 2, :])
+    distances = np.sqrt(((points[:, None, :, :] - centers[:, :, None, :])**2).sum(axis=-1))
+    squared = (distances - radii[..., None])**2
+
+    cost = np.where(mask[:, None, :], np.minimum(squared, threshold**2), 0).sum(axis=2)
+    cost[~np.isfinite(cost)] = np.inf
+    best = np.argmin(cost, axis=1)
+    bestSquared = squared[np.arange(B), best]
+    thresholds = _inlierThresholds(np.sqrt(bestSquared), mask, threshold)
+    inliers = mask & (bestSquared <= thresholds[:, None]**2)
+
+    # Fall back to all points when there is nothing to vote on or the vote failed
+    fallback = (counts <= 3) | (inliers.sum(axis=1) < 3)
+    inliers[fallback] = mask[fallback]
+    return inliers
+
+def _gaussNewton(points, inliers, centers, radii, iterations):
+    weights = inliers.astype(float)
+    params = np.column_stack((centers, radii))
+    B = len(params)
+    for i in xrange(iterations):
+        delta = points - params[:, None, :2]
+        distances = np.sqrt((delta**2).sum(axis=-1))
+        safe = np.maximum(distances, 1e-12)
+        residuals = distances - params[:, None, 2]
+
+        J = np.empty(points.shape[:2] + (3,))
+        J[..., 0] = -delta[..., 0] / safe
+        J[..., 1] = -delta[..., 1] / safe
+        J[..., 2] = -1
+        Jw = J * weights[..., None]
+        JtJ = np.einsum('bni,bnj->bij', Jw, J)
+        Jtr = np.einsum('bni,bn->bi', Jw, residuals)
+        step = np.linalg.solve(JtJ + 1e-9 * np.eye(3), -Jtr[..., None])[..., 0]
+        params += step
+        if np.all(np.abs(step) < 1e-9):
+            break
+
+    delta = points - params[:, None, :2]
+    residuals = np.sqrt((delta**2).sum(axis=-1)) - params[:, None, 2]
+    counts = weights.sum(axis=1)
+    sumSquares = (residuals**2 * weights).sum(axis=1)
+    rmsError = np.sqrt(sumSquares / np.maximum(counts, 1))
+
+    # Covariance sigma^2 (J^T J)^-1 with sigma^2 from the inlier residuals
+    distances = np.maximum(np.sqrt((delta**2).sum(axis=-1)), 1e-12)
+    J = np.stack((-delta[..., 0] / distances, -delta[..., 1] / distances, -np.ones((B, points.shape[1]))), axis=-1)
+    Jw = J * weights[..., None]
+    JtJ = np.einsum('bni,bnj->bij', Jw, J)
+    sigma2 = sumSquares / np.maximum(counts - 3, 1)
+    covariance = np.linalg.pinv(JtJ) * sigma2[:, None, None]
+    return params, residuals, rmsError, covariance, i + 1
+
+# Fit a batch of circles. points is (B, N, 2) or (N, 2) for a single circle.
+@instrument('fit')
+def fitCircles(points, mask=None, robust=True, threshold=INLIER_THRESHOLD, iterations=20, numHypotheses=NUM_HYPOTHESES, seed=0):
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 2:
+        points = points[None]
+        mask = None if mask is None else np.asarray(mask)[None]
+    if mask is None:
+        mask = np.ones(points.shape[:2], dtype=bool)
+    mask = np.asarray(mask, dtype=bool)
+    # masked out points are never used, so give them harmless coordinates
+    points = np.where(mask[..., None], points, 0)
+
+    if robust:
+        inliers = _robustInliers(points, mask, threshold, numHypotheses, np.random.RandomState(seed))
+    else:
+        inliers = mask.copy()
+
+    centers, radii = algebraicCircles(points, inliers.astype(float))
+    params, residuals, rmsError, covariance, iterationsRun = _gaussNewton(points, inliers, centers, radii, iterations)
+
+    if robust:
+        # Re-evaluate the inliers against the refined circle and refine again if they changed
+        thresholds = _inlierThresholds(residuals, mask, threshold)
+        refit = mask & (np.abs(residuals) <= thresholds[:, None])
+        tooFew = refit.sum(axis=1) < 3
+        refit[tooFew] = inliers[tooFew]
+        if (refit != inliers).any():
+            inliers = refit
+            params, residuals, rmsError, covariance, iterationsRun = _gaussNewton(points, inliers, params[:, :2], params[:, 2], iterations)
+    record('fitRmsError', np.mean(rmsError))
+    record('fitOutliers', (mask & ~inliers).sum())
+    return CircleFits(params[:, :2], params[:, 2], inliers, residuals, rmsError, covariance, iterationsRun)
@@ -0,0 +1,136 @@
+'''
+Automatic object/reflection correspondences.
+
+ORB keypoints are detected in an object region and in its reflection region and
+matched by descriptor, keeping matches that pass Lowe's ratio test. A mirror
+image is flipped, and ORB descriptors are rotation invariant but not flip
+invariant, so the reflection is matched both as it is and flipped left to
+right and the orientation with more surviving matches wins.
+
+Matches are then filtered geometrically: the lines joining an object to its
+reflection all pass through (or near) one point, the vanishing point for a
+planar mirror and the sphere center for a spherical one. The common point is
+found with MSAC over pairs of lines, scored by the rms distance of each line's
+endpoints from the best line through the point, which works for points at
+infinity too. Each call handles one object, so the filter never compares
+objects with each other and leaves the consistency test to the analysis.
+
+Returns (n, 4) endpoint arrays ready for LineCollection.addLines.
+'''
+
+import numpy as np
+
+import Geometry
+from Instrumentation import instrument, record
+
+MAX_FEATURES = 2000
+RATIO = 0.75
+# rms endpoint distance in pixels within which a line passes through the common point
+INLIER_THRESHOLD = 3.0
+NUM_HYPOTHESES = 256
+
+
+def _createOrb(cv2, maxFeatures):
+    if hasattr(cv2, 'ORB_create'):
+        return cv2.ORB_create(nfeatures=maxFeatures)
+    return cv2.ORB(nfeatures=maxFeatures)
+
+def _gray8(gray):
+    return np.clip(gray, 0, 255).astype(np.uint8)
+
+# Keypoint coordinates (n, 2) and ORB descriptors of a luminance array
+def detectKeypoints(gray, maxFeatures=MAX_FEATURES):
+    import cv2
+    keypoints, descriptors = _createOrb(cv2, maxFeatures).detectAndCompute(_gray8(gray), None)
+    if descriptors is None:
+        return np.empty((0, 2)), None
+    return np.array([keypoint.pt for keypoint in keypoints], dtype=float).reshape(-1, 2), descriptors
+
+# Indices (i, j) of descriptors in first whose best match in second passes the ratio test
+def matchDescriptors(first, second, ratio=RATIO):
+    import cv2
+    if first is None or second is None or len(second) < 2:
+        return np.empty((0, 2), dtype=int)
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    pairs = [(m[0].queryIdx, m[0].trainIdx) for m in matcher.knnMatch(first, second, k=2)
+             if len(m) == 2 and m[0].distance < ratio * m[1].distance]
+    return np.array(pairs, dtype=int).reshape(-1, 2)
+
+# Match an object region to a reflection region. Each region is a luminance array
+# and the image coordinates of its top left corner. Returns the matched lines,
+# object point first, in image coordinates.
+def matchRegions(objectGray, objectOffset, reflectionGray, reflectionOffset, maxFeatures=MAX_FEATURES, ratio=RATIO):
+    objectPoints, objectDescriptors = detectKeypoints(objectGray, maxFeatures)
+    best = np.empty((0, 4))
+    for flipped in (False, True):
+        gray = reflectionGray[:, ::-1] if flipped else reflectionGray
+        reflectionPoints, reflectionDescriptors = detectKeypoints(np.ascontiguousarray(gray), maxFeatures)
+        if flipped:
+            reflectionPoints[:, 0] = reflectionGray.shape[1] - 1 - reflectionPoints[:, 0]
+        pairs = matchDescriptors(objectDescriptors, reflectionDescriptors, ratio)
+        if len(pairs) > len(best):
+            best = np.hstack((objectPoints[pairs[:, 0]] + objectOffset, reflectionPoints[pairs[:, 1]] + reflectionOffset))
+    return best
+
+# Rms distance of each line's endpoints from the best fitting line through each
+# homogeneous point. points is (H, 3) with unit rows, the result is (H, n).
+def commonPointResiduals(points, lines, eps=1e-9):
+    lines = Geometry.asLineArray(lines)
+    finite = np.abs(points[:, 2]) > eps
+
+    # Finite points: the smallest eigenvalue of the scatter of the endpoints about
+    # the point, in a form that stays accurate far from the origin
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.where(finite, points[:, 0] / points[:, 2], 0)[:, None]
+        y = np.where(finite, points[:, 1] / points[:, 2], 0)[:, None]
+    ax, ay = lines[:, 0] - x, lines[:, 1] - y
+    bx, by = lines[:, 2] - x, lines[:, 3] - y
+    trace = ax**2 + ay**2 + bx**2 + by**2
+    cross2 = (ax * by - ay * bx)**2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smallest = 2 * cross2 / (trace + np.sqrt(np.maximum(trace**2 - 4 * cross2, 0)))
+    residuals = np.sqrt(np.nan_to_num(smallest) / 2)
+
+    # Points at infinity: the lines through them are parallel to their direction
+    norm = np.hypot(points[:, 0], points[:, 1])[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        spread = np.abs(points[:, 0, None] * (lines[:, 3] - lines[:, 1]) - points[:, 1, None] * (lines[:, 2] - lines[:, 0])) / norm
+    return np.where(finite[:, None], residuals, np.nan_to_num(spread) / 2)
+
+def _homogeneousLines(lines):
+    return np.cross(np.column_stack((lines[:, :2], np.ones(len(lines)))), np.column_stack((lines[:, 2:], np.ones(len(lines)))))
+
+# MSAC for the point the lines have in common. Returns the homogeneous point and
+# the inlier mask; with fewer than three lines every line is an inlier.
+def filterCommonPoint(lines, threshold=INLIER_THRESHOLD, numHypotheses=NUM_HYPOTHESES, seed=0):
+    lines = Geometry.asLineArray(lines)
+    if len(lines) < 3:
+        return None, np.ones(len(lines), dtype=bool)
+
+    randomState = np.random.RandomState(seed)
+    first = randomState.randint(0, len(lines), numHypotheses)
+    second = (first + randomState.randint(1, len(lines), numHypotheses)) % len(lines)
+    homogeneous = _homogeneousLines(lines)
+    hypotheses = np.cross(homogeneous[first], homogeneous[second])
+    norms = np.sqrt((hypotheses**2).sum(axis=1))
+    hypotheses = hypotheses[norms > 0] / norms[norms > 0, None]
+    if not len(hypotheses):
+        return None, np.ones(len(lines), dtype=bool)
+
+    residuals = commonPointResiduals(hypotheses, lines)
+    cost = np.minimum(residuals, threshold)**2
+    best = np.argmin(cost.sum(axis=1))
+    return hypotheses[best], residuals[best] <= threshold
+
+# Lines between an object region and its reflection region, filtered geometrically.
+# Matches shorter than minLength pixels are dropped as the regions matching themselves.
+@instrument('correspondences')
+def findCorrespondences(objectGray, objectOffset, reflectionGray, reflectionOffset,
+                        maxFeatures=MAX_FEATURES, ratio=RATIO, threshold=INLIER_THRESHOLD, minLength=5.0):
+    lines = matchRegions(objectGray, np.asarray(objectOffset, dtype=float),
+                         reflectionGray, np.asarray(reflectionOffset, dtype=float), maxFeatures, ratio)
+    lines = lines[np.hypot(lines[:, 2] - lines[:, 0], lines[:, 3] - lines[:, 1]) >= minLength]
+    record('matches', len(lines))
+    inliers = filterCommonPoint(lines, threshold)[1]
+    record('correspondences', inliers.sum())
+    return lines[inliers]
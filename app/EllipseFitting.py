@@ -0,0 +1,345 @@
+'''
+Ellipse fitting for the outlines of spheres seen in perspective.
+
+A pinhole camera sees a sphere through the cone of rays that graze it, and the
+image plane cuts that cone obliquely unless the sphere sits on the optical axis.
+The outline is therefore an ellipse stretched away from the principal point
+(images/diagrams/sphere-distortion.svg), and the center of a circle fitted to it
+is not where the sphere's center projects.
+
+fitContour samples a dense contour around an initial circle, moves every point
+onto the image edge with Geometry.refineEdgePoints and fits an ellipse to all of
+them. fitEllipses is robust the way CircleFitting.fitCircles is: random
+five-point hypotheses are scored with the MSAC cost on the Sampson distance,
+and the inliers of the best one are fitted by the direct least squares method
+of Halir and Flusser, the numerically stable form of Fitzgibbon's. Both stages
+are 3x3 eigenproblems batched over every ellipse and hypothesis. Occluders and
+reflections right at the rim put many edge points off the outline, so the
+consensus step matters more here than for the clicked circle points.
+
+A free ellipse has five parameters, and an outline that is partly hidden or cut
+off by the image border leaves some of them loose. When the camera is known the
+outline is a sphere silhouette, which has only three: the ray to the center and
+the half angle of the cone of rays that graze the sphere. fitEllipses then fits
+that cone instead, with three-point hypotheses and a linear least squares refit.
+
+projectedSphereCenters corrects for perspective. If the cone's axis makes angle
+t with the optical axis and its half angle is s, the outline's center lies
+f sin t cos t / D from the principal point along the major axis, and its semi
+axes are a = f sin s cos s / D and b = f sin s / sqrt(D), with
+D = cos^2 t - sin^2 s. The sphere center projects to f tan t, which works out to
+c - (a^2 - b^2) / c for an outline centered c from the principal point, whatever
+the focal length. That makes the center very sensitive to a - b, so when the
+focal length is known the center is instead put on the bisector of the rays to
+the outline's two ends along the line through the principal point.
+'''
+
+from functools import partial
+
+import numpy as np
+
+import Geometry
+from Instrumentation import instrument, record
+
+# contour points sampled around the sphere by fitContour
+DENSE_POINTS = 1024
+NUM_HYPOTHESES = 256
+# points each hypothesis is scored on
+SCORE_POINTS = 256
+# Sampson distance in pixels from an ellipse within which an edge point is an inlier
+INLIER_THRESHOLD = 1.0
+
+
+class EllipseFits(object):
+    '''
+    Results for a batch of B ellipses:
+
+    conics     (B, 6)  unit coefficients (A, B, C, D, E, F) of A x^2 + B xy + C y^2 + D x + E y + F = 0
+    centers    (B, 2)  ellipse centers
+    axes       (B, 2)  semi-major and semi-minor axis lengths
+    angles     (B,)    angle of the major axis from the x axis, in radians
+    inliers    (B, N)  points used for the final fit
+    residuals  (B, N)  Sampson distance of every point, about its geometric distance
+    rmsError   (B,)    root mean square residual over the inliers
+    '''
+
+    def __init__(self, conics, inliers, residuals):
+        self.conics = conics
+        self.inliers = inliers
+        self.residuals = residuals
+        with np.errstate(invalid='ignore'):
+            self.rmsError = np.sqrt(np.where(inliers, residuals**2, 0).sum(axis=1) / np.maximum(inliers.sum(axis=1), 1))
+        self.centers, self.axes, self.angles = ellipseParameters(conics)
+
+    def __len__(self):
+        return len(self.conics)
+
+    def __repr__(self):
+        return "EllipseFits(%d ellipses, mean rmsError=%.3f)" % (len(self), np.mean(self.rmsError))
+
+    # Summary of one ellipse as plain Python values
+    def summary(self, i=0):
+        return {
+            'center': [float(v) for v in self.centers[i]],
+            'axes': [float(v) for v in self.axes[i]],
+            'angle': float(self.angles[i]),
+            'rmsError': float(self.rmsError[i]),
+            'numInliers': int(self.inliers[i].sum()),
+            'outliers': np.flatnonzero(~self.inliers[i]).tolist(),
+        }
+
+# Symmetric 3x3 matrices of conic coefficients (B, 6)
+def _conicMatrices(conics):
+    A, B, C, D, E, F = np.rollaxis(conics, -1)
+    return np.stack((np.stack((A, B / 2, D / 2), -1),
+                     np.stack((B / 2, C, E / 2), -1),
+                     np.stack((D / 2, E / 2, F), -1)), -2)
+
+# Centers, semi-axes (major first) and major axis angles of conics (B, 6).
+# Conics that are not ellipses give nan.
+def ellipseParameters(conics):
+    A, B, C, D, E, F = np.rollaxis(np.asarray(conics, dtype=float), -1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        determinant = 4 * A * C - B**2
+        cx = (B * E - 2 * C * D) / determinant
+        cy = (B * D - 2 * A * E) / determinant
+        constant = (D * cx + E * cy) / 2 + F
+
+        quadratic = np.stack((np.stack((A, B / 2), -1), np.stack((B / 2, C), -1)), -2)
+        quadratic[~np.isfinite(quadratic)] = 0
+        eigenvalues, eigenvectors = np.linalg.eigh(quadratic)
+        # the longer axis has the eigenvalue nearest zero, which comes last when the
+        # conic's overall sign is negative
+        flip = constant > 0
+        eigenvalues[flip] = eigenvalues[flip][:, ::-1]
+        eigenvectors[flip] = eigenvectors[flip][:, :, ::-1]
+        axes = np.sqrt(-constant[:, None] / eigenvalues)
+        angles = np.arctan2(eigenvectors[:, 1, 0], eigenvectors[:, 0, 0])
+
+    valid = (determinant > 0) & np.isfinite(axes).all(axis=1)
+    centers = np.column_stack((cx, cy))
+    centers[~valid] = np.nan
+    axes[~valid] = np.nan
+    angles = np.where(valid, np.mod(angles, np.pi), np.nan)
+    return centers, axes, angles
+
+# Sampson distances (..., N) of points (..., N, 2) from conics (..., 6)
+def sampsonDistances(conics, points):
+    A, B, C, D, E, F = [c[..., None] for c in np.rollaxis(conics, -1)]
+    x, y = points[..., 0], points[..., 1]
+    value = A * x**2 + B * x * y + C * y**2 + D * x + E * y + F
+    gx = 2 * A * x + B * y + D
+    gy = B * x + 2 * C * y + E
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.abs(value) / np.hypot(gx, gy)
+
+# Weighted direct least squares ellipses (Halir and Flusser) for points (B, N, 2)
+# and weights (B, N). Points are centered and scaled first for conditioning.
+def directEllipses(points, weights):
+    weights = np.asarray(weights, dtype=float)
+    total = np.maximum(weights.sum(axis=1), 1e-12)
+    mean = (points * weights[..., None]).sum(axis=1) / total[:, None]
+    centered = points - mean[:, None]
+    scale = np.sqrt((weights * (centered**2).sum(axis=-1)).sum(axis=1) / total / 2)
+    scale[scale == 0] = 1
+    x = centered[..., 0] / scale[:, None]
+    y = centered[..., 1] / scale[:, None]
+
+    quadratic = np.stack((x * x, x * y, y * y), -1)
+    linear = np.stack((x, y, np.ones_like(x)), -1)
+    s1 = np.einsum('bni,bn,bnj->bij', quadratic, weights, quadratic)
+    s2 = np.einsum('bni,bn,bnj->bij', quadratic, weights, linear)
+    s3 = np.einsum('bni,bn,bnj->bij', linear, weights, linear)
+
+    # linear part in terms of the quadratic part, then the constraint 4AC - B^2 = 1
+    # (a tiny ridge keeps degenerate samples, like collinear points, solvable)
+    t = -np.linalg.solve(s3 + 1e-12 * np.eye(3), np.transpose(s2, (0, 2, 1)))
+    m = s1 + np.matmul(s2, t)
+    m[~np.isfinite(m)] = 0
+    reduced = np.stack((m[:, 2] / 2, -m[:, 1], m[:, 0] / 2), 1)
+    eigenvectors = np.real(np.linalg.eig(reduced)[1])
+    condition = 4 * eigenvectors[:, 0] * eigenvectors[:, 2] - eigenvectors[:, 1]**2
+    best = np.argmax(condition, axis=1)
+    a1 = eigenvectors[np.arange(len(points)), :, best]
+    a2 = np.einsum('bij,bj->bi', t, a1)
+
+    # back to image coordinates: x = H X with H undoing the centering and scaling
+    h = np.zeros((len(points), 3, 3))
+    h[:, 0, 0] = h[:, 1, 1] = 1 / scale
+    h[:, :2, 2] = -mean / scale[:, None]
+    h[:, 2, 2] = 1
+    return _matrixConics(np.matmul(np.transpose(h, (0, 2, 1)), np.matmul(_conicMatrices(np.hstack((a1, a2))), h)))
+
+# Unit conic coefficients (B, 6) of symmetric matrices (B, 3, 3)
+def _matrixConics(q):
+    conics = np.column_stack((q[:, 0, 0], 2 * q[:, 0, 1], q[:, 1, 1], 2 * q[:, 0, 2], 2 * q[:, 1, 2], q[:, 2, 2]))
+    return conics / np.sqrt((conics**2).sum(axis=1))[:, None]
+
+# Least squares sphere silhouettes seen by camera, a SphereReflection.Camera, as
+# conics like directEllipses gives. The rays r through a sphere's outline make a
+# cone around the ray to its center, with r . n = 1 for n along that ray and
+# |n| = 1 / cos of the cone's half angle, which is linear in n.
+def silhouetteConics(camera, points, weights):
+    weights = np.asarray(weights, dtype=float)
+    rays = camera.rays(points.reshape(-1, 2)).reshape(points.shape[:-1] + (3,))
+    a = np.einsum('bni,bn,bnj->bij', rays, weights, rays)
+    b = np.einsum('bni,bn->bi', rays, weights)
+    cones = np.linalg.solve(a + 1e-12 * np.eye(3), b[..., None])[..., 0]
+    cones[~np.isfinite(cones)] = 0
+
+    # the image of (r . n)^2 = |r|^2 for r = K^-1 (x, y, 1)
+    f = camera.focalLength
+    px, py = camera.principalPoint
+    inverse = np.array([[1 / f, 0, -px / f], [0, 1 / f, -py / f], [0, 0, 1]])
+    cone = cones[:, :, None] * cones[:, None, :] - np.eye(3)
+    return _matrixConics(np.matmul(inverse.T, np.matmul(cone, inverse)))
+
+def _robustInliers(points, mask, threshold, numHypotheses, randomState, fitConics, sampleSize):
+    B, N = mask.shape
+    counts = mask.sum(axis=1)
+
+    # Pick sampleSize distinct valid points per hypothesis from random keys
+    keys = randomState.rand(B, numHypotheses, N)
+    keys[~np.broadcast_to(mask[:, None, :], keys.shape)] = np.inf
+    samples = np.argpartition(keys, sampleSize, axis=2)[:, :, :sampleSize]
+    sample = points[np.arange(B)[:, None, None], samples].reshape(B * numHypotheses, sampleSize, 2)
+
+    conics = fitConics(sample, np.ones(sample.shape[:2])).reshape(B, numHypotheses, 6)
+    valid = np.isfinite(ellipseParameters(conics.reshape(-1, 6))[1]).all(axis=1).reshape(B, numHypotheses)
+
+    # hypotheses are scored on evenly spread points, the winner on all of them
+    scored = np.unique(np.linspace(0, N - 1, min(N, SCORE_POINTS)).astype(int))
+    distances = sampsonDistances(conics, points[:, None, scored])
+    squared = np.where(np.isfinite(distances), distances**2, np.inf)
+    cost = np.where(mask[:, None, scored], np.minimum(squared, threshold**2), 0).sum(axis=2)
+    cost[~valid] = np.inf
+    best = np.argmin(cost, axis=1)
+    with np.errstate(invalid='ignore'):
+        inliers = mask & (sampsonDistances(conics[np.arange(B), best], points) <= threshold)
+
+    # Fall back to all points when there is nothing to vote on or the vote failed
+    fallback = (counts <= sampleSize) | (inliers.sum(axis=1) < sampleSize)
+    inliers[fallback] = mask[fallback]
+    return inliers
+
+# Fit an ellipse to each set of points. points is (B, N, 2) or (N, 2) for a single
+# ellipse; mask (B, N) marks the points to use. With a camera the ellipses are
+# sphere silhouettes for it: three parameters instead of five, so outlines that are
+# partly hidden or cut off by the image border still pin the ellipse down.
+@instrument('ellipseFit')
+def fitEllipses(points, mask=None, robust=True, threshold=INLIER_THRESHOLD, numHypotheses=NUM_HYPOTHESES, seed=0, camera=None):
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 2:
+        points = points[None]
+        mask = None if mask is None else np.asarray(mask)[None]
+    if mask is None:
+        mask = np.ones(points.shape[:2], dtype=bool)
+    mask = np.asarray(mask, dtype=bool) & np.isfinite(points).all(axis=-1)
+    # masked out points are never used, so give them harmless coordinates
+    points = np.where(mask[..., None], points, 0)
+    if camera is None:
+        fitConics, sampleSize = directEllipses, 5
+    else:
+        fitConics, sampleSize = partial(silhouetteConics, camera), 3
+
+    if robust:
+        inliers = _robustInliers(points, mask, threshold, numHypotheses, np.random.RandomState(seed), fitConics, sampleSize)
+    else:
+        inliers = mask.copy()
+    conics = fitConics(points, inliers)
+    residuals = sampsonDistances(conics, points)
+
+    if robust:
+        # Re-evaluate the inliers against the least squares fit and fit again if they changed
+        with np.errstate(invalid='ignore'):
+            refit = mask & (residuals <= threshold)
+        tooFew = refit.sum(axis=1) < sampleSize
+        refit[tooFew] = inliers[tooFew]
+        if (refit != inliers).any():
+            inliers = refit
+            conics = fitConics(points, inliers)
+            residuals = sampsonDistances(conics, points)
+
+    fits = EllipseFits(conics, inliers, residuals)
+    record('ellipseRmsError', float(np.nanmean(fits.rmsError)))
+    record('ellipseOutliers', (mask & ~inliers).sum())
+    return fits
+
+# Points evenly spaced in angle around an ellipse
+def ellipsePoints(center, axes, angle, numPoints):
+    t = np.linspace(0, 2 * np.pi, numPoints, endpoint=False)
+    x = axes[0] * np.cos(t)
+    y = axes[1] * np.sin(t)
+    c, s = np.cos(angle), np.sin(angle)
+    return np.column_stack((center[0] + c * x - s * y, center[1] + s * x + c * y))
+
+# Distances from ellipse centers to their outlines along unit directions (B, 2)
+def _extents(axes, angles, directions):
+    cosine = directions[:, 0] * np.cos(angles) + directions[:, 1] * np.sin(angles)
+    sine = np.sqrt(np.maximum(1 - cosine**2, 0))
+    return 1 / np.sqrt((cosine / axes[:, 0])**2 + (sine / axes[:, 1])**2)
+
+# Where the centers of spheres project, from their outline ellipses. With a focal
+# length the center is found the way SphereReflection.sphereFromCircle finds it,
+# from the outline points nearest to and farthest from the principal point, which
+# keeps edge noise from being amplified. Without one, the (a^2 - b^2) / c shift is
+# used; it needs no focal length but magnifies errors in a - b by about 2a / c.
+def projectedSphereCenters(centers, axes, angles, principalPoint, focalLength=None):
+    centers = Geometry.asPointArray(centers)
+    axes = np.asarray(axes, dtype=float).reshape(-1, 2)
+    angles = np.asarray(angles, dtype=float).reshape(-1)
+    principalPoint = np.asarray(principalPoint, dtype=float)
+    offsets = centers - principalPoint
+    distance = np.hypot(*offsets.T)
+    # outlines centered on the principal point are circles and need no correction
+    onAxis = distance == 0
+    direction = np.where(onAxis[:, None], [1.0, 0.0], offsets / np.where(onAxis, 1, distance)[:, None])
+
+    if focalLength is None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shift = (axes[:, 0]**2 - axes[:, 1]**2) / distance
+        # noise can make a nearly round outline look stretched the wrong way
+        shift = np.where(onAxis, 0, np.clip(shift, 0, distance))
+        return centers - shift[:, None] * direction
+
+    extent = _extents(axes, angles, direction)[:, None]
+    near = np.column_stack((offsets - extent * direction, np.full(len(centers), float(focalLength))))
+    far = np.column_stack((offsets + extent * direction, np.full(len(centers), float(focalLength))))
+    axis = near / np.sqrt((near**2).sum(axis=1))[:, None] + far / np.sqrt((far**2).sum(axis=1))[:, None]
+    return principalPoint + focalLength * axis[:, :2] / axis[:, 2, None]
+
+# Dense outline of the sphere around an initial circle in image coordinates. gray is
+# the luminance of a region whose top left corner is at offset; it should hold the
+# whole circle plus searchRadius. Returns the edge points and their EllipseFits,
+# fitted as silhouettes when a camera is given; points whose search would leave
+# the region are not used for the fit.
+def fitContour(gray, center, radius, offset=(0, 0), searchRadius=5, numPoints=DENSE_POINTS, iterations=2, camera=None):
+    offset = np.asarray(offset, dtype=float)
+    center = np.asarray(center, dtype=float)
+    height, width = gray.shape
+    contour = ellipsePoints(center, (radius, radius), 0.0, numPoints)
+    for i in xrange(iterations):
+        local = contour - offset
+        inside = ((local[:, 0] >= searchRadius) & (local[:, 0] <= width - 1 - searchRadius) &
+                  (local[:, 1] >= searchRadius) & (local[:, 1] <= height - 1 - searchRadius))
+        points = Geometry.refineEdgePoints(gray, local, center - offset, searchRadius) + offset
+        fits = fitEllipses(points, inside, camera=camera)
+        if not np.isfinite(fits.centers[0]).all():
+            break
+        center = fits.centers[0]
+        contour = ellipsePoints(center, fits.axes[0], fits.angles[0], numPoints)
+    return points, fits
+
+# Ellipse outline of a sphere around its fitted circle and where the sphere's center
+# projects with camera, a SphereReflection.Camera. Returns the outline's
+# EllipseFits summary with the projected center added as 'projectedCenter', or
+# None when no ellipse fits the edges.
+def fitSphereOutline(gray, center, radius, camera, offset=(0, 0), searchRadius=5):
+    points, fits = fitContour(gray, center, radius, offset, searchRadius, camera=camera)
+    if not np.isfinite(fits.centers[0]).all():
+        return None
+    projected = projectedSphereCenters(fits.centers, fits.axes, fits.angles, camera.principalPoint, camera.focalLength)[0]
+    summary = fits.summary()
+    summary['projectedCenter'] = [float(v) for v in projected]
+    record('projectedCenterShift', float(np.hypot(*(projected - center))))
+    return summary
@@ -0,0 +1,449 @@
+import heapq
+
+import numpy as np
+
+from Instrumentation import instrument, record
+
+# Plain NumPy geometry helpers. Lines are stored as rows of (x1, y1, x2, y2)
+# and points as rows of (x, y), so nothing in here needs Qt.
+
+
+def asLineArray(lines):
+    return np.asarray(lines, dtype=float).reshape(-1, 4)
+
+def asPointArray(points):
+    return np.asarray(points, dtype=float).reshape(-1, 2)
+
+# Intersect one line with every line in others, treating all of them as infinite lines
+# (the same as QLineF.intersect accepting both bounded and unbounded intersections).
+# Returns the intersection points and a mask of which rows of others were not parallel.
+def intersectLineWithLines(line, others):
+    others = asLineArray(others)
+    x1, y1, x2, y2 = np.asarray(line, dtype=float)
+    rx, ry = x2 - x1, y2 - y1
+    sx = others[:, 2] - others[:, 0]
+    sy = others[:, 3] - others[:, 1]
+
+    denominator = rx * sy - ry * sx
+    valid = (denominator != 0) & np.isfinite(denominator)
+
+    qx = others[valid, 0] - x1
+    qy = others[valid, 1] - y1
+    t = (qx * sy[valid] - qy * sx[valid]) / denominator[valid]
+
+    points = np.empty((t.shape[0], 2))
+    points[:, 0] = x1 + t * rx
+    points[:, 1] = y1 + t * ry
+    return points, valid
+
+# Perpendicular distance from a point to each (infinite) line
+def pointLineDistances(point, lines):
+    lines = asLineArray(lines)
+    px, py = np.asarray(point, dtype=float)
+    dx = lines[:, 2] - lines[:, 0]
+    dy = lines[:, 3] - lines[:, 1]
+    length = np.hypot(dx, dy)
+    cross = (lines[:, 0] - px) * dy - (lines[:, 1] - py) * dx
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.abs(cross) / length
+
+# Every pairwise intersection between the given lines, along with the index pair
+# of the lines that produced each point
+@instrument('intersect')
+def pairwiseIntersections(lines):
+    lines = asLineArray(lines)
+    pointBlocks = [np.empty((0, 2))]
+    pairBlocks = [np.empty((0, 2), dtype=int)]
+    for i in xrange(len(lines) - 1):
+        points, valid = intersectLineWithLines(lines[i], lines[i+1:])
+        pairs = np.empty((points.shape[0], 2), dtype=int)
+        pairs[:, 0] = i
+        pairs[:, 1] = np.flatnonzero(valid) + i + 1
+        pointBlocks.append(points)
+        pairBlocks.append(pairs)
+    points, pairs = np.vstack(pointBlocks), np.vstack(pairBlocks)
+    record('intersections', len(points))
+    return points, pairs
+
+# Intersections of every line in lines with every line in others, with index pairs
+# (row in lines, row in others). Loops over the shorter of the two.
+@instrument('intersect')
+def crossIntersections(lines, others):
+    lines = asLineArray(lines)
+    others = asLineArray(others)
+    swap = len(lines) > len(others)
+    if swap:
+        lines, others = others, lines
+
+    pointBlocks = [np.empty((0, 2))]
+    pairBlocks = [np.empty((0, 2), dtype=int)]
+    for i in xrange(len(lines)):
+        points, valid = intersectLineWithLines(lines[i], others)
+        pairs = np.empty((points.shape[0], 2), dtype=int)
+        pairs[:, 0] = i
+        pairs[:, 1] = np.flatnonzero(valid)
+        pointBlocks.append(points)
+        pairBlocks.append(pairs)
+    points, pairs = np.vstack(pointBlocks), np.vstack(pairBlocks)
+    if swap:
+        pairs = pairs[:, ::-1]
+    record('intersections', len(points))
+    return points, pairs
+
+# Luminance of a BGR(A) image array (as from cv2.imread or convertQImageToMat)
+def luminance(image):
+    image = np.asarray(image)
+    if image.ndim == 2:
+        return image.astype(np.float32)
+    return (0.114 * image[..., 0] + 0.587 * image[..., 1] + 0.299 * image[..., 2]).astype(np.float32)
+
+# Bilinearly interpolated values of a 2D array at (xs, ys), clamped to the edges
+def bilinearSample(values, xs, ys):
+    height, width = values.shape
+    xs = np.clip(xs, 0, width - 1)
+    ys = np.clip(ys, 0, height - 1)
+    x0 = np.floor(xs).astype(int)
+    y0 = np.floor(ys).astype(int)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = xs - x0
+    fy = ys - y0
+
+    top = values[y0, x0] * (1 - fx) + values[y0, x1] * fx
+    bottom = values[y1, x0] * (1 - fx) + values[y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+# Move each contour point onto the strongest luminance edge along its radial.
+# Every point's intensity profile is sampled in one go from -searchRadius to
+# +searchRadius pixels along the line through the center, and the edge is placed
+# at the peak of the gradient magnitude, refined to sub-pixel precision with a
+# parabola through the peak and its neighbours. Points on flat regions stay put.
+@instrument('refine')
+def refineEdgePoints(gray, points, center, searchRadius=5, step=0.5):
+    points = asPointArray(points)
+    radial = points - np.asarray(center, dtype=float)
+    length = np.hypot(radial[:, 0], radial[:, 1])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        direction = radial / length[:, None]
+    hasDirection = length > 0
+    direction[~hasDirection] = 0
+
+    offsets = np.arange(-searchRadius, searchRadius + step / 2.0, step)
+    xs = points[:, 0, None] + offsets * direction[:, 0, None]
+    ys = points[:, 1, None] + offsets * direction[:, 1, None]
+    profiles = bilinearSample(gray, xs, ys)
+
+    strength = np.abs(np.gradient(profiles, axis=1))
+    idx = np.argmax(strength, axis=1)
+    rowIdx = np.arange(len(points))
+    peak = strength[rowIdx, idx]
+
+    # Sub-pixel peak from a parabola through the neighbouring samples
+    inner = (idx > 0) & (idx < len(offsets) - 1)
+    before = strength[rowIdx, np.maximum(idx - 1, 0)]
+    after = strength[rowIdx, np.minimum(idx + 1, len(offsets) - 1)]
+    curvature = before - 2 * peak + after
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift = np.where(inner & (curvature < 0), 0.5 * (before - after) / curvature, 0)
+
+    edgeOffset = (offsets[idx] + shift * step)
+    refined = points + edgeOffset[:, None] * direction
+
+    unchanged = (peak == 0) | ~hasDirection
+    refined[unchanged] = points[unchanged]
+    if len(points):
+        record('edgeShift', np.abs(edgeOffset[~unchanged]).mean() if (~unchanged).any() else 0)
+    return refined
+
+# Keep the intersections that lie within one standard deviation (as a distance)
+# of their mean. Returns the mask of kept points and their mean.
+def stdDevCluster(points):
+    points = asPointArray(points)
+    mean = points.mean(axis=0)
+    stdDev = points.std(axis=0)
+    within = np.hypot(*(points - mean).T) <= np.hypot(*stdDev)
+    return within, points[within].mean(axis=0)
+
+# smallest bandwidth in pixels densityCluster picks by itself
+MIN_BANDWIDTH = 0.5
+# the density grid covers this many robust standard deviations around the median
+DENSITY_WINDOW = 20
+MEAN_SHIFT_ITERATIONS = 50
+# cluster members lie within this many robust scales of the mode
+MEMBER_SCALES = 3
+# points the mean shift and the scale estimates look at, taken at an even stride
+SAMPLE_POINTS = 100000
+
+
+class DensityCluster(object):
+    '''
+    Dominant mode of a point cloud:
+
+    center     (2,)  the mean of the members, which lie around the densest mode
+    spread     float robust standard deviation of the members about the mode, as a distance
+    radius     float MEMBER_SCALES spreads, but at least the bandwidth
+    members    (n,)  mask of the points within radius of the mode
+    bandwidth  float radius of the flat kernel used to find the mode
+    '''
+
+    def __init__(self, center, spread, radius, members, bandwidth):
+        self.center = center
+        self.spread = spread
+        self.radius = radius
+        self.members = members
+        self.bandwidth = bandwidth
+
+def _sample(points, size=SAMPLE_POINTS):
+    return points[::max(1, len(points) // size)]
+
+# Robust scale of a point cloud: the median absolute deviation of each axis,
+# scaled to a standard deviation for normal data, combined as a distance
+def robustScale(points, median=None):
+    if median is None:
+        median = np.median(points, axis=0)
+    return np.hypot(*(1.4826 * np.median(np.abs(points - median), axis=0)))
+
+# Silverman's rule of thumb on the robust scale, so neither outliers nor the number
+# of points blow the bandwidth up
+def defaultBandwidth(points):
+    return max(MIN_BANDWIDTH, 1.06 * robustScale(points) * len(points) ** -0.2)
+
+# Flat-kernel mean shift from start over the given points
+def meanShift(points, start, bandwidth, iterations=MEAN_SHIFT_ITERATIONS):
+    center = np.asarray(start, dtype=float)
+    for i in xrange(iterations):
+        near = points[np.hypot(*(points - center).T) <= bandwidth]
+        if not len(near):
+            break
+        newCenter = near.mean(axis=0)
+        done = np.hypot(*(newCenter - center)) < 1e-3 * bandwidth
+        center = newCenter
+        if done:
+            break
+    return center
+
+# Densest mode of the points, robust to outliers and to several competing modes,
+# unlike stdDevCluster. The points are binned on a grid of bandwidth sized cells
+# around their median and the 3x3 block of cells holding the most points seeds a
+# mean shift. The members are then the points within MEMBER_SCALES robust scales
+# of the mode, with the scale and the center (their mean) re-estimated from the
+# members until they settle. Binning is one bincount and the iterative steps work
+# on a sample of at most SAMPLE_POINTS, so millions of points take well under a second.
+# Returns None with fewer than 3 finite points.
+@instrument('densityCluster')
+def densityCluster(points, bandwidth=None):
+    points = asPointArray(points)
+    finite = np.isfinite(points).all(axis=1)
+    candidates = points[finite]
+    if len(candidates) < 3:
+        return None
+    if bandwidth is None:
+        bandwidth = defaultBandwidth(candidates)
+
+    # Far outliers (intersections of nearly parallel lines) cannot hold the mode
+    median = np.median(_sample(candidates), axis=0)
+    window = max(DENSITY_WINDOW * robustScale(_sample(candidates), median), 2 * bandwidth)
+    candidates = candidates[(np.abs(candidates - median) <= window).all(axis=1)]
+
+    origin = median - window
+    numCells = int(np.ceil(2 * window / bandwidth)) + 1
+    cells = np.minimum(((candidates - origin) / bandwidth).astype(int), numCells - 1)
+    counts = np.bincount(cells[:, 0] * numCells + cells[:, 1], minlength=numCells * numCells).reshape(numCells, numCells)
+
+    # Points in each cell's 3x3 neighbourhood
+    padded = np.pad(counts, 1, mode='constant')
+    density = sum(padded[dx:dx + numCells, dy:dy + numCells] for dx in xrange(3) for dy in xrange(3))
+    seedX, seedY = np.unravel_index(np.argmax(density), density.shape)
+    block = (np.abs(cells[:, 0] - seedX) <= 1) & (np.abs(cells[:, 1] - seedY) <= 1)
+    start = candidates[block].mean(axis=0)
+
+    # The mean shift cannot wander far from the densest block
+    local = candidates[np.hypot(*(candidates - start).T) <= 3 * bandwidth]
+    center = meanShift(_sample(local), start, bandwidth)
+
+    sample = _sample(candidates)
+    radius = MEMBER_SCALES * bandwidth
+    spread = 0.0
+    for i in xrange(10):
+        near = sample[np.hypot(*(sample - center).T) <= radius]
+        spread = robustScale(near, center)
+        newCenter = near.mean(axis=0)
+        newRadius = max(MEMBER_SCALES * spread, bandwidth)
+        done = abs(newRadius - radius) < 1e-3 * radius and np.hypot(*(newCenter - center)) < 1e-3 * radius
+        center, radius = newCenter, newRadius
+        if done:
+            break
+
+    with np.errstate(invalid='ignore'):
+        members = finite & (np.hypot(*(points - center).T) <= radius)
+    center = points[members].mean(axis=0)
+    record('clusterMembers', members.sum())
+    return DensityCluster(center, spread, radius, members, bandwidth)
+
+
+class AnalysisResult:
+    numClusters = 0
+    distanceSums = []
+    originalIndices = []
+    def __init__(self, clusters, distanceSums, indices):
+        self.numClusters = clusters
+        self.distanceSums = distanceSums
+        self.originalIndices = indices
+
+    def __repr__(self):
+        return str("Number of clusters: %d, Distance sums: %s, Original indices: %s" % (self.numClusters, self.distanceSums, self.originalIndices))
+
+# Agglomerative clustering of per-object intersection sets.
+# Starting from one cluster per set, repeatedly merge the two closest centroids,
+# recording the distance sums at every level. Results are sorted by total distance.
+#
+# Centroid distances live in a heap with lazy deletion, merged centroids are
+# updated from the point counts, and only the merged cluster's distance sum is
+# recomputed at each level.
+@instrument('cluster')
+def findClusters(pointSets):
+    toReturn = []
+
+    points = [asPointArray(p) for p in pointSets]
+    counts = [len(p) for p in points]
+    with np.errstate(invalid='ignore'):
+        centroids = [p.mean(axis=0) if len(p) else np.array([np.nan, np.nan]) for p in points]
+    distanceSums = [_distanceSum(p, c) for p, c in zip(points, centroids)]
+    indices = [(idx,) for idx in xrange(len(points))]
+
+    # clusters in the order the original list-based implementation kept them
+    order = range(len(points))
+    active = set(order)
+    heap = []
+    for i in order:
+        _pushDistances(heap, centroids, i, order[i+1:])
+
+    toReturn.append(AnalysisResult(len(order), [distanceSums[i] for i in order], [indices[i] for i in order]))
+    while len(order) > 1:
+        dist, i, j = heapq.heappop(heap)
+        if i not in active or j not in active:
+            continue
+
+        # combine the two closest centroids into a new cluster
+        newIdx = len(points)
+        points.append(np.vstack((points[i], points[j])))
+        counts.append(counts[i] + counts[j])
+        if counts[-1]:
+            centroids.append((np.nan_to_num(centroids[i]) * counts[i] + np.nan_to_num(centroids[j]) * counts[j]) / counts[-1])
+        else:
+            centroids.append(np.array([np.nan, np.nan]))
+        distanceSums.append(_distanceSum(points[-1], centroids[-1]))
+        # ordered so the original indices read the same as before, closest pair first
+        first, second = (i, j) if order.index(i) < order.index(j) else (j, i)
+        indices.append(indices[first] + indices[second])
+        points[i] = points[j] = None
+
+        active.discard(i)
+        active.discard(j)
+        order.remove(i)
+        order.remove(j)
+        _pushDistances(heap, centroids, newIdx, order)
+        order.append(newIdx)
+        active.add(newIdx)
+
+        toReturn.append(AnalysisResult(len(order), [distanceSums[k] for k in order], [indices[k] for k in order]))
+
+    toReturn.sort(key=lambda x: sum(x.distanceSums))
+    return toReturn
+
+def _distanceSum(points, centroid):
+    return np.hypot(points[:, 0] - centroid[0], points[:, 1] - centroid[1]).sum()
+
+# Push the distances from one centroid to the others onto the heap. Empty clusters
+# have no centroid and are merged last.
+def _pushDistances(heap, centroids, idx, others):
+    if not len(others):
+        return
+    otherCentroids = np.array([centroids[k] for k in others])
+    distances = np.hypot(otherCentroids[:, 0] - centroids[idx][0], otherCentroids[:, 1] - centroids[idx][1])
+    distances[np.isnan(distances)] = np.inf
+    for other, dist in zip(others, distances):
+        heapq.heappush(heap, (dist, min(idx, other), max(idx, other)))
+
+# Point minimizing the weighted squared perpendicular distance to every line,
+# solved directly from the 2x2 normal equations, so it is linear in the number
+# of lines. Lines are weighted by their length unless weights are given.
+# Returns the point, the weighted rms distance of the lines to it and the
+# condition number of the system (very large when the lines are parallel and
+# the vanishing point is at infinity).
+def vanishingPoint(lines, weights=None):
+    lines = asLineArray(lines)
+    direction = lines[:, 2:] - lines[:, :2]
+    length = np.hypot(direction[:, 0], direction[:, 1])
+    keep = length > 0
+    lines, direction, length = lines[keep], direction[keep], length[keep]
+    weights = length if weights is None else np.asarray(weights, dtype=float)[keep]
+    if len(lines) < 2:
+        return np.array([np.nan, np.nan]), np.nan, np.inf
+
+    normals = np.column_stack((-direction[:, 1], direction[:, 0])) / length[:, None]
+    offsets = (normals * lines[:, :2]).sum(axis=1)
+    weightedNormals = normals * weights[:, None]
+    A = np.dot(weightedNormals.T, normals)
+    b = np.dot(weightedNormals.T, offsets)
+
+    point = np.linalg.lstsq(A, b, rcond=-1)[0]
+    residuals = np.dot(normals, point) - offsets
+    rms = np.sqrt((weights * residuals**2).sum() / weights.sum())
+    return point, rms, np.linalg.cond(A)
+
+# Weighted rms perpendicular distance from a point to lines, weighted by line length
+def rmsLineDistance(point, lines):
+    lines = asLineArray(lines)
+    length = np.hypot(lines[:, 2] - lines[:, 0], lines[:, 3] - lines[:, 1])
+    keep = length > 0
+    distances = pointLineDistances(point, lines[keep])
+    return np.sqrt((length[keep] * distances**2).sum() / length[keep].sum())
+
+# Planar mirror check. Lines joining objects to their reflections in one planar
+# mirror are parallel in the scene, so every collection should share a vanishing
+# point. Collections i and j agree when each one's lines pass the other's vanishing
+# point within factor times their distance to their own one, plus tolerance pixels.
+# A collection is consistent when it agrees with most of the others; the common
+# vanishing point is fitted to the lines of the consistent collections.
+# Cost is linear in the number of lines for a fixed number of collections.
+def planarConsistency(lineSets, tolerance=2.0, factor=2.0):
+    lineSets = [asLineArray(lines) for lines in lineSets]
+    usable = [idx for idx, lines in enumerate(lineSets) if len(lines) > 1]
+
+    fits = [vanishingPoint(lines) for lines in lineSets]
+    vanishingPoints = np.array([fit[0] for fit in fits]).reshape(-1, 2)
+    rmsDistances = np.array([fit[1] for fit in fits])
+
+    # crossDistances[i, j]: rms distance of collection i's lines to collection j's vanishing point
+    crossDistances = np.full((len(lineSets), len(lineSets)), np.nan)
+    for i in usable:
+        for j in usable:
+            crossDistances[i, j] = rmsLineDistance(vanishingPoints[j], lineSets[i])
+    with np.errstate(invalid='ignore'):
+        passes = crossDistances <= factor * rmsDistances[:, None] + tolerance
+    agree = passes & passes.T
+
+    consistent = np.zeros(len(lineSets), dtype=bool)
+    for i in usable:
+        others = [j for j in usable if j != i]
+        consistent[i] = not others or agree[i, others].sum() * 2 > len(others)
+
+    commonSets = [lineSets[idx] for idx in usable if consistent[idx]] or [lineSets[idx] for idx in usable]
+    if commonSets:
+        commonPoint, commonRms, commonCondition = vanishingPoint(np.vstack(commonSets))
+    else:
+        commonPoint, commonRms, commonCondition = np.array([np.nan, np.nan]), np.nan, np.inf
+
+    return {
+        'vanishingPoints': vanishingPoints,
+        'rmsDistances': rmsDistances,
+        'conditions': np.array([fit[2] for fit in fits]),
+        'usable': usable,
+        'crossDistances': crossDistances,
+        'consistent': consistent,
+        'commonVanishingPoint': commonPoint,
+        'commonCondition': commonCondition,
+        'commonRmsDistances': np.array([rmsLineDistance(commonPoint, lines) if idx in usable else np.nan for idx, lines in enumerate(lineSets)]),
+        'clusters': findClusters([vanishingPoints[idx:idx+1] for idx in usable]),
+    }
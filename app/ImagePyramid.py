@@ -0,0 +1,209 @@
+'''
+Tiled multi-resolution pyramids for large images.
+
+The first time an image is opened it is decoded once, halved repeatedly until it
+fits in a single tile, and every level is cut into square tiles that are written
+to a cache directory. After that only the tiles that are actually looked at are
+read back, so memory use depends on the tile cache size rather than on the
+resolution of the photograph.
+'''
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from math import ceil, floor, log
+
+import numpy as np
+
+from Instrumentation import timed
+
+# file name extensions of the images a folder is browsed or analyzed for
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+TILE_SIZE = 512
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nonplanar-reflections', 'pyramids')
+META_FILENAME = 'pyramid.json'
+
+
+# Pyramids are reused until the source file changes
+def _cacheKey(imagePath, tileSize):
+    stat = os.stat(imagePath)
+    key = "%s|%d|%d|%d" % (imagePath, stat.st_size, int(stat.st_mtime), tileSize)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class ImagePyramid(object):
+
+    def __init__(self, imagePath, cacheDir=CACHE_DIR, tileSize=TILE_SIZE):
+        self.imagePath = os.path.abspath(imagePath)
+        self.tileSize = tileSize
+        self.directory = os.path.join(cacheDir, _cacheKey(self.imagePath, tileSize))
+
+        metaPath = os.path.join(self.directory, META_FILENAME)
+        if os.path.isfile(metaPath):
+            with open(metaPath) as f:
+                meta = json.load(f)
+        else:
+            with timed('buildPyramid'):
+                meta = self._build()
+
+        self.width, self.height = meta['size']
+        self.levelSizes = [tuple(size) for size in meta['levels']]
+
+    # Whether opening imagePath would reuse a cached pyramid instead of building one
+    @staticmethod
+    def isBuilt(imagePath, cacheDir=CACHE_DIR, tileSize=TILE_SIZE):
+        imagePath = os.path.abspath(imagePath)
+        return os.path.isfile(os.path.join(cacheDir, _cacheKey(imagePath, tileSize), META_FILENAME))
+
+    def _build(self):
+        import cv2
+        image = cv2.imread(self.imagePath)
+        if image is None:
+            raise IOError("Could not read image %s" % self.imagePath)
+
+        height, width = image.shape[:2]
+        levels = []
+        level = 0
+        while True:
+            levelHeight, levelWidth = image.shape[:2]
+            levels.append((levelWidth, levelHeight))
+            levelDir = os.path.join(self.directory, str(level))
+            if not os.path.isdir(levelDir):
+                os.makedirs(levelDir)
+            for row in xrange(int(ceil(levelHeight / float(self.tileSize)))):
+                for column in xrange(int(ceil(levelWidth / float(self.tileSize)))):
+                    tile = image[row*self.tileSize:(row+1)*self.tileSize, column*self.tileSize:(column+1)*self.tileSize]
+                    cv2.imwrite(self.tilePath(level, row, column), tile)
+
+            if max(levelWidth, levelHeight) <= self.tileSize:
+                break
+            image = cv2.resize(image, (max(1, (levelWidth + 1) // 2), max(1, (levelHeight + 1) // 2)), interpolation=cv2.INTER_AREA)
+            level += 1
+
+        # The metadata file is written last so an interrupted build is redone
+        meta = {'size': [width, height], 'levels': levels}
+        with open(os.path.join(self.directory, META_FILENAME), 'w') as f:
+            json.dump(meta, f)
+        return meta
+
+    def tilePath(self, level, row, column):
+        return os.path.join(self.directory, str(level), "%d_%d.png" % (row, column))
+
+    # Downsampling factor of a level relative to the full image
+    def levelScale(self, level):
+        levelWidth, levelHeight = self.levelSizes[level]
+        return self.width / float(levelWidth), self.height / float(levelHeight)
+
+    # Coarsest level that still has at least one source pixel per screen pixel at this zoom
+    def levelForZoom(self, zoom):
+        if zoom >= 1:
+            return 0
+        return max(0, min(len(self.levelSizes) - 1, int(floor(log(1.0 / zoom, 2)))))
+
+    # Tiles of a level that overlap the image-coordinate rectangle (x0, y0, x1, y1).
+    # Yields (row, column, targetRect) with targetRect = (x, y, width, height) in image coordinates.
+    def visibleTiles(self, level, rect):
+        levelWidth, levelHeight = self.levelSizes[level]
+        scaleX, scaleY = self.levelScale(level)
+        x0, y0, x1, y1 = rect
+
+        firstColumn = max(0, int(x0 / scaleX) // self.tileSize)
+        lastColumn = min(int(ceil(levelWidth / float(self.tileSize))) - 1, int(x1 / scaleX) // self.tileSize)
+        firstRow = max(0, int(y0 / scaleY) // self.tileSize)
+        lastRow = min(int(ceil(levelHeight / float(self.tileSize))) - 1, int(y1 / scaleY) // self.tileSize)
+
+        for row in xrange(firstRow, lastRow + 1):
+            for column in xrange(firstColumn, lastColumn + 1):
+                x = column * self.tileSize
+                y = row * self.tileSize
+                tileWidth = min(self.tileSize, levelWidth - x)
+                tileHeight = min(self.tileSize, levelHeight - y)
+                yield row, column, (x * scaleX, y * scaleY, tileWidth * scaleX, tileHeight * scaleY)
+
+    # Coarsest level whose longer side is at least minSize pixels
+    def levelForSize(self, minSize):
+        for level in xrange(len(self.levelSizes) - 1, -1, -1):
+            if max(self.levelSizes[level]) >= minSize:
+                return level
+        return 0
+
+    # All BGR pixels of one level, assembled from its tiles
+    def levelImage(self, level):
+        import cv2
+        levelWidth, levelHeight = self.levelSizes[level]
+        pixels = np.zeros((levelHeight, levelWidth, 3), dtype=np.uint8)
+        for row in xrange(int(ceil(levelHeight / float(self.tileSize)))):
+            for column in xrange(int(ceil(levelWidth / float(self.tileSize)))):
+                tile = cv2.imread(self.tilePath(level, row, column))
+                y, x = row * self.tileSize, column * self.tileSize
+                pixels[y:y+tile.shape[0], x:x+tile.shape[1]] = tile
+        return pixels
+
+    # Full resolution BGR pixels of the rectangle (x0, y0, x1, y1), clamped to the image.
+    # Returns the array and the image coordinates of its top left corner.
+    def region(self, x0, y0, x1, y1):
+        import cv2
+        x0, y0 = max(0, int(x0)), max(0, int(y0))
+        x1, y1 = min(self.width, int(ceil(x1))), min(self.height, int(ceil(y1)))
+        pixels = np.zeros((max(0, y1 - y0), max(0, x1 - x0), 3), dtype=np.uint8)
+
+        for row, column, _ in self.visibleTiles(0, (x0, y0, x1 - 1, y1 - 1)):
+            tile = cv2.imread(self.tilePath(0, row, column))
+            tileX = column * self.tileSize
+            tileY = row * self.tileSize
+            left, top = max(x0, tileX), max(y0, tileY)
+            right = min(x1, tileX + tile.shape[1])
+            bottom = min(y1, tileY + tile.shape[0])
+            pixels[top-y0:bottom-y0, left-x0:right-x0] = tile[top-tileY:bottom-tileY, left-tileX:right-tileX]
+
+        return pixels, (x0, y0)
+
+
+# Least recently used cache of decoded tiles, bounded by total size in bytes.
+# load(key) decodes a missing tile and sizeOf(tile) reports its size. Values
+# decoded elsewhere, e.g. on a worker thread, can be added with put. Without a
+# loader it is a plain LRU cache and get returns None for missing keys.
+class TileCache(object):
+
+    def __init__(self, load, sizeOf, maxBytes=256 * 1024 * 1024):
+        self._load = load
+        self._sizeOf = sizeOf
+        self.maxBytes = maxBytes
+        self.totalBytes = 0
+        self._tiles = OrderedDict()
+
+    def get(self, key):
+        if key in self._tiles:
+            tile = self._tiles.pop(key)
+            self._tiles[key] = tile
+            return tile
+        if self._load is None:
+            return None
+
+        tile = self._load(key)
+        self.put(key, tile)
+        return tile
+
+    def put(self, key, tile):
+        self.pop(key)
+        self._tiles[key] = tile
+        self.totalBytes += self._sizeOf(tile)
+        while self.totalBytes > self.maxBytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self.totalBytes -= self._sizeOf(evicted)
+
+    # Remove and return the value for key, or None when it is not cached
+    def pop(self, key):
+        if key not in self._tiles:
+            return None
+        tile = self._tiles.pop(key)
+        self.totalBytes -= self._sizeOf(tile)
+        return tile
+
+    def __contains__(self, key):
+        return key in self._tiles
+
+    def clear(self):
+        self._tiles.clear()
+        self.totalBytes = 0
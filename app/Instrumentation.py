@@ -0,0 +1,127 @@
+'''
+Lightweight instrumentation for the analysis hot paths.
+
+Stages (opening, refining, fitting, intersecting, clustering, analyzing) record
+call counts and timings, and the code records scalar diagnostics such as fit
+residuals, center shifts and intersection counts. Everything goes to the
+module-level `instruments` object, which the GUI can show with report() and the
+batch CLI can dump with toDict(). Recording is thread safe, so stages run by
+the GUI's background jobs are counted too.
+'''
+
+import functools
+import threading
+import timeit
+from contextlib import contextmanager
+
+
+class Statistic(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.last = None
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.last = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def toDict(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.mean,
+                'min': self.minimum, 'max': self.maximum, 'last': self.last}
+
+    def merge(self, other):
+        if not other['count']:
+            return
+        self.count += other['count']
+        self.total += other['total']
+        self.minimum = other['min'] if self.minimum is None else min(self.minimum, other['min'])
+        self.maximum = other['max'] if self.maximum is None else max(self.maximum, other['max'])
+        self.last = other['last']
+
+
+class Instrumentation(object):
+
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.diagnostics = {}
+
+    @contextmanager
+    def timed(self, stage):
+        if not self.enabled:
+            yield
+            return
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            elapsed = timeit.default_timer() - start
+            with self._lock:
+                self.stages.setdefault(stage, Statistic()).add(elapsed)
+
+    # Decorator form of timed
+    def instrument(self, stage):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timed(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self.diagnostics.setdefault(name, Statistic()).add(value)
+
+    def toDict(self):
+        with self._lock:
+            return {
+                'stages': dict((name, stat.toDict()) for name, stat in self.stages.items()),
+                'diagnostics': dict((name, stat.toDict()) for name, stat in self.diagnostics.items()),
+            }
+
+    # Add the counts from another toDict(), e.g. one sent back by a worker process
+    def merge(self, data):
+        with self._lock:
+            for name, stat in data['stages'].items():
+                self.stages.setdefault(name, Statistic()).merge(stat)
+            for name, stat in data['diagnostics'].items():
+                self.diagnostics.setdefault(name, Statistic()).merge(stat)
+
+    def report(self):
+        with self._lock:
+            return self._report()
+
+    def _report(self):
+        lines = ["%-24s %8s %12s %12s %12s" % ("Stage", "Calls", "Total (ms)", "Mean (ms)", "Max (ms)")]
+        for name in sorted(self.stages, key=lambda n: -self.stages[n].total):
+            stat = self.stages[name]
+            lines.append("%-24s %8d %12.2f %12.3f %12.3f" % (name, stat.count, stat.total * 1000, stat.mean * 1000, stat.maximum * 1000))
+        lines.append("")
+        lines.append("%-24s %8s %12s %12s %12s %12s" % ("Diagnostic", "Count", "Last", "Mean", "Min", "Max"))
+        for name in sorted(self.diagnostics):
+            stat = self.diagnostics[name]
+            lines.append("%-24s %8d %12.4g %12.4g %12.4g %12.4g" % (name, stat.count, stat.last, stat.mean, stat.minimum, stat.maximum))
+        return "\n".join(lines)
+
+
+instruments = Instrumentation()
+timed = instruments.timed
+instrument = instruments.instrument
+record = instruments.record
@@ -1,107 +1,101 @@
-import cv2
-from cv2 import cv
-import numpy as np
-import Tkinter, tkFileDialog
-import random
-import itertools
-from math import hypot, sqrt, floor
+'''
+Annotation state and analysis for one image.
 
-from PySide import QtCore
-from PySide.QtGui import QColor
+Everything here works on plain NumPy arrays: lines are rows of x1, y1, x2, y2,
+points are (x, y) and colors are 0xAARRGGBB integers as stored in annotations.
+Nothing imports Qt, OpenCV or a GUI toolkit, so batch workers and scripts get
+the analysis without paying for them; app.py converts its Qt types at the
+boundary and does the drawing.
+'''
 
+import colorsys
+import random
 from abc import ABCMeta, abstractmethod
+from functools import partial
+from math import floor
 
-from scipy.optimize import fsolve
-
-
-
-
-# http://stackoverflow.com/questions/18406149/pyqt-pyside-how-do-i-convert-qimage-into-opencvs-mat-format
-def convertQImageToMat(incomingImage):
-    '''  Converts a QImage into an opencv MAT format  '''
-
-    incomingImage = incomingImage.convertToFormat(4)
-
-    width = incomingImage.width()
-    height = incomingImage.height()
-
-    ptr = incomingImage.bits()
-    ptr.setsize(incomingImage.byteCount())
-    arr = np.array(ptr).reshape(height, width, 4)  #  Copies the data
-    return arr
-
-# Find the intersection points between a QLine and a QRect
-def intersectLineRect(line, rect):
-    x1, y1, x2, y2 = rect.getCoords()
-
-    toReturn = []
-
-    rectLines = []
-    rectLines.append(QtCore.QLineF(x1, y1, x2, y1))
-    rectLines.append(QtCore.QLineF(x1, y1, x1, y2))
-    rectLines.append(QtCore.QLineF(x2, y1, x2, y2))
-    rectLines.append(QtCore.QLineF(x1, y2, x2, y2))
+import numpy as np
 
-    for l in rectLines:
-        intersectType, intersectionPoint = line.intersect(l)
-        if intersectType != QtCore.QLineF.NoIntersection and rect.contains(intersectionPoint.toPoint()):
-            toReturn.append(intersectionPoint)
+import Geometry
+import CircleFitting
+import EllipseFitting
+import AnalysisResults
+from Instrumentation import timed, record
 
-    return toReturn
 
+# Distance from point (x, y) to the infinite line through (x1, y1, x2, y2)
 def minDistance(point, line):
-    p = np.array(point.toTuple())
-    a = np.array(line.p1().toTuple())
-    unit = line.unitVector()
-    n = np.array([unit.dx(), unit.dy()])
+    return Geometry.pointLineDistances(point, line)[0]
 
-    return np.linalg.norm((a - p) - np.dot((a-p), n) * n)
+# Opaque 0xAARRGGBB color from hue, saturation and value in [0, 1]
+def hsvColor(hue, saturation, value):
+    r, g, b = [int(round(c * 255)) for c in colorsys.hsv_to_rgb(hue, saturation, value)]
+    return 0xFF000000 | (r << 16) | (g << 8) | b
 
-class LineCollection:
+class LineCollection(object):
 
+    # Lines are rows of an endpoint array. Intersections are stored with the pair of
+    # line indices that produced them, so adding or removing a line only touches
+    # that line's intersections.
     def __init__(self):
-        self.lines = []
-        self.intersections = []
+        self.endpoints = np.empty((0, 4))
+        self.intersectionPoints = np.empty((0, 2))
+        self.intersectionPairs = np.empty((0, 2), dtype=int)
 
+    def __len__(self):
+        return len(self.endpoints)
+
+    # newLine is (x1, y1, x2, y2)
     def addLine(self, newLine):
-        self.lines.append(newLine)
-        self.intersections = self._findIntersections()
+        newRow = np.array(newLine, dtype=float).reshape(4)
+        newIdx = len(self.endpoints)
+
+        with timed('addLine'):
+            points, valid = Geometry.intersectLineWithLines(newRow, self.endpoints)
+        record('intersections', len(points))
+        pairs = np.empty((points.shape[0], 2), dtype=int)
+        pairs[:, 0] = np.flatnonzero(valid)
+        pairs[:, 1] = newIdx
+
+        self.endpoints = np.vstack((self.endpoints, newRow))
+        self.intersectionPoints = np.vstack((self.intersectionPoints, points))
+        self.intersectionPairs = np.vstack((self.intersectionPairs, pairs))
+
+    # Add many lines at once from an (n, 4) endpoint array: the new lines are
+    # intersected with the existing ones and with each other in one pass each
+    def addLines(self, endpoints):
+        newRows = Geometry.asLineArray(endpoints)
+        first = len(self.endpoints)
+
+        with timed('addLines'):
+            crossPoints, crossPairs = Geometry.crossIntersections(self.endpoints, newRows)
+            newPoints, newPairs = Geometry.pairwiseIntersections(newRows)
+
+        self.endpoints = np.vstack((self.endpoints, newRows))
+        self.intersectionPoints = np.vstack((self.intersectionPoints, crossPoints, newPoints))
+        self.intersectionPairs = np.vstack((self.intersectionPairs, crossPairs + [0, first], newPairs + first))
+
+    def removeLine(self, idx):
+        self.endpoints = np.delete(self.endpoints, idx, axis=0)
+
+        keep = (self.intersectionPairs != idx).all(axis=1)
+        self.intersectionPoints = self.intersectionPoints[keep]
+        self.intersectionPairs = self.intersectionPairs[keep]
+        self.intersectionPairs[self.intersectionPairs > idx] -= 1
 
     def undoLine(self):
-        if self.lines:
-            self.lines.pop()
-            self.intersection = self._findIntersections()
-
-    def draw(self, painter, borderRect, color):
-        # TODO: calculate border points for each line, draw a line between those points
-        painter.setPen(color)
-        for l in self.lines:
-            borderPoints = intersectLineRect(l, borderRect)
-            painter.drawLine(borderPoints[0], borderPoints[1]) # Unsafe, may not return this many points
-            painter.drawEllipse(l.p1(), 2, 2)
-            painter.drawEllipse(l.p2(), 2, 2)
-
-    def _findIntersections(self):        
-        toReturn = []
-        if len(self.lines) > 1:
-            for i in self.lines:
-                for j in self.lines[self.lines.index(i)+1:]:
-                    intersectType, intersectionPoint = i.intersect(j)
-                    if intersectType != QtCore.QLineF.NoIntersection:
-                        toReturn.append(intersectionPoint)
-        return toReturn
-
-class AnalysisResult:
-    numClusters = 0
-    distanceSums = []
-    originalIndices = []
-    def __init__(self, clusters, distanceSums, indices):
-        self.numClusters = clusters
-        self.distanceSums = distanceSums
-        self.originalIndices = indices
-
-    def __repr__(self):
-        return str("Number of clusters: %d, Distance sums: %s, Original indices: %s" % (self.numClusters, self.distanceSums, self.originalIndices))
+        if len(self.endpoints):
+            self.removeLine(len(self.endpoints) - 1)
+
+    # Replace all lines at once from an (n, 4) endpoint array
+    def setLines(self, endpoints):
+        self.endpoints = Geometry.asLineArray(endpoints).copy()
+        self._findIntersections()
+
+    # Recompute every pairwise intersection from the endpoint array
+    def _findIntersections(self):
+        self.intersectionPoints, self.intersectionPairs = Geometry.pairwiseIntersections(self.endpoints)
+        return self.intersectionPoints
 
 class AbstractAnalysis:
     __metaclass__ = ABCMeta
@@ -118,7 +112,6 @@ class AbstractAnalysis:
     def startNewLineCollection(self):
         self.lineCollections.append(LineCollection())
         self.openCollectionIdx += 1
-        newColor = QColor()
         # http://martin.ankerl.com/2009/12/09/how-to-create-random-colors-programmatically/
         '''
         rand = random.random()
@@ -127,226 +120,152 @@ class AbstractAnalysis:
         '''
         phi = 0.618033988749895
         hue = self.openCollectionIdx * phi - floor(self.openCollectionIdx * phi)
-        newColor.setHsv(int(hue*256), 120 + int(random.random()*(240-120+1)), 242)
-        self.colors.append(newColor)
-
-    def draw(self, painter, borderRect):
-        # draw all lines
-        for lc in self.lineCollections:
-            lc.draw(painter, borderRect, self.colors[self.lineCollections.index(lc)])
-
-    def addLine(self, newLine):
-        self.lineCollections[self.openCollectionIdx].addLine(newLine)
+        saturation = 120 + int(random.random()*(240-120+1))
+        self.colors.append(hsvColor(int(hue*256) / 360.0, saturation / 255.0, 242 / 255.0))
 
+    # Add the line from point1 to point2, each (x, y), to the open collection
     def addLine(self, point1, point2):
-        newLine = QtCore.QLineF(point1, point2)
-        self.lineCollections[self.openCollectionIdx].addLine(newLine)
+        self.lineCollections[self.openCollectionIdx].addLine(tuple(point1) + tuple(point2))
+
+    # Bulk insert into the open collection, e.g. from Correspondences.findCorrespondences
+    def addLines(self, endpoints):
+        self.lineCollections[self.openCollectionIdx].addLines(endpoints)
 
     def undoLine(self):
         self.lineCollections[self.openCollectionIdx].undoLine()
 
+    # Annotation dict in the format used by AnnotationStore and BatchAnalysis
+    def getAnnotation(self):
+        return {
+            'mode': self.mode,
+            'lineCollections': [lc.endpoints for lc in self.lineCollections],
+            'colors': list(self.colors),
+            'circlePoints': np.empty((0, 2)),
+        }
+
+    def setAnnotation(self, annotation):
+        if not len(annotation['lineCollections']):
+            return
+        self.lineCollections = []
+        self.colors = []
+        for lines, color in zip(annotation['lineCollections'], annotation['colors']):
+            lc = LineCollection()
+            lc.setLines(lines)
+            self.lineCollections.append(lc)
+            self.colors.append(int(color))
+        self.openCollectionIdx = len(self.lineCollections) - 1
+
+    # Returns a result object from AnalysisResults; render it with toText, toDict or writeCsv
+    def analyze(self):
+        return self.analysisTask()()
+
+    # Returns a function that runs the analysis on a snapshot of the current lines.
+    # It touches nothing else, so it can run on a worker thread while annotation goes on.
     @abstractmethod
-    def analyze(self, plainTextEdit):
+    def analysisTask(self):
         pass
 
 
 class PlanarAnalysis(AbstractAnalysis):
+    mode = 'planar'
+    # extra rms distance in pixels the common vanishing point may add to a collection's own
+    tolerance = 2.0
 
-    
-    # method to return likely clusters and whether or not at least one deviates
-    # perform k-means for k = number of objects to 1
-    # calculate variance from centroids?
-    def _findClusters(self):
-        toReturn = []
-
-        intersectionsCollection = [(lc.intersections, (self.lineCollections.index(lc),)) for lc in self.lineCollections]
-        centroids = [np.mean(ic[0], axis=0) for ic in intersectionsCollection]
-
-        for i in xrange(len(self.lineCollections), 0, -1):
-            if i < len(self.lineCollections): # combine the two closest centroids
-                toCombine = self._findIndicesWithMinDistance(centroids)
-
-                # remove the items to be combined from intersectionsCollection
-                item1 = intersectionsCollection[toCombine[0]]
-                item2 = intersectionsCollection[toCombine[1]]
-
-                del intersectionsCollection[max(toCombine)]
-                del intersectionsCollection[min(toCombine)]
-
-                # add combined list and indices of collections that were combined
-                intersectionsCollection.append((item1[0] +item2[0], item1[1] + item2[1]))
-
-                # recalculate centroids
-                centroids = [np.mean(ic[0], axis=0) for ic in intersectionsCollection]
-
-            # calculate the sum of the distances from the centroid to the points, put in result
-            # todo: calculate variance for more than one collection
-            #for idx in range(len(intersectionsCollection)):
-            distanceSums = [sum( [hypot(point[0]-centroids[idx][0],  point[1]-centroids[idx][1]) for point in intersectionsCollection[idx][0] ]) for idx in range(len(intersectionsCollection))]
-            toReturn.append(AnalysisResult(i, distanceSums, [ic[1] for ic in intersectionsCollection]))
-        toReturn.sort(key=lambda x: sum(x.distanceSums))
-        return toReturn
-
-    def _findIndicesWithMinDistance(self, collection):
-
-        # Used to find the indices of the closest two centroids
-        # minSoFar = maxint
-        # indices = (-1, -1)
-        idxs = itertools.combinations(xrange(len(collection)), 2)
-
-        def hypotIdx(iIdx, jIdx):
-            i = collection[iIdx]
-            j = collection[jIdx]
-            return hypot(i[0] - j[0], i[1] - j[1])
-
-        minidx = min(idxs, key=lambda x: hypotIdx(*x))
-
-        # for iidx in xrange(len(collection)):
-        #     i = collection[iidx]
-        #     for jidx in xrange(iidx+1,len(collection)):
-        #         j = collection[jidx]
-        #         print "i, j", i, j
-        #         dist = hypot(i[0] - j[0], i[1] - j[1])
-        #         if dist < minSoFar:
-        #             minSoFar = dist
-        #             indices = (collection.index(i), collection.index(j))
-
-        print minidx
-        return minidx
-
-    def analyze(self, plainTextEdit):
-        raise NotImplementedError
+    def analysisTask(self):
+        # Each object's lines should meet at the vanishing point shared by every object in the mirror
+        return partial(AnalysisResults.planarResult, [lc.endpoints for lc in self.lineCollections], self.tolerance)
 
 
 class SphericalAnalysis(AbstractAnalysis):
+    mode = 'spherical'
+
     def __init__(self):
         # TODO: add a circle representation
         super(SphericalAnalysis, self).__init__()
 
-        self.center = QtCore.QPointF(0,0)
+        self.center = np.zeros(2)
         self.radius = 0
-        self.circlePoints = []
-
-    def draw(self, painter, borderRect):
-        super(SphericalAnalysis, self).draw(painter, borderRect)
-        if self.radius != 0:
-            painter.setPen(QColor(255, 0, 0))
-            painter.drawEllipse(self.center, self.radius, self.radius)
-            for p in self.circlePoints:
-                painter.drawEllipse(p, 2, 2)
-            painter.drawEllipse(self.center,2,2)
-
-    def solveCircle(self, points):
-        # ax + by + c = x^2 + y^2
-        Alist = []
-        blist = []
-        for point in points:
-            Alist.append([point.x(), point.y(), 1])
-            blist.append([-(point.x()**2+point.y()**2)])
-        #A = np.array([[point1.x(),point1.y(),1], [point2.x(),point2.y(),1], [point3.x(),point3.y(),1]])
-        #b = np.array([[-(point1.x()**2+point1.y()**2)], [-(point2.x()**2+point2.y()**2)], [-(point3.x()**2+point3.y()**2)]])
-        #solution = np.linalg.solve(A,b)
-        A = np.array(Alist)
-        b = np.array(blist)
-        rawSolution = np.linalg.lstsq(A,b)
-        solution = rawSolution[0]
-
-        print "Residuals:", rawSolution[1]
-
-        h = solution[0,0] / -2  # h = -a/2
-        k = solution[1,0] / -2  # k = -b/2
-
-        r = sqrt(h**2 + k**2 - solution[2,0]) # r^2 = h^2 + k^2 - f
-
-        return h, k, r
-
-    def addCircle(self, argPoints, image):
-
-        h, k, r = self.solveCircle(argPoints)
-
-        self.center.setX(h)
-        self.center.setY(k)
-        self.radius = r
-        self.circlePoints = argPoints
-
-        # Improve the points picked using simple edge detection
-        # For each point picked:
-        newPoints = []
-
-        for point in self.circlePoints:
-
-            # Aggregate candidates for a new point by finding contiguous points towards and away from the center obtained previously
-            newPointCandidates = []
-            restrictionLine = QtCore.QLineF(point, self.center)
-            slopeVector = QtCore.QPointF()
-            if restrictionLine.dx() == 0:
-                slopeVector.setX(0)
-                slopeVector.setY(1)
-            elif abs(restrictionLine.dy()) > abs(restrictionLine.dx()):
-                slopeVector.setX(restrictionLine.dx() / restrictionLine.dy())
-                slopeVector.setY(1)
-            else:
-                slopeVector.setX(1)
-                slopeVector.setY(restrictionLine.dy() / restrictionLine.dx())
-
-            for i in range(-5, 5):
-                if i == 0:
-                    newPointCandidates.append(point)
-                    continue
-                diff = i * slopeVector
-                newPointCandidates.append(point + QtCore.QPoint(round(diff.x()), round(diff.y())))
-
-            #print newPointCandidates
-
-            # Take the difference between each point and the next point
-            absdiff = []
-            for j in range(len(newPointCandidates) - 1): # for all points except the last one
-                absdiff.append(abs(image.pixel(newPointCandidates[j])-image.pixel(newPointCandidates[j+1])))
-
-            # replace the old point with the spot in between the two pixels with the max difference
-            maxdiff, idx = max( (v, i) for i, v in enumerate(absdiff) )
-            #print "maxdiff: %f" % maxdiff
-            if maxdiff != 0:
-                newPoints.append((newPointCandidates[idx] + newPointCandidates[idx+1]) / 2)
-            else:
-                newPoints.append(QtCore.QPointF(point))
-            
-
-        self.circlePoints = newPoints
-        h, k, r = self.solveCircle(newPoints)
-
-        print "Center shifted by", self.center.x() - h, self.center.y() - k
-
-        self.center.setX(h)
-        self.center.setY(k)
-        self.radius = r
-
-
-        # Make a list of the points within 10px of the picked point along the radial of the detected center
-        # Find the differences between the points in the list and pick the max as the new point
-
-
-        #Redo circle solution with new points
-
-    def analyze(self, plainTextEdit):
-        plainTextEdit.setPlainText("")
+        self.circlePoints = np.empty((0, 2))
+        # how far in pixels edge refinement looks along each radial
+        self.searchRadius = 5
+        # Monte Carlo samples for confidence intervals and p-values, 0 to skip them
+        self.numSamples = 0
+        # fit summary of the last solveCircle: residuals, inliers and standard errors
+        self.circleFit = None
+        # fit an ellipse to the whole outline when a circle is added and analyze
+        # against the projected sphere center, for spheres away from the image center
+        self.fitEllipse = False
+        # SphereReflection.Camera of the image, needed by fitEllipse
+        self.camera = None
+        # EllipseFitting.fitSphereOutline summary of the last added circle, or None
+        self.ellipse = None
+
+    def getAnnotation(self):
+        annotation = super(SphericalAnalysis, self).getAnnotation()
+        annotation['circlePoints'] = self.circlePoints.copy()
+        return annotation
+
+    # The stored circle points are already refined, so only the fit is redone. No
+    # outline ellipse is stored; in ellipse mode the GUI fits it again.
+    def setAnnotation(self, annotation):
+        super(SphericalAnalysis, self).setAnnotation(annotation)
+        if len(annotation['circlePoints']) > 2:
+            self.circlePoints = Geometry.asPointArray(annotation['circlePoints']).copy()
+            h, k, r = self.solveCircle(self.circlePoints)
+            self.center = np.array([h, k])
+            self.radius = r
+            self.ellipse = None
+
+    # Geometric circle fit to (n, 2) points. With robust set, stray points are voted
+    # out first and reported in circleFit['outliers'].
+    def solveCircle(self, points, robust=True):
+        fits = CircleFitting.fitCircles(Geometry.asPointArray(points), robust=robust)
+        self.circleFit = fits.summary()
+
+        h, k = fits.centers[0]
+        return h, k, fits.radii[0]
+
+    # argPoints are the clicked (x, y) points and image a BGR(A) or luminance array of
+    # pixels whose top left corner is at offset in image coordinates
+    def addCircle(self, argPoints, image, offset=(0, 0)):
+        self.setCircle(*self.refineCircle(argPoints, image, offset))
+
+    # The work behind addCircle, leaving the analysis untouched so it can run on a
+    # worker thread. Returns the refined points, their CircleFits and, with
+    # fitEllipse, the outline ellipse for setCircle. The ellipse is fitted to
+    # whatever of the sphere the image region holds.
+    def refineCircle(self, argPoints, image, offset=(0, 0)):
+        points = Geometry.asPointArray(argPoints)
+
+        # The clicks only need to give a rough center for the radials
+        h, k = CircleFitting.fitCircles(points, robust=False).centers[0]
+
+        # Improve the points picked using simple edge detection along the radial of the detected center
+        gray = Geometry.luminance(image)
+        newPoints = Geometry.refineEdgePoints(gray, points - offset, (h - offset[0], k - offset[1]), self.searchRadius) + offset
+
+        fits = CircleFitting.fitCircles(newPoints)
+        record('centerShift', np.hypot(h - fits.centers[0][0], k - fits.centers[0][1]))
+
+        ellipse = None
+        if self.fitEllipse and self.camera is not None:
+            ellipse = EllipseFitting.fitSphereOutline(gray, fits.centers[0], fits.radii[0], self.camera, offset, self.searchRadius)
+        return newPoints, fits, ellipse
+
+    def setCircle(self, points, fits, ellipse=None):
+        self.circlePoints = Geometry.asPointArray(points)
+        self.circleFit = fits.summary()
+        self.radius = fits.radii[0]
+        self.ellipse = ellipse
+        if ellipse is not None:
+            self.center = np.array(ellipse['projectedCenter'])
+        else:
+            self.center = np.array(fits.centers[0], dtype=float)
+
+    def analysisTask(self):
         # For each line group, figure out if each line goes through the center of the circle or close to it.
-        i = 1
-        for lc in self.lineCollections:
-            plainTextEdit.appendPlainText("Line Collection %s" % i)
-            i += 1
-            plainTextEdit.appendPlainText("Minimum distances from each line to the center:")
-            for line in lc.lines:
-                plainTextEdit.appendPlainText("%s" % minDistance(self.center, line))
-
-            if len(lc.intersections) > 2:
-                intersectionPointsAsTuples = [p.toTuple() for p in lc.intersections]
-                mean = QtCore.QPointF(*np.mean(intersectionPointsAsTuples, axis=0))
-                stdDev = QtCore.QPointF(*np.std(intersectionPointsAsTuples, axis=0))
-
-                pointsWithinStdDev = [p for p in lc.intersections if np.linalg.norm((p-mean).toTuple()) <= np.linalg.norm(stdDev.toTuple())]
-                plainTextEdit.appendPlainText("%d out of %d intersections within 1 standard deviation of the mean" % (len(pointsWithinStdDev), len(lc.intersections)))
-
-                clusterCenter = np.mean(pointsWithinStdDev, axis=0)
-                plainTextEdit.appendPlainText("Cluster is at %s, which is %s px away from the circle center" % (clusterCenter.toTuple(), (clusterCenter-self.center).toTuple()))
-
+        return partial(AnalysisResults.sphericalResult, tuple(self.center), self.radius,
+                       [lc.endpoints for lc in self.lineCollections],
+                       [lc.intersectionPoints for lc in self.lineCollections],
+                       self.circlePoints.copy(), self.numSamples,
+                       self.ellipse['rmsError'] if self.ellipse is not None else None)
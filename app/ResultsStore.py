@@ -0,0 +1,231 @@
+'''
+SQLite store of analysis results for a whole corpus.
+
+Each analyzed image gets a row in images with its full result as JSON and the
+fingerprint of its inputs: a hash of the image file, a hash of its annotation
+and the analysis settings, and AnalysisResults.ALGORITHM_VERSION. Re-running a
+batch skips every image whose fingerprint is unchanged, so reprocessing a large
+archive only touches what changed. Images whose size and modification time are
+unchanged keep their stored hash, so unchanged files are not even read.
+
+Per-collection numbers go to the collections table and per-stage timings and
+diagnostics to the diagnostics table, so corpus-level questions are plain SQL:
+
+    SELECT path, collection, offset FROM collections WHERE offset > 5
+
+Results are buffered and written in batches, one transaction per batch.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import AnalysisResults
+
+DEFAULT_FILENAME = 'results.sqlite'
+# results buffered before they are written
+BATCH_SIZE = 100
+HASH_BLOCK = 1 << 20
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    imageHash TEXT,
+    annotationHash TEXT,
+    version INTEGER,
+    mode TEXT,
+    error TEXT,
+    analyzedAt REAL,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS collections (
+    path TEXT,
+    collection INTEGER,
+    numLines INTEGER,
+    meanDistance REAL,
+    maxDistance REAL,
+    numIntersections INTEGER,
+    numInCluster INTEGER,
+    clusterX REAL,
+    clusterY REAL,
+    offsetX REAL,
+    offsetY REAL,
+    offset REAL,
+    clusterSpread REAL,
+    numOutlierLines INTEGER,
+    pValue REAL,
+    vanishingX REAL,
+    vanishingY REAL,
+    rmsDistance REAL,
+    consistent INTEGER,
+    PRIMARY KEY (path, collection)
+);
+CREATE TABLE IF NOT EXISTS diagnostics (
+    path TEXT,
+    kind TEXT,
+    name TEXT,
+    count INTEGER,
+    total REAL,
+    minimum REAL,
+    maximum REAL,
+    PRIMARY KEY (path, kind, name)
+);
+CREATE INDEX IF NOT EXISTS collectionsByOffset ON collections (offset);
+CREATE INDEX IF NOT EXISTS collectionsByMeanDistance ON collections (meanDistance);
+'''
+
+COLLECTION_COLUMNS = ('path', 'collection', 'numLines', 'meanDistance', 'maxDistance', 'numIntersections', 'numInCluster',
+                      'clusterX', 'clusterY', 'offsetX', 'offsetY', 'offset', 'clusterSpread', 'numOutlierLines', 'pValue',
+                      'vanishingX', 'vanishingY', 'rmsDistance', 'consistent')
+
+
+def fileHash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Hash of an annotation together with the settings it is analyzed with
+def annotationHash(annotation, settings):
+    text = json.dumps({'annotation': annotation, 'settings': settings}, sort_keys=True, default=AnalysisResults.jsonDefault)
+    return hashlib.sha1(text).hexdigest()
+
+def _pair(value):
+    return (None, None) if value is None else tuple(value)
+
+# Rows for the collections table from a result dict of either mode
+def _collectionRows(path, result):
+    rows = []
+    for i, c in enumerate(result.get('lineCollections', [])):
+        row = dict.fromkeys(COLLECTION_COLUMNS)
+        row['path'] = path
+        row['collection'] = i + 1
+        if result.get('mode') == 'planar':
+            row['vanishingX'], row['vanishingY'] = _pair(c.get('vanishingPoint'))
+            row['rmsDistance'] = c.get('rmsDistance')
+            row['consistent'] = c.get('consistent')
+        else:
+            distances = c.get('distances', [])
+            row['numLines'] = len(distances)
+            row['meanDistance'] = float(np.mean(distances)) if distances else None
+            row['maxDistance'] = float(np.max(distances)) if distances else None
+            row['numIntersections'] = c.get('numIntersections')
+            row['numInCluster'] = c.get('numInCluster')
+            row['clusterX'], row['clusterY'] = _pair(c.get('clusterCenter'))
+            row['offsetX'], row['offsetY'] = _pair(c.get('clusterOffset'))
+            if row['offsetX'] is not None:
+                row['offset'] = float(np.hypot(row['offsetX'], row['offsetY']))
+                row['clusterSpread'] = c.get('clusterSpread')
+                row['numOutlierLines'] = len(c.get('outlierLines', []))
+            row['pValue'] = c.get('uncertainty', {}).get('pValue')
+        rows.append(tuple(row[column] for column in COLLECTION_COLUMNS))
+    return rows
+
+def _diagnosticRows(path, timings):
+    rows = []
+    for kind in ('stages', 'diagnostics'):
+        for name, stat in timings.get(kind, {}).items():
+            rows.append((path, kind, name, stat['count'], stat['total'], stat['min'], stat['max']))
+    return rows
+
+
+class ResultsStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self._pending = []
+        self._fingerprints = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    @staticmethod
+    def key(imagePath):
+        return os.path.abspath(imagePath)
+
+    # Stored fingerprints by path, read in one query
+    def fingerprints(self):
+        if self._fingerprints is None:
+            rows = self.connection.execute('SELECT path, size, mtime, imageHash, annotationHash, version, error FROM images')
+            self._fingerprints = dict((row[0], row[1:]) for row in rows)
+        return self._fingerprints
+
+    # (size, mtime, hash) of an image file. The stored hash is reused when the
+    # size and modification time match, so unchanged files are not read.
+    def imageFingerprint(self, imagePath):
+        stat = os.stat(imagePath)
+        stored = self.fingerprints().get(self.key(imagePath))
+        if stored is not None and stored[0] == stat.st_size and stored[1] == stat.st_mtime and stored[2]:
+            return stat.st_size, stat.st_mtime, stored[2]
+        return stat.st_size, stat.st_mtime, fileHash(imagePath)
+
+    # Fingerprint of an image's inputs, to be handed back to add()
+    def fingerprint(self, imagePath, annotation, settings):
+        return self.imageFingerprint(imagePath) + (annotationHash(annotation, settings), AnalysisResults.ALGORITHM_VERSION)
+
+    # Whether an image has no stored result for this fingerprint. Failed analyses
+    # are always retried.
+    def isStale(self, imagePath, fingerprint):
+        stored = self.fingerprints().get(self.key(imagePath))
+        return stored is None or stored[5] is not None or stored[2:5] != fingerprint[2:]
+
+    # Buffer a result dict from BatchAnalysis, with its 'timings' if it has them
+    def add(self, result, fingerprint):
+        self._pending.append((dict(result), fingerprint))
+        if len(self._pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        images, collections, diagnostics, paths = [], [], [], []
+        now = time.time()
+        for result, fingerprint in self._pending:
+            path = self.key(result['image'])
+            paths.append((path,))
+            timings = result.get('timings', {})
+            stored = dict((k, v) for k, v in result.items() if k != 'timings')
+            images.append((path,) + tuple(fingerprint) + (result.get('mode'), result.get('error'), now,
+                                                          json.dumps(stored, default=AnalysisResults.jsonDefault)))
+            collections.extend(_collectionRows(path, result))
+            diagnostics.extend(_diagnosticRows(path, timings))
+            if self._fingerprints is not None:
+                self._fingerprints[path] = tuple(fingerprint) + (result.get('error'),)
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM collections WHERE path = ?', paths)
+            self.connection.executemany('DELETE FROM diagnostics WHERE path = ?', paths)
+            self.connection.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', images)
+            self.connection.executemany('INSERT INTO collections VALUES (%s)' % ', '.join('?' * len(COLLECTION_COLUMNS)), collections)
+            self.connection.executemany('INSERT INTO diagnostics VALUES (?, ?, ?, ?, ?, ?, ?)', diagnostics)
+        self._pending = []
+
+    def query(self, sql, parameters=()):
+        self.flush()
+        return self.connection.execute(sql, parameters).fetchall()
+
+    # Stored result dict of an image, or None
+    def result(self, imagePath):
+        rows = self.query('SELECT result FROM images WHERE path = ?', (self.key(imagePath),))
+        return json.loads(rows[0][0]) if rows else None
+
+    # (path, collection, offset) for every spherical collection whose intersection
+    # cluster is more than minOffset pixels from the circle center
+    def offsetsAbove(self, minOffset):
+        return self.query('SELECT path, collection, offset FROM collections WHERE offset > ? ORDER BY offset DESC', (minOffset,))
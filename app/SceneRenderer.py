@@ -0,0 +1,460 @@
+'''
+Ray traced mirror-sphere scenes for ground-truth datasets.
+
+OBJ meshes (by default every .obj under models/) are placed on a checkered
+floor between the camera and a mirror sphere, and the scene is rendered with a
+NumPy ray tracer: primary rays hit the floor, the meshes or the sphere, and rays
+that hit the sphere are reflected once. Triangles are found through a bounding
+volume hierarchy that is traversed for whole batches of rays at a time.
+
+Some objects can be forged: their reflection is rendered from a displaced copy
+of the mesh, as if the reflection had been composited in from another photo.
+
+Every image comes with an annotation in the BatchAnalysis format, so a dataset
+directory can be fed straight to BatchAnalysis: exact points on the sphere's
+outline and, for every object, lines joining visible mesh vertices to where the
+vertices appear in the sphere (computed with SphereReflection). The annotation
+also records which collections are forged and the scene's geometry.
+
+Scenes are rendered in parallel, one process per scene at a time.
+
+Usage: python SceneRenderer.py OUTPUT_DIR [-n NUM_SCENES] [-j PROCESSES] [--size WIDTHxHEIGHT] [--forged FRACTION] [--models DIR]
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+import SphereReflection
+from Instrumentation import instrument
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'models')
+LEAF_SIZE = 8
+# rays traced together; bounds the memory of the traversal
+RAY_BATCH = 16384
+EPSILON = 1e-6
+LIGHT = np.array([-0.4, -0.8, -0.45]) / np.sqrt(0.4**2 + 0.8**2 + 0.45**2)
+AMBIENT = 0.25
+MIRROR_REFLECTANCE = 0.9
+# mesh vertices tested for visibility when choosing annotated lines
+CANDIDATE_VERTICES = 1000
+
+
+# Vertices (n, 3) and triangles (m, 3) of an OBJ file. Polygons are split into fans.
+def loadObj(path):
+    vertices = []
+    triangles = []
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == 'v':
+                vertices.append([float(v) for v in parts[1:4]])
+            elif parts[0] == 'f':
+                # v, v/vt, v//vn or v/vt/vn; negative indices count from the end
+                face = [int(p.split('/')[0]) for p in parts[1:]]
+                face = [idx - 1 if idx > 0 else len(vertices) + idx for idx in face]
+                triangles.extend([face[0], face[i], face[i+1]] for i in xrange(1, len(face) - 1))
+    return np.array(vertices, dtype=float).reshape(-1, 3), np.array(triangles, dtype=int).reshape(-1, 3)
+
+def findModels(modelsDir=MODELS_DIR):
+    paths = []
+    for root, dirs, files in os.walk(modelsDir):
+        paths.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith('.obj'))
+    return sorted(paths)
+
+
+class Mesh(object):
+
+    def __init__(self, vertices, triangles):
+        self.vertices = vertices
+        self.triangles = triangles
+
+    @classmethod
+    def load(cls, path):
+        return cls(*loadObj(path))
+
+    # Copy scaled to the given height, turned by angle radians about the vertical axis,
+    # and moved so its base is centered at position. Image y points down, so the base
+    # is the largest y.
+    def placed(self, position, height, angle):
+        v = self.vertices - (self.vertices.min(axis=0) + self.vertices.max(axis=0)) / 2
+        # OBJ models are y-up, the camera is y-down
+        v[:, 1] = -v[:, 1]
+        v *= height / max(np.ptp(v[:, 1]), EPSILON)
+        c, s = np.cos(angle), np.sin(angle)
+        v = np.column_stack((c * v[:, 0] + s * v[:, 2], v[:, 1], -s * v[:, 0] + c * v[:, 2]))
+        v += np.asarray(position, dtype=float) - [0, v[:, 1].max(), 0]
+        return Mesh(v, self.triangles)
+
+
+class Bvh(object):
+    '''
+    Bounding volume hierarchy over the triangles of several meshes.
+
+    Nodes are stored in flat arrays. Traversal is breadth first over (ray, node)
+    pairs, so every step is a handful of array operations for all rays at once,
+    and pairs whose box lies beyond the ray's closest hit so far are dropped.
+    '''
+
+    def __init__(self, meshes, leafSize=LEAF_SIZE):
+        v0, v1, v2, ids = [], [], [], []
+        for meshId, mesh in enumerate(meshes):
+            tri = mesh.vertices[mesh.triangles]
+            v0.append(tri[:, 0])
+            v1.append(tri[:, 1])
+            v2.append(tri[:, 2])
+            ids.append(np.full(len(tri), meshId, dtype=int))
+        self.v0 = np.vstack(v0) if v0 else np.empty((0, 3))
+        self.edge1 = (np.vstack(v1) if v1 else np.empty((0, 3))) - self.v0
+        self.edge2 = (np.vstack(v2) if v2 else np.empty((0, 3))) - self.v0
+        self.meshIds = np.concatenate(ids) if ids else np.empty(0, dtype=int)
+        normals = np.cross(self.edge1, self.edge2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.normals = np.nan_to_num(normals / np.sqrt((normals**2).sum(axis=1))[:, None])
+
+        self._triMin = np.minimum(np.minimum(self.v0, self.v0 + self.edge1), self.v0 + self.edge2)
+        self._triMax = np.maximum(np.maximum(self.v0, self.v0 + self.edge1), self.v0 + self.edge2)
+        self._centroids = self.v0 + (self.edge1 + self.edge2) / 3
+        self.order = np.arange(len(self.v0))
+        self.leafSize = leafSize
+        self._nodes = []
+        if len(self.v0):
+            self._build(0, len(self.v0))
+        nodes = np.array(self._nodes, dtype=float).reshape(-1, 10)
+        self.nodeMin = nodes[:, 0:3]
+        self.nodeMax = nodes[:, 3:6]
+        self.left = nodes[:, 6].astype(int)
+        self.right = nodes[:, 7].astype(int)
+        self.leafStart = nodes[:, 8].astype(int)
+        self.leafCount = nodes[:, 9].astype(int)
+        del self._nodes, self._triMin, self._triMax, self._centroids
+
+    def _build(self, start, end):
+        idx = self.order[start:end]
+        nodeIdx = len(self._nodes)
+        self._nodes.append(None)
+        boxMin = self._triMin[idx].min(axis=0)
+        boxMax = self._triMax[idx].max(axis=0)
+        centroids = self._centroids[idx]
+        extent = np.ptp(centroids, axis=0)
+
+        if end - start <= self.leafSize or extent.max() == 0:
+            self._nodes[nodeIdx] = list(boxMin) + list(boxMax) + [-1, -1, start, end - start]
+            return nodeIdx
+
+        # split at the median along the longest axis of the centroids
+        self.order[start:end] = idx[np.argsort(centroids[:, np.argmax(extent)], kind='mergesort')]
+        mid = start + (end - start) // 2
+        left = self._build(start, mid)
+        right = self._build(mid, end)
+        self._nodes[nodeIdx] = list(boxMin) + list(boxMax) + [left, right, 0, 0]
+        return nodeIdx
+
+    # Moller-Trumbore for pairs of rays and triangles
+    def _intersectTriangles(self, origins, directions, tri):
+        pvec = np.cross(directions, self.edge2[tri])
+        det = (self.edge1[tri] * pvec).sum(axis=1)
+        tvec = origins - self.v0[tri]
+        qvec = np.cross(tvec, self.edge1[tri])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            inverse = 1.0 / det
+            u = (tvec * pvec).sum(axis=1) * inverse
+            v = (directions * qvec).sum(axis=1) * inverse
+            t = (self.edge2[tri] * qvec).sum(axis=1) * inverse
+            hit = (np.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > EPSILON)
+        return np.where(hit, t, np.inf)
+
+    # Closest hit distance along each ray, no farther than tMax, and the triangle
+    # hit (-1 for none). directions must be unit vectors.
+    def intersect(self, origins, directions, tMax):
+        best = np.array(tMax, dtype=float)
+        hitTri = np.full(len(origins), -1, dtype=int)
+        if not len(self.nodeMin):
+            return best, hitTri
+
+        safe = np.where(np.abs(directions) < 1e-12, 1e-12, directions)
+        inverse = 1.0 / safe
+        rays = np.arange(len(origins))
+        nodes = np.zeros(len(origins), dtype=int)
+        while len(rays):
+            t1 = (self.nodeMin[nodes] - origins[rays]) * inverse[rays]
+            t2 = (self.nodeMax[nodes] - origins[rays]) * inverse[rays]
+            tNear = np.minimum(t1, t2).max(axis=1)
+            tFar = np.maximum(t1, t2).min(axis=1)
+            keep = (tFar >= np.maximum(tNear, 0)) & (tNear < best[rays])
+            rays, nodes = rays[keep], nodes[keep]
+
+            leaf = self.left[nodes] < 0
+            leafRays, leafNodes = rays[leaf], nodes[leaf]
+            if len(leafRays):
+                counts = self.leafCount[leafNodes]
+                pairRays = np.repeat(leafRays, counts)
+                firsts = np.repeat(self.leafStart[leafNodes], counts)
+                within = np.arange(len(pairRays)) - np.repeat(np.cumsum(counts) - counts, counts)
+                tri = self.order[firsts + within]
+                t = self._intersectTriangles(origins[pairRays], directions[pairRays], tri)
+                np.minimum.at(best, pairRays, t)
+                closest = (t == best[pairRays]) & np.isfinite(t)
+                hitTri[pairRays[closest]] = tri[closest]
+
+            inner = ~leaf
+            rays = np.concatenate((rays[inner], rays[inner]))
+            nodes = np.concatenate((self.left[nodes[inner]], self.right[nodes[inner]]))
+        hitTri[~np.isfinite(best) | (best >= tMax)] = -1
+        return best, hitTri
+
+
+class Scene(object):
+    '''
+    Camera at the origin looking down +z, y down. The sphere rests on the floor,
+    the plane y = floorY, and the meshes stand on it too.
+
+    meshes           meshes seen directly
+    reflectedMeshes  meshes seen in the sphere; a forged object's copy is displaced
+    colors           (k, 3) BGR albedo per mesh
+    '''
+
+    def __init__(self, camera, width, height, sphereCenter, sphereRadius, meshes, reflectedMeshes, colors, forged):
+        self.camera = camera
+        self.width = width
+        self.height = height
+        self.sphereCenter = np.asarray(sphereCenter, dtype=float)
+        self.sphereRadius = float(sphereRadius)
+        self.floorY = self.sphereCenter[1] + self.sphereRadius
+        self.meshes = meshes
+        self.reflectedMeshes = reflectedMeshes
+        self.colors = np.asarray(colors, dtype=float)
+        self.forged = np.asarray(forged, dtype=bool)
+        self.bvh = Bvh(meshes)
+        self.reflectedBvh = Bvh(reflectedMeshes) if self.forged.any() else self.bvh
+
+    def _sphereHits(self, origins, directions):
+        oc = origins - self.sphereCenter
+        b = (oc * directions).sum(axis=1)
+        c = (oc**2).sum(axis=1) - self.sphereRadius**2
+        disc = b**2 - c
+        with np.errstate(invalid='ignore'):
+            t = -b - np.sqrt(disc)
+            return np.where((disc >= 0) & (t > EPSILON), t, np.inf)
+
+    def _floorHits(self, origins, directions):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = (self.floorY - origins[:, 1]) / directions[:, 1]
+            return np.where(t > EPSILON, t, np.inf)
+
+    def _floorColor(self, points):
+        checker = (np.floor(points[:, 0] * 2) + np.floor(points[:, 2] * 2)) % 2
+        return np.where(checker[:, None] > 0, [170.0, 170.0, 165.0], [70.0, 75.0, 80.0])
+
+    def _skyColor(self, directions):
+        up = np.clip(-directions[:, 1], 0, 1)[:, None]
+        return (1 - up) * [235.0, 215.0, 200.0] + up * [200.0, 140.0, 90.0]
+
+    def _shade(self, bvh, origins, directions, t, tri):
+        points = origins + t[:, None] * directions
+        normals = bvh.normals[tri]
+        normals *= -np.sign((normals * directions).sum(axis=1))[:, None]
+        light = AMBIENT + (1 - AMBIENT) * np.clip(-(normals * LIGHT).sum(axis=1), 0, 1)
+        return self.colors[bvh.meshIds[tri]] * light[:, None]
+
+    # Color of each ray; withSphere is off for rays already reflected by the sphere
+    def trace(self, origins, directions, withSphere=True):
+        bvh = self.bvh if withSphere else self.reflectedBvh
+        color = self._skyColor(directions)
+
+        floorT = self._floorHits(origins, directions)
+        sphereT = self._sphereHits(origins, directions) if withSphere else np.full(len(origins), np.inf)
+        meshT, tri = bvh.intersect(origins, directions, np.minimum(floorT, sphereT))
+
+        onFloor = np.isfinite(floorT) & (floorT <= sphereT) & (tri < 0)
+        color[onFloor] = self._floorColor(origins[onFloor] + floorT[onFloor, None] * directions[onFloor])
+        onMesh = tri >= 0
+        color[onMesh] = self._shade(bvh, origins[onMesh], directions[onMesh], meshT[onMesh], tri[onMesh])
+
+        onSphere = np.isfinite(sphereT) & (sphereT < floorT) & (tri < 0)
+        if onSphere.any():
+            points = origins[onSphere] + sphereT[onSphere, None] * directions[onSphere]
+            normals = (points - self.sphereCenter) / self.sphereRadius
+            d = directions[onSphere]
+            reflected = d - 2 * (d * normals).sum(axis=1)[:, None] * normals
+            color[onSphere] = MIRROR_REFLECTANCE * self.trace(points, reflected, False)
+        return color
+
+    # BGR uint8 image; supersample rays per pixel side are averaged for anti-aliasing
+    @instrument('render')
+    def render(self, supersample=1):
+        offsets = (np.arange(supersample) + 0.5) / supersample - 0.5
+        ys, xs = np.mgrid[0:self.height, 0:self.width]
+        pixels = np.column_stack((xs.ravel(), ys.ravel())).astype(float)
+        image = np.zeros((len(pixels), 3))
+        origins = np.zeros((RAY_BATCH, 3))
+        for dy in offsets:
+            for dx in offsets:
+                directions = self.camera.rays(pixels + [dx, dy])
+                for start in xrange(0, len(pixels), RAY_BATCH):
+                    stop = min(len(pixels), start + RAY_BATCH)
+                    image[start:stop] += self.trace(origins[:stop-start], directions[start:stop])
+        image /= supersample**2
+        return np.clip(image, 0, 255).astype(np.uint8).reshape(self.height, self.width, 3)
+
+    # Points on the sphere's outline in the image: the projection of the circle where
+    # the rays from the camera graze the sphere
+    def outlinePoints(self, numPoints=32):
+        return SphereReflection.sphereOutline(self.camera, self.sphereCenter, self.sphereRadius, numPoints)
+
+    def _inFrame(self, pixels):
+        return (pixels[:, 0] >= 0) & (pixels[:, 0] < self.width) & (pixels[:, 1] >= 0) & (pixels[:, 1] < self.height)
+
+    # Lines from visible vertices of each mesh to their visible reflections, at most
+    # linesPerObject per mesh, spread over the mesh by random choice
+    def correspondences(self, linesPerObject, randomState, minLength=3.0):
+        lineSets = []
+        for mesh, reflectedMesh in zip(self.meshes, self.reflectedMeshes):
+            vertices = mesh.vertices
+            if len(vertices) > CANDIDATE_VERTICES:
+                chosen = randomState.choice(len(vertices), CANDIDATE_VERTICES, replace=False)
+                vertices, reflectedVertices = vertices[chosen], reflectedMesh.vertices[chosen]
+            else:
+                reflectedVertices = reflectedMesh.vertices
+
+            # seen directly: nothing closer along the ray through the vertex
+            distance = np.sqrt((vertices**2).sum(axis=1))
+            directions = vertices / distance[:, None]
+            origins = np.zeros_like(vertices)
+            blockers = np.minimum(self._sphereHits(origins, directions), self._floorHits(origins, directions))
+            hitT, _ = self.bvh.intersect(origins, directions, distance * (1 + 1e-4))
+            direct = np.minimum(hitT, blockers) >= distance * (1 - 1e-4)
+
+            # seen in the sphere: nothing between the reflection point and the vertex
+            points, reflectable = SphereReflection.reflectionPoints(self.sphereCenter, self.sphereRadius, reflectedVertices)
+            toVertex = reflectedVertices - points
+            span = np.sqrt((toVertex**2).sum(axis=1))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                directions = toVertex / span[:, None]
+            reflectedT, _ = self.reflectedBvh.intersect(points, directions, span * (1 + 1e-4))
+            mirrored = reflectable & (np.minimum(reflectedT, self._floorHits(points, directions)) >= span * (1 - 1e-4))
+            # and nothing between the camera and the reflection point
+            pointDistance = np.sqrt((points**2).sum(axis=1))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                directions = points / pointDistance[:, None]
+            pointT, _ = self.bvh.intersect(np.zeros_like(points), directions, pointDistance * (1 - 1e-4))
+            mirrored &= pointT >= pointDistance * (1 - 1e-4)
+
+            objectPixels = self.camera.project(vertices)
+            reflectionPixels = self.camera.project(points)
+            lines = np.hstack((objectPixels, reflectionPixels))
+            usable = (direct & mirrored & self._inFrame(objectPixels) & self._inFrame(reflectionPixels)
+                      & (np.hypot(lines[:, 2] - lines[:, 0], lines[:, 3] - lines[:, 1]) >= minLength))
+            candidates = np.flatnonzero(usable)
+            if len(candidates) > linesPerObject:
+                candidates = randomState.choice(candidates, linesPerObject, replace=False)
+            lineSets.append(lines[candidates])
+        return lineSets
+
+
+# Random scene: the sphere on the floor ahead of the camera and the meshes on the
+# floor between them, off to the sides so they do not hide the sphere
+def randomScene(models, width=640, height=480, numObjects=3, forgedFraction=0.5, forgeryOffset=1.0, seed=0):
+    randomState = np.random.RandomState(seed)
+    camera = SphereReflection.Camera.fromFieldOfView(width, height, randomState.uniform(45, 65))
+    sphereRadius = 1.0
+    sphereCenter = np.array([randomState.uniform(-0.8, 0.8), randomState.uniform(0.8, 1.6), randomState.uniform(7, 10)])
+    floorY = sphereCenter[1] + sphereRadius
+
+    meshes, reflectedMeshes, colors = [], [], []
+    forged = np.zeros(numObjects, dtype=bool)
+    forged[randomState.permutation(numObjects)[:int(round(numObjects * forgedFraction))]] = True
+    sides = randomState.permutation([-1, 1] * numObjects)[:numObjects]
+    for i in xrange(numObjects):
+        z = sphereCenter[2] - randomState.uniform(2.5, 4.5)
+        x = sphereCenter[0] + sides[i] * randomState.uniform(1.4, 2.6) * z / sphereCenter[2]
+        mesh = models[randomState.randint(len(models))].placed((x, floorY, z), randomState.uniform(0.8, 1.5), randomState.uniform(0, 2 * np.pi))
+        meshes.append(mesh)
+        if forged[i]:
+            angle = randomState.uniform(0, 2 * np.pi)
+            offset = forgeryOffset * np.array([np.cos(angle), 0, np.sin(angle)])
+            reflectedMeshes.append(Mesh(mesh.vertices + offset, mesh.triangles))
+        else:
+            reflectedMeshes.append(mesh)
+        colors.append(randomState.uniform(60, 230, 3))
+    return Scene(camera, width, height, sphereCenter, sphereRadius, meshes, reflectedMeshes, colors, forged)
+
+# Annotation in the BatchAnalysis format plus the ground truth
+def sceneAnnotation(scene, linesPerObject=20, seed=0):
+    randomState = np.random.RandomState(seed)
+    return {
+        'mode': 'spherical',
+        'circlePoints': scene.outlinePoints().tolist(),
+        'lineCollections': [lines.tolist() for lines in scene.correspondences(linesPerObject, randomState)],
+        'forged': scene.forged.tolist(),
+        'sphereCenter': scene.sphereCenter.tolist(),
+        'sphereRadius': scene.sphereRadius,
+        'focalLength': scene.camera.focalLength,
+        'principalPoint': scene.camera.principalPoint.tolist(),
+    }
+
+
+# Meshes are loaded once per worker process
+_models = None
+
+def _loadModels(paths):
+    global _models
+    _models = [Mesh.load(path) for path in paths]
+
+def _renderScene(job):
+    import cv2
+    index, outputDir, options = job
+    seed = options['seed'] + index
+    scene = randomScene(_models, options['width'], options['height'], options['numObjects'], options['forgedFraction'], seed=seed)
+    imagePath = os.path.join(outputDir, "scene_%05d.png" % index)
+    cv2.imwrite(imagePath, scene.render(options['supersample']))
+    with open(imagePath + '.json', 'w') as f:
+        json.dump(sceneAnnotation(scene, options['linesPerObject'], seed), f)
+    return imagePath
+
+def renderDataset(outputDir, numScenes, processes=None, modelPaths=None, start=0, **options):
+    settings = {'width': 640, 'height': 480, 'numObjects': 3, 'forgedFraction': 0.5,
+                'linesPerObject': 20, 'supersample': 1, 'seed': 0}
+    settings.update(options)
+    modelPaths = modelPaths or findModels()
+    if not modelPaths:
+        raise IOError("No OBJ models found")
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+
+    jobs = [(index, outputDir, settings) for index in xrange(start, start + numScenes)]
+    pool = multiprocessing.Pool(processes, initializer=_loadModels, initargs=(modelPaths,))
+    try:
+        for done, imagePath in enumerate(pool.imap_unordered(_renderScene, jobs), 1):
+            print "%d/%d %s" % (done, numScenes, imagePath)
+    finally:
+        pool.close()
+        pool.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Render mirror-sphere scenes with ground-truth annotations.")
+    parser.add_argument('outputDir', help="directory for the images and their annotations")
+    parser.add_argument('-n', '--scenes', dest='numScenes', type=int, default=10)
+    parser.add_argument('-j', '--processes', type=int, default=None, help="number of worker processes (default: number of cores)")
+    parser.add_argument('--start', type=int, default=0, help="index of the first scene, to extend an existing dataset")
+    parser.add_argument('--size', default='640x480', help="image size as WIDTHxHEIGHT (default: 640x480)")
+    parser.add_argument('--objects', dest='numObjects', type=int, default=3, help="objects per scene (default: 3)")
+    parser.add_argument('--forged', dest='forgedFraction', type=float, default=0.5, help="fraction of objects with a forged reflection (default: 0.5)")
+    parser.add_argument('--lines', dest='linesPerObject', type=int, default=20, help="annotated lines per object (default: 20)")
+    parser.add_argument('--supersample', type=int, default=1, help="rays per pixel side (default: 1)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--models', dest='modelsDir', default=MODELS_DIR, help="directory searched for OBJ models")
+    args = parser.parse_args()
+
+    width, height = [int(v) for v in args.size.lower().split('x')]
+    renderDataset(args.outputDir, args.numScenes, args.processes, findModels(args.modelsDir), args.start,
+                  width=width, height=height, numObjects=args.numObjects, forgedFraction=args.forgedFraction,
+                  linesPerObject=args.linesPerObject, supersample=args.supersample, seed=args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+Automatic sphere detection.
+
+Candidate circles are proposed with a Hough transform on a small downsampled
+copy of the image, then each candidate is refined at full resolution inside a
+small region around it: contour points are sampled on the candidate circle,
+moved onto the image edges with Geometry.refineEdgePoints and refitted with
+CircleFitting.fitCircles, the same steps SphericalAnalysis.addCircle uses.
+A proposal from an image downsampled by some scale can be off by that many
+full resolution pixels, so the edge search starts scale times wider and is
+halved on every pass until it is back to searchRadius.
+'''
+
+import numpy as np
+
+import Geometry
+import CircleFitting
+
+WORKING_SIZE = 512
+
+
+class DetectedCircle(object):
+
+    def __init__(self, center, radius, points, rmsError):
+        self.center = center
+        self.radius = radius
+        self.points = points
+        self.rmsError = rmsError
+
+    def __repr__(self):
+        return "DetectedCircle(center=(%.2f, %.2f), radius=%.2f, rmsError=%.3f)" % (self.center[0], self.center[1], self.radius, self.rmsError)
+
+def _houghMethod(cv2):
+    if hasattr(cv2, 'HOUGH_GRADIENT'):
+        return cv2.HOUGH_GRADIENT
+    return cv2.cv.CV_HOUGH_GRADIENT
+
+# Propose circles on a small grayscale image. scale converts its coordinates to
+# full resolution. Returns up to maxCandidates (x, y, r) tuples, strongest first.
+def proposeCircles(smallGray, scale=1.0, maxCandidates=3, minRadiusFraction=0.03, maxRadiusFraction=0.5):
+    import cv2
+    smallGray = cv2.GaussianBlur(np.clip(smallGray, 0, 255).astype(np.uint8), (5, 5), 1.5)
+    size = max(smallGray.shape)
+    circles = cv2.HoughCircles(smallGray, _houghMethod(cv2), 1, max(8, size // 8),
+                               param1=100, param2=30,
+                               minRadius=max(3, int(size * minRadiusFraction)),
+                               maxRadius=int(size * maxRadiusFraction))
+    if circles is None:
+        return []
+    return [(x * scale, y * scale, r * scale) for x, y, r in circles.reshape(-1, 3)[:maxCandidates]]
+
+# Points evenly spaced around a circle
+def circlePoints(center, radius, numPoints):
+    angles = np.linspace(0, 2 * np.pi, numPoints, endpoint=False)
+    return np.column_stack((center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles)))
+
+# Edge search radius of each refinement pass: halving from searchRadius * scale,
+# then iterations passes at searchRadius
+def searchSchedule(searchRadius, scale=1.0, iterations=2):
+    radii = []
+    radius = searchRadius * max(1.0, scale)
+    while radius > searchRadius:
+        radii.append(radius)
+        radius /= 2.0
+    return radii + [searchRadius] * iterations
+
+# Refine a proposed circle at full resolution. readRegion(x0, y0, x1, y1) returns the
+# luminance of that rectangle and the image coordinates of its top left corner, so
+# only the neighbourhood of the circle is ever read. scale is the downsampling of the
+# image the circle was proposed on.
+def refineCircle(readRegion, circle, numPoints=64, searchRadius=5, iterations=2, scale=1.0):
+    x, y, r = circle
+    searchRadii = searchSchedule(searchRadius, scale, iterations)
+    margin = int(np.ceil(searchRadii[0])) + 2
+    gray, offset = readRegion(x - r - margin, y - r - margin, x + r + margin + 1, y + r + margin + 1)
+    offset = np.asarray(offset, dtype=float)
+
+    center = np.array([x, y], dtype=float)
+    radius = r
+    points = circlePoints(center, radius, numPoints)
+    for window in searchRadii:
+        points = Geometry.refineEdgePoints(gray, points - offset, center - offset, window) + offset
+        fit = CircleFitting.fitCircles(points)
+        center = fit.centers[0]
+        radius = fit.radii[0]
+
+    # Edge hits that are not on the sphere are left out of the contour
+    points = points[fit.inliers[0]]
+    return DetectedCircle((center[0], center[1]), radius, points, fit.rmsError[0])
+
+# Detect spheres in a full resolution luminance array. Returns DetectedCircles, best fit first.
+def detectSpheres(gray, maxCandidates=3, numPoints=64, searchRadius=5, workingSize=WORKING_SIZE):
+    import cv2
+    height, width = gray.shape
+    scale = max(1.0, max(width, height) / float(workingSize))
+    smallGray = cv2.resize(gray, (max(1, int(round(width / scale))), max(1, int(round(height / scale)))), interpolation=cv2.INTER_AREA)
+
+    def readRegion(x0, y0, x1, y1):
+        x0, y0 = max(0, int(x0)), max(0, int(y0))
+        return gray[y0:max(y0, int(y1)), x0:max(x0, int(x1))], (x0, y0)
+
+    detected = [refineCircle(readRegion, circle, numPoints, searchRadius, scale=scale) for circle in proposeCircles(smallGray, scale, maxCandidates)]
+    detected.sort(key=lambda c: c.rmsError / max(c.radius, 1))
+    return detected
@@ -0,0 +1,161 @@
+'''
+Forward model of reflections in a mirror sphere.
+
+The camera is a pinhole at the origin looking down +z, with the image's x and y
+axes. For a sphere of known center and radius and a batch of 3D scene points,
+reflectionPoints finds where on the sphere each point is seen reflected
+(Alhazen's problem). Each problem lies in the plane through the camera, the
+sphere center and the scene point, where the reflection point is an angle on
+the great circle between the directions of the camera and of the scene point.
+All points are solved together by safeguarded Newton iterations on that angle:
+Newton steps that leave the bracket known to hold the root fall back to
+bisection, so every point converges.
+
+sphereFromCircle places a sphere of a chosen radius in front of the camera from
+its circle in the image, and predictReflections projects the reflections back
+to pixels, so predicted and observed correspondences can be compared directly.
+'''
+
+import numpy as np
+
+from Instrumentation import instrument
+
+ITERATIONS = 40
+TOLERANCE = 1e-12
+
+
+class Camera(object):
+
+    def __init__(self, focalLength, principalPoint):
+        self.focalLength = float(focalLength)
+        self.principalPoint = np.asarray(principalPoint, dtype=float)
+
+    # Camera with a horizontal field of view of fov degrees for an image of the given size
+    @classmethod
+    def fromFieldOfView(cls, width, height, fov=60.0):
+        return cls(width / (2 * np.tan(np.radians(fov) / 2)), ((width - 1) / 2.0, (height - 1) / 2.0))
+
+    # Pixel coordinates (n, 2) of 3D points (n, 3)
+    def project(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.focalLength * points[:, :2] / points[:, 2, None] + self.principalPoint
+
+    # Unit ray directions (n, 3) through pixels (n, 2)
+    def rays(self, pixels):
+        pixels = np.asarray(pixels, dtype=float).reshape(-1, 2)
+        directions = np.column_stack((pixels - self.principalPoint, np.full(len(pixels), self.focalLength)))
+        return directions / np.sqrt((directions**2).sum(axis=1))[:, None]
+
+    # 3D points at the given distances from the camera along the rays through pixels
+    def backproject(self, pixels, distances):
+        return self.rays(pixels) * np.asarray(distances, dtype=float).reshape(-1, 1)
+
+
+# 3D center of a sphere of radius sphereRadius whose outline in the image is the
+# circle (center, radius). Perspective turns the outline into an ellipse, so the
+# center is taken on the bisector of the rays to the outline's nearest and
+# farthest points from the principal point, at the distance that gives the
+# sphere the angle those rays span.
+def sphereFromCircle(camera, center, radius, sphereRadius=1.0):
+    center = np.asarray(center, dtype=float)
+    radial = center - camera.principalPoint
+    length = np.hypot(*radial)
+    direction = radial / length if length > 0 else np.array([1.0, 0.0])
+    near, far = camera.rays(np.array([center - radius * direction, center + radius * direction]))
+
+    halfAngle = np.arccos(np.clip(np.dot(near, far), -1, 1)) / 2
+    axis = (near + far) / np.sqrt(((near + far)**2).sum())
+    return axis * sphereRadius / np.sin(halfAngle)
+
+# Pixels of numPoints points evenly spaced around the exact outline of a sphere:
+# the circle where the cone of rays grazing the sphere touches it
+def sphereOutline(camera, sphereCenter, sphereRadius, numPoints=32):
+    sphereCenter = np.asarray(sphereCenter, dtype=float)
+    distance = np.sqrt((sphereCenter**2).sum())
+    axis = sphereCenter / distance
+    u = np.cross(axis, [0, 1, 0])
+    u /= np.sqrt((u**2).sum())
+    v = np.cross(axis, u)
+    r = float(sphereRadius)
+    angles = np.linspace(0, 2 * np.pi, numPoints, endpoint=False)
+    ring = (sphereCenter - axis * r * r / distance
+            + r * np.sqrt(1 - (r / distance)**2) * (np.cos(angles)[:, None] * u + np.sin(angles)[:, None] * v))
+    return camera.project(ring)
+
+# In plane coordinates the camera is at (cameraDistance, 0) and the scene point at
+# (px, py) with py >= 0, both relative to the sphere center. At the reflection point
+# R (cos t, sin t) the normal makes equal angles with the directions to the two,
+# so the sum of the sines of those angles, returned here, is zero.
+def _balance(t, cameraDistance, px, py, radius):
+    sx, sy = radius * np.cos(t), radius * np.sin(t)
+    nx, ny = np.cos(t), np.sin(t)
+    cx, cy = cameraDistance - sx, -sy
+    qx, qy = px - sx, py - sy
+    return (nx * cy - ny * cx) / np.hypot(cx, cy) + (nx * qy - ny * qx) / np.hypot(qx, qy)
+
+# Reflection points (n, 3) on the sphere of the scene points (n, 3) as seen from the
+# camera at the origin, and a mask of the points that have a visible reflection:
+# outside the sphere and not hidden right behind it.
+@instrument('reflect')
+def reflectionPoints(sphereCenter, sphereRadius, scenePoints, iterations=ITERATIONS):
+    sphereCenter = np.asarray(sphereCenter, dtype=float)
+    scenePoints = np.asarray(scenePoints, dtype=float).reshape(-1, 3)
+
+    toCamera = -sphereCenter
+    cameraDistance = np.sqrt((toCamera**2).sum())
+    e1 = toCamera / cameraDistance
+    toPoint = scenePoints - sphereCenter
+    px = toPoint.dot(e1)
+    perpendicular = toPoint - px[:, None] * e1
+    py = np.sqrt((perpendicular**2).sum(axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        e2 = perpendicular / py[:, None]
+    # points on the axis through the camera reflect at the point nearest the camera
+    e2[py == 0] = 0
+
+    # The root lies between the direction of the camera (t = 0) and of the point
+    low = np.zeros(len(scenePoints))
+    high = np.arctan2(py, px)
+    f = lambda t: _balance(t, cameraDistance, px, py, sphereRadius)
+    t = high / 2
+    fLow = f(low)
+    for i in xrange(iterations):
+        value = f(t)
+        # keep the root bracketed
+        sameAsLow = np.sign(value) == np.sign(fLow)
+        low = np.where(sameAsLow, t, low)
+        fLow = np.where(sameAsLow, value, fLow)
+        high = np.where(sameAsLow, high, t)
+
+        step = 1e-7
+        derivative = (f(t + step) - f(t - step)) / (2 * step)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            newton = t - value / derivative
+        inside = np.isfinite(newton) & (newton > low) & (newton < high)
+        nextT = np.where(inside, newton, (low + high) / 2)
+        done = np.abs(nextT - t) < TOLERANCE
+        t = nextT
+        if done.all():
+            break
+
+    points = sphereCenter + sphereRadius * (np.cos(t)[:, None] * e1 + np.sin(t)[:, None] * e2)
+    outside = (toPoint**2).sum(axis=1) > sphereRadius**2
+    # visible from the camera: the camera is on the outer side of the tangent plane
+    visible = cameraDistance * np.cos(t) > sphereRadius
+    # and the scene point is too
+    facing = (px * np.cos(t) + py * np.sin(t)) > sphereRadius
+    return points, outside & visible & facing
+
+# Pixel positions of the reflections of scene points, with the mask from reflectionPoints
+def predictReflections(camera, sphereCenter, sphereRadius, scenePoints):
+    points, valid = reflectionPoints(sphereCenter, sphereRadius, scenePoints)
+    return camera.project(points), valid
+
+# Distances in pixels between predicted and observed reflections (n, 2); nan where
+# the point has no visible reflection
+def reflectionResiduals(camera, sphereCenter, sphereRadius, scenePoints, observed):
+    predicted, valid = predictReflections(camera, sphereCenter, sphereRadius, scenePoints)
+    residuals = np.hypot(*(predicted - np.asarray(observed, dtype=float).reshape(-1, 2)).T)
+    residuals[~valid] = np.nan
+    return residuals
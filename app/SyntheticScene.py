@@ -0,0 +1,83 @@
+'''
+Synthetic mirror-sphere scenes with known ground truth.
+
+A scene is a bright disc (the sphere) on a darker background, a set of noisy
+"clicked" points on its outline and line collections joining objects to their
+reflections. Genuine collections pass through the sphere's center; forged ones
+pass through a point offset from it, as a pasted-in reflection would. Nothing
+here imports Qt.
+'''
+
+import numpy as np
+
+# rows generated at a time when rendering, to keep 100 MP images within memory
+RENDER_BLOCK_ROWS = 1024
+
+
+class SyntheticScene(object):
+
+    def __init__(self, width, height, center, radius, circlePoints, lineSets, forged, targets, seed):
+        self.width = width
+        self.height = height
+        self.center = center
+        self.radius = radius
+        self.circlePoints = circlePoints
+        self.lineSets = lineSets
+        self.forged = forged
+        self.targets = targets
+        self.seed = seed
+
+    def annotation(self):
+        return {'mode': 'spherical', 'circlePoints': self.circlePoints, 'lineCollections': self.lineSets}
+
+    # Luminance image of the scene as float32: an anti-aliased disc plus Gaussian noise
+    def render(self, background=40.0, foreground=200.0, noise=4.0):
+        randomState = np.random.RandomState(self.seed + 1)
+        gray = np.empty((self.height, self.width), dtype=np.float32)
+        xs = np.arange(self.width, dtype=np.float32) - np.float32(self.center[0])
+        for top in xrange(0, self.height, RENDER_BLOCK_ROWS):
+            bottom = min(self.height, top + RENDER_BLOCK_ROWS)
+            ys = np.arange(top, bottom, dtype=np.float32)[:, None] - np.float32(self.center[1])
+            coverage = np.clip(np.float32(self.radius + 0.5) - np.sqrt(xs**2 + ys**2), 0, 1)
+            block = background + (foreground - background) * coverage
+            if noise:
+                block += randomState.standard_normal(block.shape).astype(np.float32) * noise
+            gray[top:bottom] = block
+        return gray
+
+# Lines through target with perpendicular endpoint noise, spread in direction and
+# placed between 0.2 and 1.5 radii from the target on either side
+def _linesThrough(target, radius, numLines, noise, randomState):
+    angles = randomState.uniform(0, np.pi, numLines)
+    direction = np.column_stack((np.cos(angles), np.sin(angles)))
+    near = randomState.uniform(0.2, 1.5, numLines) * radius
+    far = -randomState.uniform(0.2, 1.5, numLines) * radius
+    start = target + near[:, None] * direction
+    end = target + far[:, None] * direction
+    lines = np.hstack((start, end))
+    return lines + randomState.normal(0, noise, lines.shape)
+
+def generateScene(width=1920, height=1080, numCollections=3, linesPerCollection=10, lineNoise=1.0,
+                  numForged=1, forgeryOffset=0.3, numCirclePoints=9, clickNoise=2.0, seed=0):
+    '''
+    lineNoise      standard deviation in pixels added to every line endpoint
+    numForged      how many collections pass through an offset point instead of the center
+    forgeryOffset  distance of that point from the center, as a fraction of the radius
+    clickNoise     standard deviation in pixels of the clicked outline points
+    '''
+    randomState = np.random.RandomState(seed)
+    radius = randomState.uniform(0.15, 0.35) * min(width, height)
+    center = np.array([randomState.uniform(radius, width - radius), randomState.uniform(radius, height - radius)])
+
+    angles = randomState.uniform(0, 2 * np.pi, numCirclePoints)
+    circlePoints = center + radius * np.column_stack((np.cos(angles), np.sin(angles)))
+    circlePoints += randomState.normal(0, clickNoise, circlePoints.shape)
+
+    forged = np.zeros(numCollections, dtype=bool)
+    forged[randomState.permutation(numCollections)[:numForged]] = True
+    targets = np.tile(center, (numCollections, 1))
+    offsetAngles = randomState.uniform(0, 2 * np.pi, numCollections)
+    targets[forged] += forgeryOffset * radius * np.column_stack((np.cos(offsetAngles), np.sin(offsetAngles)))[forged]
+
+    lineSets = [_linesThrough(target, radius, linesPerCollection, lineNoise, randomState) for target in targets]
+    return SyntheticScene(width, height, center, radius, circlePoints, lineSets, forged, targets, seed)
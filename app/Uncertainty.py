@@ -0,0 +1,200 @@
+'''
+Monte Carlo uncertainty for the spherical analysis.
+
+Clicked line endpoints and refined circle points are both noisy, so a line of a
+genuine reflection never passes exactly through the fitted circle center. To
+tell how much of a collection's distance from the center noise can explain,
+every sample perturbs all endpoints and circle points at once, refits the
+circles in one batch with CircleFitting.fitCircles and evaluates all lines and
+intersections of all samples as array operations. The annotation is already
+noisy, so samples are drawn around what was fitted to it rather than around
+the annotation itself: circle points on the fitted circle plus noise, and
+lines through the collection's intersection cluster shifted by its resampled
+residuals.
+
+- Bootstrap: confidence intervals for each collection's mean line distance
+  and for the offset of its intersection cluster from the center. Each
+  sample's cluster is found by the mean shift of Geometry.densityCluster,
+  started from the observed mode. Collections of fewer than 3 lines have no
+  cluster to fit, so their own lines plus noise are used.
+- Null hypothesis: the same lines moved to pass exactly through the center,
+  plus noise, give the mean line distance a consistent collection would show.
+  The p-value is the fraction of those at least as large as the observed one,
+  so a small value means noise alone is an unlikely explanation.
+
+Samples are processed in chunks so memory stays bounded for large collections.
+'''
+
+import numpy as np
+
+import Geometry
+import CircleFitting
+from Instrumentation import instrument
+
+NUM_SAMPLES = 2000
+# standard deviation in pixels of the click noise on line endpoints
+LINE_NOISE = 1.0
+# lower bound for the circle point noise
+MIN_CIRCLE_NOISE = 0.25
+# intersections used per sample for the cluster statistics
+MAX_PAIRS = 500
+# endpoint values held in memory at once
+CHUNK_VALUES = 2000000
+
+
+class CollectionUncertainty(object):
+    '''
+    distanceInterval  (2,)  confidence interval of the mean distance from the lines to the center
+    offsetInterval    (2,)  confidence interval of the intersection cluster's distance from the center,
+                            None with fewer than 3 lines
+    pValue            float probability of a mean distance at least this large from noise alone
+    '''
+
+    def __init__(self, meanDistance, distanceInterval, offsetInterval, pValue):
+        self.meanDistance = meanDistance
+        self.distanceInterval = distanceInterval
+        self.offsetInterval = offsetInterval
+        self.pValue = pValue
+
+    def toDict(self):
+        return {
+            'meanDistance': float(self.meanDistance),
+            'distanceInterval': [float(v) for v in self.distanceInterval],
+            'offsetInterval': None if self.offsetInterval is None else [float(v) for v in self.offsetInterval],
+            'pValue': float(self.pValue),
+        }
+
+
+# Distances from per-sample centers (K, 2) to per-sample lines (K, n, 4)
+def _distances(centers, lines):
+    dx = lines[..., 2] - lines[..., 0]
+    dy = lines[..., 3] - lines[..., 1]
+    cross = (lines[..., 0] - centers[:, 0, None]) * dy - (lines[..., 1] - centers[:, 1, None]) * dx
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.abs(cross) / np.hypot(dx, dy)
+
+# Per-sample distance of the intersection cluster from the center, for the line pairs
+# given. The mean shift of Geometry.densityCluster runs for every sample at once from
+# the observed mode with the observed bandwidth.
+def _clusterOffsets(centers, lines, first, second, start, bandwidth):
+    a = lines[:, first]
+    b = lines[:, second]
+    rx, ry = a[..., 2] - a[..., 0], a[..., 3] - a[..., 1]
+    sx, sy = b[..., 2] - b[..., 0], b[..., 3] - b[..., 1]
+    denominator = rx * sy - ry * sx
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = ((b[..., 0] - a[..., 0]) * sy - (b[..., 1] - a[..., 1]) * sx) / denominator
+    points = np.stack((a[..., 0] + t * rx, a[..., 1] + t * ry), axis=-1)
+    # parallel pairs never come near the cluster
+    points[~np.isfinite(points).all(axis=-1)] = np.inf
+
+    clusters = np.tile(np.asarray(start, dtype=float), (len(points), 1))
+    for i in xrange(Geometry.MEAN_SHIFT_ITERATIONS):
+        with np.errstate(invalid='ignore'):
+            near = np.hypot(*(points - clusters[:, None]).transpose(2, 0, 1)) <= bandwidth
+        counts = near.sum(axis=1)
+        moved = np.where(near[..., None], points, 0).sum(axis=1) / np.maximum(counts, 1)[:, None]
+        moved[counts == 0] = clusters[counts == 0]
+        done = np.hypot(*(moved - clusters).T).max() < 1e-3 * bandwidth
+        clusters = moved
+        if done:
+            break
+    return np.hypot(*(clusters - centers).T)
+
+# Signed distances of lines from point, and the unit normals they are measured along
+def _signedOffsets(lines, point):
+    dx = lines[:, 2] - lines[:, 0]
+    dy = lines[:, 3] - lines[:, 1]
+    length = np.hypot(dx, dy)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normal = np.column_stack((-dy, dx)) / length[:, None]
+    normal[~np.isfinite(normal)] = 0
+    return ((lines[:, :2] - point) * normal).sum(axis=1), normal
+
+# Move every line sideways so it passes exactly through point
+def _throughPoint(lines, point):
+    signed, normal = _signedOffsets(lines, point)
+    shift = signed[:, None] * normal
+    return lines - np.hstack((shift, shift))
+
+def _interval(values, confidence):
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return np.array([np.nan, np.nan])
+    tail = 50 * (1 - confidence)
+    return np.percentile(values, [tail, 100 - tail])
+
+# Uncertainty for each line collection. center is what the observed distances are
+# measured from: the fitted circle center, or the projected sphere center of an
+# ellipse fit (see EllipseFitting), in which case the sampled centers are moved by
+# the perspective offset between the two, and circleNoise should be the ellipse
+# fit's rms error since the outline is not a circle. circleNoise defaults to the
+# rms error of a circle fit to circlePoints, corrected for the 3 fitted parameters.
+@instrument('uncertainty')
+def sphericalUncertainty(center, circlePoints, lineSets, numSamples=NUM_SAMPLES, lineNoise=LINE_NOISE,
+                         circleNoise=None, confidence=0.95, seed=0):
+    center = np.asarray(center, dtype=float)
+    circlePoints = Geometry.asPointArray(circlePoints)
+    randomState = np.random.RandomState(seed)
+
+    # Outliers were already voted out of the analysis' fit; leave them out here too
+    fit = CircleFitting.fitCircles(circlePoints)
+    circlePoints = circlePoints[fit.inliers[0]]
+    numPoints = len(circlePoints)
+    if circleNoise is None:
+        circleNoise = fit.rmsError[0] * np.sqrt(numPoints / max(numPoints - 3.0, 1.0))
+    circleNoise = max(circleNoise, MIN_CIRCLE_NOISE)
+    radial = circlePoints - fit.centers[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fittedPoints = fit.centers[0] + fit.radii[0] * radial / np.hypot(radial[:, 0], radial[:, 1])[:, None]
+
+    # One batch of perturbed circles, shared by every collection
+    noisyCircles = fittedPoints + randomState.normal(0, circleNoise, (numSamples,) + circlePoints.shape)
+    # scattered around center rather than the circle's own center, like the observed distances
+    centers = CircleFitting.fitCircles(noisyCircles, robust=False).centers + (center - fit.centers[0])
+
+    results = []
+    for lines in lineSets:
+        lines = Geometry.asLineArray(lines)
+        if not len(lines):
+            results.append(None)
+            continue
+        observed = Geometry.pointLineDistances(center, lines).mean()
+        nullLines = _throughPoint(lines, center)
+        cluster = Geometry.densityCluster(Geometry.pairwiseIntersections(lines)[0]) if len(lines) > 2 else None
+        if cluster is not None:
+            # the observed lines are these fitted ones shifted by the residuals along the normals
+            residuals, normals = _signedOffsets(lines, cluster.center)
+            fitted = _throughPoint(lines, cluster.center)
+            residuals *= np.sqrt(len(lines) / (len(lines) - 2.0))
+
+        first, second = np.triu_indices(len(lines), 1)
+        if len(first) > MAX_PAIRS:
+            chosen = randomState.choice(len(first), MAX_PAIRS, replace=False)
+            first, second = first[chosen], second[chosen]
+
+        bootstrap = np.empty(numSamples)
+        null = np.empty(numSamples)
+        offsets = np.empty(numSamples)
+        chunk = max(1, CHUNK_VALUES // (4 * len(lines) + 2 * len(first)))
+        for start in xrange(0, numSamples, chunk):
+            stop = min(numSamples, start + chunk)
+            chunkCenters = centers[start:stop]
+            if cluster is not None:
+                picked = residuals[randomState.randint(len(lines), size=(stop - start, len(lines)))]
+                shift = (picked * randomState.choice((-1, 1), picked.shape))[..., None] * normals
+                noisy = fitted + np.concatenate((shift, shift), axis=-1)
+            else:
+                noisy = lines + randomState.normal(0, lineNoise, (stop - start,) + lines.shape)
+            bootstrap[start:stop] = np.nanmean(_distances(chunkCenters, noisy), axis=1)
+            if cluster is not None:
+                offsets[start:stop] = _clusterOffsets(chunkCenters, noisy, first, second, cluster.center, cluster.bandwidth)
+            noisyNull = nullLines + randomState.normal(0, lineNoise, (stop - start,) + lines.shape)
+            null[start:stop] = np.nanmean(_distances(chunkCenters, noisyNull), axis=1)
+
+        results.append(CollectionUncertainty(
+            observed,
+            _interval(bootstrap, confidence),
+            _interval(offsets, confidence) if cluster is not None else None,
+            (1 + (null >= observed).sum()) / float(numSamples + 1)))
+    return results
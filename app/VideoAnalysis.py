@@ -0,0 +1,223 @@
+'''
+Streaming spherical analysis of videos and image sequences.
+
+Frames are read one at a time from a video file or a directory of images, and
+only the previous frame is kept, so memory use does not grow with the length of
+the sequence. The annotation for the first frame uses the BatchAnalysis format.
+
+From frame to frame:
+
+- The sphere is tracked with the previous circle as a prior. Its center is
+  predicted assuming constant velocity, and only the local edge refinement and
+  circle fit that SphericalAnalysis.addCircle does are rerun around it
+  (SphereDetection.refineCircle). When the fit fails the sphere can be detected
+  again from scratch with --detect.
+- Line endpoints are carried over with pyramidal Lucas-Kanade optical flow, all
+  lines in one call. Lines whose endpoints fail the forward-backward check are
+  dropped.
+- Each frame is analyzed with AnalysisResults.sphericalResult. One CSV row per
+  line collection per frame is written as soon as the frame is done.
+
+Usage: python VideoAnalysis.py SOURCE ANNOTATION [-o OUTPUT.csv] [-r SEARCH_RADIUS] [-m MAX_MOTION] [--detect]
+'''
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+import Geometry
+import CircleFitting
+import SphereDetection
+import AnalysisResults
+from AnnotationStore import AnnotationStore
+from ImagePyramid import IMAGE_EXTENSIONS
+from Instrumentation import timed, record
+
+NUM_CONTOUR_POINTS = 64
+# rms fit error in pixels above which the sphere counts as lost
+LOST_THRESHOLD = 2.0
+# forward-backward optical flow error in pixels above which an endpoint counts as lost
+FLOW_THRESHOLD = 1.0
+
+
+# Yield (frameIndex, luminance) for a video file or a directory of images, one frame at a time
+def readFrames(source):
+    import cv2
+    if os.path.isdir(source):
+        names = sorted(name for name in os.listdir(source) if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+        for idx, name in enumerate(names):
+            image = cv2.imread(os.path.join(source, name))
+            if image is None:
+                raise IOError("Could not read image %s" % name)
+            yield idx, Geometry.luminance(image)
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError("Could not open video %s" % source)
+    try:
+        idx = 0
+        while True:
+            ok, image = capture.read()
+            if not ok:
+                break
+            yield idx, Geometry.luminance(image)
+            idx += 1
+    finally:
+        capture.release()
+
+
+class SphereTracker(object):
+
+    def __init__(self, center, radius, searchRadius=5, maxMotion=10, numPoints=NUM_CONTOUR_POINTS):
+        self.center = np.asarray(center, dtype=float)
+        self.radius = float(radius)
+        self.velocity = np.zeros(2)
+        self.searchRadius = searchRadius
+        self.maxMotion = maxMotion
+        self.numPoints = numPoints
+
+    # Refine the predicted circle in gray. Returns the DetectedCircle and whether
+    # the fit was good enough to be trusted; a bad fit leaves the tracker as it was.
+    def update(self, gray):
+        def readRegion(x0, y0, x1, y1):
+            x0, y0 = max(0, int(x0)), max(0, int(y0))
+            return gray[y0:max(y0, int(y1)), x0:max(x0, int(x1))], (x0, y0)
+
+        predicted = self.center + self.velocity
+        # a wide search first to catch up with the motion, then a narrow one to settle on the edge
+        circle = SphereDetection.refineCircle(readRegion, (predicted[0], predicted[1], self.radius), self.numPoints, self.maxMotion, 1)
+        circle = SphereDetection.refineCircle(readRegion, circle.center + (circle.radius,), self.numPoints, self.searchRadius, 1)
+
+        tracked = circle.rmsError <= LOST_THRESHOLD and len(circle.points) >= 3
+        if tracked:
+            center = np.asarray(circle.center)
+            self.velocity = center - self.center
+            self.center = center
+            self.radius = circle.radius
+        return circle, tracked
+
+
+# Carries line endpoints from one frame to the next with optical flow
+class LineTracker(object):
+
+    def __init__(self, lineSets, maxError=FLOW_THRESHOLD):
+        self.lineSets = [Geometry.asLineArray(lines) for lines in lineSets]
+        self.maxError = maxError
+
+    def update(self, previousGray, gray):
+        import cv2
+        counts = [len(lines) for lines in self.lineSets]
+        if not sum(counts):
+            return self.lineSets
+
+        previous8 = np.clip(previousGray, 0, 255).astype(np.uint8)
+        current8 = np.clip(gray, 0, 255).astype(np.uint8)
+        points = np.vstack(self.lineSets).reshape(-1, 1, 2).astype(np.float32)
+        forward, status, _ = cv2.calcOpticalFlowPyrLK(previous8, current8, points, None)
+        backward, backStatus, _ = cv2.calcOpticalFlowPyrLK(current8, previous8, forward, None)
+
+        error = np.hypot(*(backward - points).reshape(-1, 2).T)
+        good = (status.ravel() == 1) & (backStatus.ravel() == 1) & (error <= self.maxError)
+        # a line survives only when both of its endpoints were tracked
+        keep = good.reshape(-1, 2).all(axis=1)
+        moved = forward.reshape(-1, 4).astype(float)
+
+        lineSets = []
+        start = 0
+        for count in counts:
+            lineSets.append(moved[start:start+count][keep[start:start+count]])
+            start += count
+        record('linesLost', (~keep).sum())
+        self.lineSets = lineSets
+        return lineSets
+
+
+# Fit the first frame's sphere from the annotation's circle points, or detect it.
+# Returns the center, radius and rms fit error.
+def initialCircle(annotation, gray, searchRadius=5, detect=False):
+    circlePoints = Geometry.asPointArray(annotation.get('circlePoints', []))
+    if len(circlePoints) >= 3:
+        h, k = CircleFitting.fitCircles(circlePoints, robust=False).centers[0]
+        refined = Geometry.refineEdgePoints(gray, circlePoints, (h, k), searchRadius)
+        fit = CircleFitting.fitCircles(refined)
+        return fit.centers[0], fit.radii[0], fit.rmsError[0]
+    if detect:
+        detected = SphereDetection.detectSpheres(gray, searchRadius=searchRadius)
+        if detected:
+            return detected[0].center, detected[0].radius, detected[0].rmsError
+    raise ValueError("The annotation needs at least 3 circle points, or use detect")
+
+# Analyze frames one by one, yielding a dict per frame with the frame index, the
+# tracked circle and its SphericalResult
+def analyzeSequence(frames, annotation, searchRadius=5, maxMotion=10, detect=False):
+    sphere = None
+    lines = LineTracker(annotation.get('lineCollections', []))
+    previousGray = None
+
+    for idx, gray in frames:
+        with timed('frame'):
+            if sphere is None:
+                center, radius, rmsError = initialCircle(annotation, gray, searchRadius, detect)
+                sphere = SphereTracker(center, radius, searchRadius, maxMotion)
+                tracked = True
+            else:
+                with timed('track'):
+                    circle, tracked = sphere.update(gray)
+                    if not tracked and detect:
+                        detected = SphereDetection.detectSpheres(gray, searchRadius=searchRadius)
+                        if detected:
+                            sphere = SphereTracker(detected[0].center, detected[0].radius, searchRadius, maxMotion)
+                            circle, tracked = detected[0], True
+                    lines.update(previousGray, gray)
+                rmsError = circle.rmsError
+
+            result = AnalysisResults.sphericalResult(sphere.center, sphere.radius, lines.lineSets)
+        previousGray = gray
+        yield {'frame': idx, 'center': sphere.center, 'radius': sphere.radius,
+               'rmsError': rmsError, 'tracked': tracked, 'result': result}
+
+CSV_HEADER = ['frame', 'centerX', 'centerY', 'radius', 'rmsError', 'tracked'] + AnalysisResults.SphericalResult.csvHeader
+
+def csvRows(frame):
+    prefix = [frame['frame'], frame['center'][0], frame['center'][1], frame['radius'], frame['rmsError'], frame['tracked']]
+    return [prefix + row for row in frame['result'].csvRows()]
+
+def loadAnnotation(annotationPath):
+    if annotationPath.endswith('.npz'):
+        store = AnnotationStore(annotationPath)
+        imageIds = store.imageIds()
+        if not imageIds:
+            raise ValueError("%s has no annotations" % annotationPath)
+        return store.get(imageIds[0])
+    with open(annotationPath) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Track a spherical mirror through a video or image sequence and analyze every frame.")
+    parser.add_argument('source', help="video file or directory of frames")
+    parser.add_argument('annotation', help="annotation of the first frame: a JSON file in the BatchAnalysis format or an annotation archive")
+    parser.add_argument('-o', '--output', help="CSV file for the per-frame results (default: standard output)")
+    parser.add_argument('-r', '--search-radius', dest='searchRadius', type=float, default=5, help="pixels searched along each radial when refining the circle (default: 5)")
+    parser.add_argument('-m', '--max-motion', dest='maxMotion', type=float, default=10, help="pixels the sphere's edge may move between frames beyond the predicted motion (default: 10)")
+    parser.add_argument('-d', '--detect', action='store_true', help="detect the sphere on the first frame without circle points and again whenever it is lost")
+    args = parser.parse_args()
+
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(CSV_HEADER)
+        frames = analyzeSequence(readFrames(args.source), loadAnnotation(args.annotation), args.searchRadius, args.maxMotion, args.detect)
+        for frame in frames:
+            writer.writerows(csvRows(frame))
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
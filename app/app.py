@@ -1,40 +1,290 @@
+import os
 from sys import maxint, argv, exit
 from functools import partial
 from PySide import QtCore, QtGui
+import numpy as np
 
 import ReflectionAnalysis
+from AnnotationStore import AnnotationStore
+from ImagePyramid import ImagePyramid, TileCache, IMAGE_EXTENSIONS
+from BackgroundJobs import BackgroundJobs
+import Geometry
+import CircleFitting
+import SphereReflection
+import SphereDetection
+import Correspondences
+import Uncertainty
+from Instrumentation import instruments, timed
 
 class AnalysisMode:
     PLANAR = 1
     SPHERICAL = 2
 
+    # modes by the name saved annotations use for them
+    BY_NAME = {'planar': PLANAR, 'spherical': SPHERICAL}
+
 class ToolMode:
     POINT_MATCHING = 1
     CIRCLE = 2
+    # two corners of the object region, then two corners of its reflection
+    REGION_MATCHING = 3
+
+# http://stackoverflow.com/questions/18406149/pyqt-pyside-how-do-i-convert-qimage-into-opencvs-mat-format
+def convertQImageToMat(incomingImage):
+    '''  Converts a QImage into an opencv MAT format  '''
+
+    incomingImage = incomingImage.convertToFormat(4)
+
+    width = incomingImage.width()
+    height = incomingImage.height()
+
+    ptr = incomingImage.bits()
+    ptr.setsize(incomingImage.byteCount())
+    arr = np.array(ptr).reshape(height, width, 4)  #  Copies the data
+    return arr
+
+# The analysis objects keep plain arrays and RGBA integers; drawing them is done here
+def drawLineCollection(painter, collection, borderRect, color):
+    # Clip all lines to the border in one step and draw the resulting segments together
+    painter.setPen(color)
+    segments = Geometry.clipLinesToRect(collection.endpoints, borderRect.getCoords())[0]
+    painter.drawLines([QtCore.QLineF(*segment) for segment in segments])
+    for x1, y1, x2, y2 in collection.endpoints:
+        painter.drawEllipse(QtCore.QPointF(x1, y1), 2, 2)
+        painter.drawEllipse(QtCore.QPointF(x2, y2), 2, 2)
+
+def drawAnalysis(painter, analysis, borderRect):
+    for lc, color in zip(analysis.lineCollections, analysis.colors):
+        drawLineCollection(painter, lc, borderRect, QtGui.QColor.fromRgba(color))
+    if analysis.mode == 'spherical' and analysis.radius != 0:
+        center = QtCore.QPointF(*analysis.center)
+        painter.setPen(QtGui.QColor(255, 0, 0))
+        if analysis.ellipse is not None:
+            # the outline, around the ellipse center rather than the projected sphere center
+            painter.save()
+            painter.translate(*analysis.ellipse['center'])
+            painter.rotate(np.degrees(analysis.ellipse['angle']))
+            painter.drawEllipse(QtCore.QPointF(0, 0), *analysis.ellipse['axes'])
+            painter.restore()
+        else:
+            painter.drawEllipse(center, analysis.radius, analysis.radius)
+        for x, y in analysis.circlePoints:
+            painter.drawEllipse(QtCore.QPointF(x, y), 2, 2)
+        painter.drawEllipse(center, 2, 2)
+
+# Downscaled copy of an image for showing while its pyramid is built. Safe to call
+# on a worker thread.
+def readPreview(fileName, maxSize=1024):
+    reader = QtGui.QImageReader(fileName)
+    size = reader.size()
+    if size.isValid() and max(size.width(), size.height()) > maxSize:
+        reader.setScaledSize(size.scaled(maxSize, maxSize, QtCore.Qt.KeepAspectRatio))
+    return reader.read()
+
+# Images in the same directory as fileName, sorted by name
+def siblingImages(fileName):
+    directory = os.path.dirname(os.path.abspath(fileName))
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS]
+
+# What is kept in memory for an image that is not on screen: its pyramid, its
+# preview and its analysis with any unsaved annotations. analysisObject is None
+# for prefetched images, whose annotations are restored when they are shown.
+class ImageSession(object):
+
+    def __init__(self, fileName, pyramid, preview=None, analysisMode=None, analysisObject=None):
+        self.fileName = fileName
+        self.pyramid = pyramid
+        self.preview = preview
+        self.analysisMode = analysisMode
+        self.analysisObject = analysisObject
+
+    def byteCount(self):
+        size = self.preview.byteCount() if self.preview is not None else 0
+        if self.analysisObject is not None:
+            size += sum(lc.endpoints.nbytes + lc.intersectionPoints.nbytes + lc.intersectionPairs.nbytes
+                        for lc in self.analysisObject.lineCollections)
+        return size
 
 class Canvas(QtGui.QWidget):
+    # extra pixels read around the clicked circle points for edge refinement
+    REFINE_MARGIN = 8
+    # background job channels that work on the current analysis object
+    ANALYSIS_CHANNELS = ('circle', 'match', 'analyze')
+
     def __init__(self, parent=None):
         super(Canvas, self).__init__(parent)
 
-        self.image = QtGui.QImage()
+        self.pyramid = None
+        self.preview = None
+        self.imageSize = QtCore.QSize()
+        # decoded tiles are shared by all images, so flipping back to one redraws from memory
+        self.tiles = TileCache(QtGui.QImage, lambda tile: tile.byteCount())
+        self.sessions = TileCache(None, lambda session: session.byteCount(), 64 * 1024 * 1024)
+        self.fileName = None
+        self._overlay = None
+        self._prefetching = None
+        # direction of the last move through the folder, for prefetching
+        self._step = 1
+        # Monte Carlo samples for spherical analyses, 0 for none
+        self.numSamples = 0
+        # fit an ellipse to the whole sphere outline when a circle is added, for a
+        # camera with this horizontal field of view in degrees
+        self.fitEllipse = False
+        self.fieldOfView = 60.0
+        # refinement, detection and analysis run here so the window stays responsive
+        self.jobs = BackgroundJobs(self)
+        self.jobs.busyChanged.connect(self.setBusy)
         self.resetMetadata()
         self.zoom = 1.0
 
+    # Open an image without blocking. A cached image comes back as it was left, with
+    # any unsaved annotations. Otherwise a low resolution preview is shown while the
+    # pyramid is built in the background, and annotating starts once it is ready.
     def openImage(self, fileName):
-        loadedImage = QtGui.QImage()
-        if not loadedImage.load(fileName):
+        if fileName == self.fileName:
+            return True
+        if not os.path.isfile(fileName):
             return False
 
-        #newSize = loadedImage.size().expandedTo(self.size())
-        #self.resizeImage(loadedImage, newSize)
-        self.resize(loadedImage.size())
-        mainWindow = self.parentWidget().parentWidget()
-        mainWindow.resize(max(loadedImage.size().width(), mainWindow.sizeHint().width()), mainWindow.sizeHint().height() + loadedImage.size().height())
-        self.image = loadedImage
-        #self.modified = False
-        self.resetMetadata()
+        self.storeSession()
+        session = self.sessions.pop(fileName)
+        if session is None and ImagePyramid.isBuilt(fileName):
+            with timed('open'):
+                session = ImageSession(fileName, ImagePyramid(fileName))
+        if session is not None:
+            self.showSession(session)
+            return True
+
+        self.showSession(ImageSession(fileName, None))
+        # formats Qt cannot read get their size once the pyramid is built
+        size = QtGui.QImageReader(fileName).size()
+        if size.isValid():
+            self.imageSize = size
+            self.resizeToImage()
+        self.jobs.submit('preview', partial(readPreview, fileName), partial(self.setPreview, fileName))
+        # a prefetch of this image that is still running delivers the pyramid instead
+        if fileName != self._prefetching or not self.jobs.isBusy('prefetch'):
+            self.jobs.submit('open', partial(self.buildPyramid, fileName), partial(self.setPyramid, fileName))
+        return True
+
+    def buildPyramid(self, fileName):
+        with timed('open'):
+            return ImagePyramid(fileName)
+
+    def setPreview(self, fileName, preview):
+        if fileName == self.fileName and self.pyramid is None:
+            self.preview = preview
+            self.update()
+
+    def setPyramid(self, fileName, pyramid):
+        if fileName == self.fileName:
+            self.showSession(ImageSession(fileName, pyramid, self.preview))
+
+    # Put the open image's state in the session cache
+    def storeSession(self):
+        if self.fileName is not None and self.pyramid is not None:
+            self.sessions.put(self.fileName, ImageSession(self.fileName, self.pyramid, self.preview, self._analysisMode, self.analysisObject))
+
+    def showSession(self, session):
+        self.jobs.cancel('preview')
+        self.jobs.cancel('open')
+        self.fileName = session.fileName
+        self.pyramid = session.pyramid
+        self.preview = session.preview
         self.zoom = 1.0
+        if session.pyramid is not None:
+            self.imageSize = QtCore.QSize(session.pyramid.width, session.pyramid.height)
+            self.resizeToImage()
+
+        if session.analysisObject is None:
+            self.resetMetadata()
+            if session.pyramid is not None:
+                self.restoreAnnotations()
+        else:
+            self.setAnalysisMode(session.analysisMode)
+            self.analysisObject = session.analysisObject
+            self.setToolMode(ToolMode.POINT_MATCHING)
+            self.invalidateOverlay()
+            self.refitCircle()
+
+        if session.pyramid is not None:
+            self.prefetch(self._step)
         self.update()
+
+    def resizeToImage(self):
+        self.resize(self.imageSize * self.zoom)
+        mainWindow = self.parentWidget().parentWidget()
+        mainWindow.resize(max(self.imageSize.width(), mainWindow.sizeHint().width()), mainWindow.sizeHint().height() + self.imageSize.height())
+
+    # Open the image step places away in the open image's folder
+    def openNeighbour(self, step):
+        if self.fileName is None:
+            return False
+        files = siblingImages(self.fileName)
+        if self.fileName not in files:
+            return False
+        self._step = step
+        return self.openImage(files[(files.index(self.fileName) + step) % len(files)])
+
+    # Build the pyramid, preview and first visible tiles of the image step places
+    # away in the background, so moving to it is near-instant
+    def prefetch(self, step):
+        files = siblingImages(self.fileName)
+        if self.fileName not in files or len(files) < 2:
+            return
+        fileName = files[(files.index(self.fileName) + step) % len(files)]
+        if fileName in self.sessions:
+            return
+        viewSize = self.parentWidget().size() if self.parentWidget() is not None else self.size()
+
+        def load():
+            pyramid = ImagePyramid(fileName)
+            level = pyramid.levelForZoom(1.0)
+            tiles = dict((path, QtGui.QImage(path)) for path in
+                         (pyramid.tilePath(level, row, column) for row, column, _ in
+                          pyramid.visibleTiles(level, (0, 0, viewSize.width(), viewSize.height()))))
+            return pyramid, readPreview(fileName), tiles
+
+        self._prefetching = fileName
+        self.jobs.submit('prefetch', load, partial(self.addPrefetched, fileName), partial(self.prefetchFailed, fileName))
+
+    def addPrefetched(self, fileName, loaded):
+        pyramid, preview, tiles = loaded
+        for path, tile in tiles.items():
+            self.tiles.put(path, tile)
+        if fileName != self.fileName:
+            self.sessions.put(fileName, ImageSession(fileName, pyramid, preview))
+        elif self.pyramid is None:
+            # the image was opened while it was being prefetched
+            self.showSession(ImageSession(fileName, pyramid, preview))
+
+    # openImage left building the pyramid to the prefetch, so build it now
+    def prefetchFailed(self, fileName, message):
+        if fileName == self.fileName and self.pyramid is None:
+            self.jobs.submit('open', partial(self.buildPyramid, fileName), partial(self.setPyramid, fileName))
+
+    # Restore the annotations saved for the open image, if there are any
+    def restoreAnnotations(self):
+        store = AnnotationStore.forImage(self.fileName)
+        annotation = store.get(store.imageIdFor(self.fileName))
+        if annotation is None:
+            return False
+
+        self.setAnalysisMode(AnalysisMode.BY_NAME[annotation['mode']])
+        self.analysisObject.setAnnotation(annotation)
+        self.invalidateOverlay()
+        # annotations keep no outline ellipse, so fit it again in ellipse mode
+        self.refitCircle()
+        return True
+
+    def saveAnnotations(self):
+        if self.fileName is None:
+            return False
+
+        store = AnnotationStore.forImage(self.fileName)
+        store.put(store.imageIdFor(self.fileName), self.analysisObject.getAnnotation())
+        store.save()
         return True
 
     def resetMetadata(self):
@@ -46,13 +296,47 @@ class Canvas(QtGui.QWidget):
         painter = QtGui.QPainter(self)
         painter.scale(self.zoom, self.zoom)
 
-        painter.drawImage(QtCore.QPoint(0, 0), self.image)
-        self.analysisObject.draw(painter, self.contentsRect())
+        if self.pyramid is not None:
+            self.drawTiles(painter, event.rect())
+        elif self.preview is not None:
+            painter.drawImage(QtCore.QRectF(QtCore.QPointF(0, 0), QtCore.QSizeF(self.imageSize)), self.preview)
+        painter.drawPicture(0, 0, self.overlay())
         for p in self._points:
             painter.drawEllipse(p, 2, 2)
 
+    # Draw only the tiles under the exposed rectangle, from the pyramid level closest to the zoom
+    def drawTiles(self, painter, exposedRect):
+        x0, y0, x1, y1 = [c / self.zoom for c in exposedRect.getCoords()]
+        level = self.pyramid.levelForZoom(self.zoom)
+        for row, column, targetRect in self.pyramid.visibleTiles(level, (x0, y0, x1, y1)):
+            tile = self.tiles.get(self.pyramid.tilePath(level, row, column))
+            painter.drawImage(QtCore.QRectF(*targetRect), tile)
+
+    # The lines, endpoints and circle are recorded once in image coordinates and
+    # replayed on every repaint, so neither scrolling nor zooming redraws them from
+    # Python. Call invalidateOverlay whenever the analysis object changes.
+    def overlay(self):
+        if self._overlay is None:
+            self._overlay = QtGui.QPicture()
+            painter = QtGui.QPainter(self._overlay)
+            drawAnalysis(painter, self.analysisObject, QtCore.QRect(QtCore.QPoint(0, 0), self.imageSize))
+            painter.end()
+        return self._overlay
+
+    # The annotations changed, so an analysis still running is out of date
+    def invalidateOverlay(self):
+        self._overlay = None
+        self.jobs.cancel('analyze')
+        self.update()
+
+    def setBusy(self, busy):
+        if busy:
+            self.setCursor(QtCore.Qt.BusyCursor)
+        else:
+            self.unsetCursor()
+
     def mousePressEvent(self, event):
-        if event.button() == QtCore.Qt.LeftButton and not self.image.isNull():
+        if event.button() == QtCore.Qt.LeftButton and self.pyramid is not None:
             #event.pos
             if self._analysisMode == AnalysisMode.SPHERICAL and self._toolMode == ToolMode.CIRCLE:
                 # make circle
@@ -60,21 +344,123 @@ class Canvas(QtGui.QWidget):
                 self._points.append(event.pos() / self.zoom)
                 # call analysisObject.addCircle() if there are 9 points saved
                 if len(self._points) > 8:
-                    self.analysisObject.addCircle(self._points, self.image)
+                    self.addCircle(self._points)
                     self._points = []
+                    self.invalidateOverlay()
             elif self._toolMode == ToolMode.POINT_MATCHING:
                 # make lines
                 if self._points:
                     # there is another point there, so make a line
-                    self.analysisObject.addLine(event.pos() / self.zoom, self._points[-1])
+                    self.analysisObject.addLine((event.pos() / self.zoom).toTuple(), self._points[-1].toTuple())
                     self._points = []
+                    self.invalidateOverlay()
                 else:
                     self._points.append(event.pos() / self.zoom)
+            elif self._toolMode == ToolMode.REGION_MATCHING:
+                self._points.append(event.pos() / self.zoom)
+                if len(self._points) > 3:
+                    self.matchRegions(self._points[:2], self._points[2:])
+                    self._points = []
             else:
                 print "Invalid input configuration"
 
             self.update()
 
+    # Refine and fit the circle in the background using only the full resolution pixels
+    # around the clicked points. A newer circle replaces one that is still being refined.
+    def addCircle(self, points):
+        points = [p.toTuple() for p in points]
+        xs = [x for x, y in points]
+        ys = [y for x, y in points]
+        margin = self.REFINE_MARGIN
+        pyramid = self.pyramid
+        analysisObject = self.analysisObject
+        analysisObject.fitEllipse = self.fitEllipse
+        analysisObject.camera = SphereReflection.Camera.fromFieldOfView(self.imageSize.width(), self.imageSize.height(), self.fieldOfView)
+        fitEllipse = self.fitEllipse
+
+        def refine():
+            x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+            if fitEllipse:
+                # the whole outline is searched, not just around the clicked points
+                rough = CircleFitting.fitCircles(points, robust=False)
+                (h, k), r = rough.centers[0], rough.radii[0]
+                x0, y0, x1, y1 = min(x0, h - r), min(y0, k - r), max(x1, h + r), max(y1, k + r)
+            pixels, offset = pyramid.region(x0 - margin, y0 - margin, x1 + margin + 1, y1 + margin + 1)
+            return analysisObject.refineCircle(points, pixels, offset)
+
+        self.jobs.submit('circle', refine, self.setCircle)
+
+    def setCircle(self, refined):
+        self.analysisObject.setCircle(*refined)
+        self.invalidateOverlay()
+
+    # Fit the circle again from its points when the Ellipse setting does not match how
+    # it was fitted, or always with force
+    def refitCircle(self, force=False):
+        if self._analysisMode != AnalysisMode.SPHERICAL or self.pyramid is None:
+            return False
+        points = self.analysisObject.circlePoints
+        if len(points) < 3 or (not force and self.fitEllipse == (self.analysisObject.ellipse is not None)):
+            return False
+        self.addCircle([QtCore.QPointF(x, y) for x, y in points])
+        return True
+
+    # Match keypoints between an object region and its reflection region in the
+    # background and add the filtered correspondences to the open line collection.
+    # Each region is given by two opposite corners.
+    def matchRegions(self, objectCorners, reflectionCorners):
+        pyramid = self.pyramid
+
+        def readRegion(corners):
+            xs = [p.x() for p in corners]
+            ys = [p.y() for p in corners]
+            pixels, offset = pyramid.region(min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+            return Geometry.luminance(pixels), offset
+
+        def match():
+            objectGray, objectOffset = readRegion(objectCorners)
+            reflectionGray, reflectionOffset = readRegion(reflectionCorners)
+            return Correspondences.findCorrespondences(objectGray, objectOffset, reflectionGray, reflectionOffset)
+
+        self.jobs.submit('match', match, self.addLines)
+
+    def addLines(self, lines):
+        if not len(lines):
+            print "No correspondences found"
+            return
+        self.analysisObject.addLines(lines)
+        self.invalidateOverlay()
+
+    # Find the sphere automatically: propose circles on a coarse pyramid level, refine
+    # the best one in a full resolution region and hand its contour to addCircle
+    def detectSphere(self):
+        if self.pyramid is None or self._analysisMode != AnalysisMode.SPHERICAL:
+            return False
+        pyramid = self.pyramid
+
+        def readRegion(x0, y0, x1, y1):
+            pixels, offset = pyramid.region(x0, y0, x1, y1)
+            return Geometry.luminance(pixels), offset
+
+        def detect():
+            level = pyramid.levelForSize(SphereDetection.WORKING_SIZE)
+            smallGray = Geometry.luminance(pyramid.levelImage(level))
+            scale = max(pyramid.levelScale(level))
+            proposals = SphereDetection.proposeCircles(smallGray, scale)
+            detected = [SphereDetection.refineCircle(readRegion, circle, scale=scale) for circle in proposals]
+            return min(detected, key=lambda c: c.rmsError / max(c.radius, 1)) if detected else None
+
+        self.jobs.submit('circle', detect, self.setDetectedSphere)
+        return True
+
+    def setDetectedSphere(self, best):
+        if best is None:
+            print "No sphere found"
+            return
+        self._points = []
+        self.addCircle([QtCore.QPointF(x, y) for x, y in best.points])
+
     def resizeImage(self, image, newSize):
         if image.size() == newSize:
             return
@@ -86,6 +472,9 @@ class Canvas(QtGui.QWidget):
         self.image = newImage
 
     def setAnalysisMode(self, newMode):
+        # work started for the previous analysis object no longer applies
+        for channel in self.ANALYSIS_CHANNELS:
+            self.jobs.cancel(channel)
         self._analysisMode = newMode
 
         if newMode == AnalysisMode.PLANAR:
@@ -96,7 +485,7 @@ class Canvas(QtGui.QWidget):
             print "Error: Undefined analysis mode"
 
         self._points = []
-        self.update()
+        self.invalidateOverlay()
 
     def setToolMode(self, newMode):
         self._toolMode = newMode
@@ -104,14 +493,18 @@ class Canvas(QtGui.QWidget):
 
     def startNewLineGroup(self):
         self.analysisObject.startNewLineCollection()
+        self.invalidateOverlay()
 
-    # Modifies plainTextEdit
-    def analyze(self, plainTextEdit):
-        self.analysisObject.analyze(plainTextEdit)
+    # Analyze a snapshot of the annotations in the background and pass the result
+    # object to onResult. Jobs on the 'analyze' channel are dropped when the annotations change.
+    def analyze(self, onResult, channel='analyze'):
+        if self._analysisMode == AnalysisMode.SPHERICAL:
+            self.analysisObject.numSamples = self.numSamples
+        self.jobs.submit(channel, self.analysisObject.analysisTask(), onResult)
 
     def changeZoom(self, change):
         self.zoom += change
-        self.resize(self.image.size()*self.zoom)
+        self.resize(self.imageSize*self.zoom)
         self.update()
 
     def clearCurrentPoints(self):
@@ -125,7 +518,17 @@ class Canvas(QtGui.QWidget):
 
     def undoLine(self):
         self.analysisObject.undoLine()
-        self.update()
+        self.invalidateOverlay()
+
+    def setUncertainty(self, enabled):
+        self.numSamples = Uncertainty.NUM_SAMPLES if enabled else 0
+
+    def setEllipse(self, enabled, fieldOfView=None):
+        self.fitEllipse = enabled
+        if fieldOfView is not None:
+            self.fieldOfView = fieldOfView
+        # the circle already added was fitted for the old setting or field of view
+        self.refitCircle(force=enabled)
 
 class MainWindow(QtGui.QMainWindow):
     def __init__(self):
@@ -154,10 +557,8 @@ class MainWindow(QtGui.QMainWindow):
     def setAnalysisMode(self, newMode):
         self.canvas.setAnalysisMode(newMode)
         
-        if newMode == AnalysisMode.SPHERICAL:
-            self.setCircleToolAct.setEnabled(True)
-        else:
-            self.setCircleToolAct.setEnabled(False)
+        self.setCircleToolAct.setEnabled(newMode == AnalysisMode.SPHERICAL)
+        self.detectSphereAct.setEnabled(newMode == AnalysisMode.SPHERICAL)
         
         self.canvas.setToolMode(ToolMode.POINT_MATCHING)
         self.setPointMatchingToolAct.setChecked(True)
@@ -169,15 +570,56 @@ class MainWindow(QtGui.QMainWindow):
         self.canvas.changeZoom(change)
 
     def analyze(self):
-        self.canvas.analyze(self.plainTextEdit)
+        self.canvas.analyze(self.showResult)
+
+    def showResult(self, result):
+        self.plainTextEdit.setPlainText(result.toText())
         self.plainTextEdit.show()
         self.plainTextEdit.activateWindow()
         self.plainTextEdit.setFocus()
         self.plainTextEdit.selectAll()
 
+    # The sphere outline depends on the camera, so ask for its field of view
+    def setEllipse(self, enabled):
+        fieldOfView = None
+        if enabled:
+            fieldOfView, ok = QtGui.QInputDialog.getDouble(self, "Ellipse", "Horizontal field of view of the camera in degrees:",
+                                                           self.canvas.fieldOfView, 1, 179, 1)
+            if not ok:
+                self.ellipseAct.setChecked(False)
+                return
+        self.canvas.setEllipse(enabled, fieldOfView)
+
+    # Show where time went in this session, slowest stage first
+    def showTimings(self):
+        self.plainTextEdit.setPlainText(instruments.report())
+        self.plainTextEdit.show()
+        self.plainTextEdit.activateWindow()
+
+    def exportResults(self):
+        fileName, filters = QtGui.QFileDialog.getSaveFileName(self, "Export Results",
+                QtCore.QDir.currentPath(), "JSON (*.json);;CSV (*.csv)")
+        if not fileName:
+            return
+        self.canvas.analyze(partial(self.writeResult, fileName), 'export')
+
+    def writeResult(self, fileName, result):
+        with open(fileName, 'wb' if fileName.lower().endswith('.csv') else 'w') as f:
+            if fileName.lower().endswith('.csv'):
+                result.writeCsv(f)
+            else:
+                f.write(result.toJson(indent=2))
+
     def createActions(self):
         self.openAct = QtGui.QAction("&Open...", self, shortcut="Ctrl+O",
                 triggered=self.open)
+        self.nextImageAct = QtGui.QAction("&Next Image", self, shortcut="PgDown",
+                triggered=partial(self.canvas.openNeighbour, 1))
+        self.previousImageAct = QtGui.QAction("&Previous Image", self, shortcut="PgUp",
+                triggered=partial(self.canvas.openNeighbour, -1))
+        self.saveAct = QtGui.QAction("&Save Annotations", self, shortcut="Ctrl+S",
+                toolTip="Save the lines and circle for the opened image so they are restored when it is reopened.",
+                triggered=self.canvas.saveAnnotations)
 
         # create analysis mode switching actions
         self.modeActGrp = QtGui.QActionGroup(self)
@@ -188,10 +630,16 @@ class MainWindow(QtGui.QMainWindow):
         self.mouseToolActGrp = QtGui.QActionGroup(self)
         self.setPointMatchingToolAct = QtGui.QAction("Match Points", self.mouseToolActGrp, toolTip="Set Point Matching Mode", checkable=True, triggered=partial(self.setToolMode, ToolMode.POINT_MATCHING))
         self.setCircleToolAct = QtGui.QAction("Find Circle", self.mouseToolActGrp, toolTip="Set Circle Finding Mode", checkable=True, triggered=partial(self.setToolMode, ToolMode.CIRCLE))
+        self.setRegionMatchingToolAct = QtGui.QAction("Match Regions", self.mouseToolActGrp, toolTip="Click two corners of an object and two corners of its reflection to add lines between matching keypoints", checkable=True, triggered=partial(self.setToolMode, ToolMode.REGION_MATCHING))
+        self.detectSphereAct = QtGui.QAction("Detect Sphere", self, toolTip="Find the sphere automatically", triggered=self.canvas.detectSphere)
 
         self.newLineGroupAct = QtGui.QAction("New Line Group", self, toolTip="Start a new group of lines. Use this when starting to analyze another object in the scene.", triggered=self.canvas.startNewLineGroup)
 
         self.analyzeAct = QtGui.QAction("Analyze", self, toolTip="Perform an analysis based on the current information.", triggered=self.analyze)
+        self.exportResultsAct = QtGui.QAction("&Export Results...", self, toolTip="Save the analysis results as JSON or CSV.", triggered=self.exportResults)
+        self.uncertaintyAct = QtGui.QAction("Uncertainty", self, checkable=True, toolTip="Add Monte Carlo confidence intervals and p-values to spherical analyses.", triggered=self.canvas.setUncertainty)
+        self.ellipseAct = QtGui.QAction("Ellipse", self, checkable=True, toolTip="Fit an ellipse to the whole sphere outline when adding a circle and analyze against the sphere center corrected for perspective.", triggered=self.setEllipse)
+        self.showTimingsAct = QtGui.QAction("Timings", self, toolTip="Show the time spent in each analysis stage and the latest fit diagnostics.", triggered=self.showTimings)
 
         self.zoomInAct = QtGui.QAction("+", self, toolTip="Zoom in", triggered=partial(self.changeZoom, .02))
         self.zoomOutAct = QtGui.QAction("-", self, toolTip="Zoom out", triggered=partial(self.changeZoom, -.02))
@@ -210,6 +658,10 @@ class MainWindow(QtGui.QMainWindow):
     def createMenus(self):
         fileMenu = QtGui.QMenu("&File", self)
         fileMenu.addAction(self.openAct)
+        fileMenu.addAction(self.nextImageAct)
+        fileMenu.addAction(self.previousImageAct)
+        fileMenu.addAction(self.saveAct)
+        fileMenu.addAction(self.exportResultsAct)
         fileMenu.addAction(self.undoLineAct)
 
         self.menuBar().addMenu(fileMenu)
@@ -224,11 +676,15 @@ class MainWindow(QtGui.QMainWindow):
 
         for action in self.mouseToolActGrp.actions():
             toolBar.addAction(action)
+        toolBar.addAction(self.detectSphereAct)
         toolBar.addAction(self.newLineGroupAct)
 
         toolBar.addSeparator()
 
         toolBar.addAction(self.analyzeAct)
+        toolBar.addAction(self.uncertaintyAct)
+        toolBar.addAction(self.ellipseAct)
+        toolBar.addAction(self.showTimingsAct)
 
         toolBar.addSeparator()
 
@@ -243,6 +699,7 @@ class MainWindow(QtGui.QMainWindow):
 def main():
     app = QtGui.QApplication(argv)
     window = MainWindow()
+    app.aboutToQuit.connect(window.canvas.jobs.waitForDone)
     window.show()
     exit(app.exec_())
     